@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Benchmarks of docker-citools scripts against synthetic Dockerfile projects.
+
+A project tree with the given number of versions and variants is generated
+(templates, mapping and skip-version globs, junk directories) along with
+a git history of commits touching templates and Dockerfiles. Scripts are
+timed end-to-end as subprocesses, results are written as JSON and can be
+compared against a stored baseline.
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+import stub_quay
+
+__docopt__ = """
+Usage: benchmarks/bench.py [-V versions] [-v variants] [-n commits] [-b builds] [-r repeat]
+                           [-j jobs] [-s seed] [-o file] [-B file] [-t tolerance]
+                           [-w dir] [-k] [<suite> ...]
+       benchmarks/bench.py -l
+
+Options:
+  -V versions --versions versions       number of generated versions [default: 40]
+  -v variants --variants variants       number of generated variants, including the default
+                                        one [default: 6]
+  -n commits --commits commits          number of generated commits [default: 50]
+  -b builds --builds builds             number of builds triggered in quay batches [default: 200]
+  -r repeat --repeat repeat             number of runs per suite [default: 3]
+  -j jobs --jobs jobs                   docker-template.py workers [default: 1]
+  -s seed --seed seed                   random seed of the generated project [default: 0]
+  -o file --output file                 write results as JSON to the file, - stands for stdout
+  -B file --baseline file               compare results to the baseline JSON file
+  -t tolerance --tolerance tolerance    allowed slowdown compared to the baseline, in
+                                        percent [default: 10]
+  -w dir --workdir dir                  directory to generate the project in (temporary by default)
+  -k --keep                             don't remove the generated project
+  -l --list                             list available suites
+
+Details:
+    Suites are run in the order listed by -l, all of them unless given.
+    Exit code is 1 if any suite is slower than its baseline median more
+    than the tolerance allows.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOCKER_TEMPLATE = os.path.join(ROOT, 'docker-template.py')
+GIT_UPDATED = os.path.join(ROOT, 'git-updated-dockerfiles.py')
+QUAY_BUILD = os.path.join(ROOT, 'quayio', 'build.py')
+
+SUITES = ('template-cold', 'template-warm', 'git-updated', 'git-updated-order',
+          'git-updated-impact', 'git-updated-levels', 'quay-batch', 'quay-batch-context')
+DISTROS = ('centos', 'fedora', 'debian', 'ubuntu', 'alpine')
+BASE_TAG = 'bench-base'
+
+
+def git(path, *args):
+    """Run git command in the project, its output returned.
+    """
+    command = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost'] + list(args)
+    return subprocess.check_output(command, cwd=path)
+
+
+def write_file(path, content):
+    """Write content to path, parent directories are created.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as stream:
+        stream.write(content)
+
+
+def append_file(path, content):
+    with open(path, 'a') as stream:
+        stream.write(content)
+
+
+class SyntheticProject(object):
+    """
+    Generated Dockerfile project tree with its git history.
+    """
+
+    def __init__(self, path, versions=40, variants=6, seed=0):
+        self.path = path
+        self.random = random.Random(seed)
+        self.versions = ['{}{}'.format(DISTROS[i % len(DISTROS)], i // len(DISTROS))
+                         for i in range(versions)]
+        self.variants = ['variant{}'.format(i) for i in range(1, variants)]
+
+    def template_name(self, variant):
+        return 'Dockerfile.template-' + variant if variant else 'Dockerfile.template'
+
+    def template(self, index):
+        """Template content, each variant is based on the previous one.
+        """
+        if index == 0:
+            base = 'FROM {{ registry }}base:{{ version }}'
+        elif index == 1:
+            base = 'FROM {{ registry }}{{ image }}:{{ version }}'
+        else:
+            base = 'FROM {{ registry }}{{ image }}:{{ version }}-' + self.variants[index - 2]
+        packages = ' \\\n    '.join('package{}-{}'.format(index, i) for i in range(20))
+        return '\n'.join([
+            base,
+            'ENV BENCH_VARIANT={{ variant }} BENCH_HELLO={{ hello }}',
+            'RUN install \\\n    ' + packages,
+            '{% for i in range(10) %}RUN step {{ i }} {{ version }}\n{% endfor %}'
+        ]) + '\n'
+
+    def config(self):
+        """docker-template.yaml content, variants are mapped to distro globs.
+        """
+        lines = ['---', 'env:', '  hello: world', '  image: bench',
+                 '  registry: quay.io/bench/', 'mapping:']
+        for i, variant in enumerate(self.variants):
+            if i % 2:
+                distros = self.random.sample(DISTROS, 2)
+                lines.append('  {}:\n    - "{{{}}}*"'.format(variant, ','.join(distros)))
+        lines.extend(['skip-version:', '  - junk-*', '  - "~*"'])
+        return '\n'.join(lines) + '\n'
+
+    def generate(self):
+        """Generate templates, config and version directories, commit them.
+        """
+        write_file(os.path.join(self.path, 'docker-template.yaml'), self.config())
+        for index, variant in enumerate([''] + self.variants):
+            write_file(os.path.join(self.path, self.template_name(variant)), self.template(index))
+        for version in self.versions + ['junk-dir', '~tmp']:
+            write_file(os.path.join(self.path, version, '.keep'), '')
+        git(self.path, 'init', '-q')
+        git(self.path, 'add', '.')
+        git(self.path, 'commit', '-q', '-m', 'Synthetic project')
+
+    def dockerfiles(self):
+        """Generated Dockerfiles relative paths.
+        """
+        found = []
+        for version in self.versions:
+            for directory, _, files in os.walk(os.path.join(self.path, version)):
+                if 'Dockerfile' in files:
+                    found.append(os.path.relpath(os.path.join(directory, 'Dockerfile'),
+                                                 self.path))
+        return sorted(found)
+
+    def clean(self):
+        """Remove generated Dockerfiles and render cache.
+        """
+        for relpath in self.dockerfiles():
+            os.remove(os.path.join(self.path, relpath))
+        cache = os.path.join(self.path, '.docker-template.cache')
+        if os.path.exists(cache):
+            os.remove(cache)
+
+    def commit_history(self, commits):
+        """Commit generated Dockerfiles as base and then commits touching
+           templates and Dockerfiles on top of it.
+        """
+        git(self.path, 'add', '.')
+        git(self.path, 'commit', '-q', '--allow-empty', '-m', 'Generated Dockerfiles')
+        git(self.path, 'tag', '-f', BASE_TAG)
+        dockerfiles = self.dockerfiles()
+        for i in range(commits):
+            if self.random.random() < 0.3:
+                variant = self.random.choice([''] + self.variants)
+                append_file(os.path.join(self.path, self.template_name(variant)),
+                            'RUN change {}\n'.format(i))
+            for relpath in self.random.sample(dockerfiles, min(len(dockerfiles), 5)):
+                append_file(os.path.join(self.path, relpath), 'RUN change {}\n'.format(i))
+            git(self.path, 'commit', '-q', '-a', '-m', 'Change {}'.format(i))
+
+    def batch(self, count, contexts=False):
+        """Batch records for quayio/build.py, ndjson lines.
+        """
+        lines = []
+        for i in range(count):
+            version = self.versions[i % len(self.versions)]
+            record = {'repository': 'bench/bench', 'tag': '{}-{}'.format(version, i),
+                      'pull_robot': 'bench+robot'}
+            if contexts:
+                record['context'] = os.path.join(self.path, version)
+            else:
+                record['dockerfile'] = 'https://example.com/{}.tgz'.format(version)
+            lines.append(json.dumps(record))
+        return '\n'.join(lines) + '\n'
+
+
+class Benchmark(object):
+    """
+    Runs suites against the synthetic project, collects timings.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.repeat = int(args['--repeat'])
+        self.workdir = args['--workdir'] or tempfile.mkdtemp(prefix='citools-bench-')
+        self.project = SyntheticProject(os.path.join(self.workdir, 'project'),
+                                        int(args['--versions']), int(args['--variants']),
+                                        int(args['--seed']))
+        self.results = {}
+        self.server = None
+
+    def run_script(self, command, stdin=None, env=None):
+        """Run script in the project directory, wall time returned.
+        """
+        environ = dict(os.environ, **(env or {}))
+        start = time.time()
+        process = subprocess.Popen([sys.executable] + command, cwd=self.project.path, env=environ,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate(stdin)[0]
+        elapsed = time.time() - start
+        if process.returncode != 0:
+            raise RuntimeError("`{}' failed with code {}:\n{}".format(
+                ' '.join(command), process.returncode, output))
+        return elapsed
+
+    def measure(self, name, run, prepare=None):
+        """Run suite repeat times, prepare is called before every run.
+        """
+        runs = []
+        for _ in range(self.repeat):
+            if prepare:
+                prepare()
+            runs.append(run())
+        runs.sort()
+        self.results[name] = {
+            'runs': runs,
+            'min': runs[0],
+            'median': runs[len(runs) // 2],
+            'mean': sum(runs) / len(runs)
+        }
+        print "{:<22} min {:8.3f}s  median {:8.3f}s".format(name, runs[0], runs[len(runs) // 2])
+        sys.stdout.flush()
+
+    def docker_template(self):
+        return self.run_script([DOCKER_TEMPLATE, '-q', '-j', self.args['--jobs']])
+
+    def template_cold(self):
+        self.measure('template-cold', self.docker_template, self.project.clean)
+
+    def template_warm(self):
+        self.measure('template-warm', self.docker_template)
+
+    def revision_diff(self):
+        return '{}..HEAD'.format(BASE_TAG)
+
+    def git_updated(self):
+        self.measure('git-updated', lambda: self.run_script([GIT_UPDATED, self.revision_diff()]))
+
+    def git_updated_order(self):
+        variants = self.project.variants + ['_default']
+        self.measure('git-updated-order', lambda: self.run_script(
+            [GIT_UPDATED, self.revision_diff(), '--'] + variants))
+
+    def git_updated_impact(self):
+        self.measure('git-updated-impact', lambda: self.run_script(
+            [GIT_UPDATED, '-i', self.revision_diff()]))
+
+    def git_updated_levels(self):
+        self.measure('git-updated-levels', lambda: self.run_script(
+            [GIT_UPDATED, '-l', self.revision_diff()]))
+
+    def quay_env(self):
+        if self.server is None:
+            self.server = stub_quay.start_server()
+        return {'QUAYIO_APIURL': self.server.api_url, 'QUAYIO_ACCESSTOKEN': 'bench'}
+
+    def quay_batch(self, name='quay-batch', contexts=False):
+        records = self.project.batch(int(self.args['--builds']), contexts)
+        env = self.quay_env()
+        self.measure(name, lambda: self.run_script([QUAY_BUILD, '-b', '-', '-c', '8'],
+                                                   stdin=records, env=env))
+
+    def quay_batch_context(self):
+        self.quay_batch('quay-batch-context', contexts=True)
+
+    def run(self, names=None):
+        """Generate the project and run suites, results returned.
+        """
+        unknown = set(names or ()) - set(SUITES)
+        if unknown:
+            raise ValueError("unknown suites: {}".format(', '.join(sorted(unknown))))
+
+        self.project.generate()
+        started = False
+        for name in SUITES:
+            # history is committed once Dockerfiles are rendered.
+            if name.startswith('git-') and not started:
+                if not self.project.dockerfiles():
+                    self.docker_template()
+                self.project.commit_history(int(self.args['--commits']))
+                started = True
+            if not names or name in names:
+                getattr(self, name.replace('-', '_'))()
+        return self.report()
+
+    def report(self):
+        return {
+            'params': dict((k.lstrip('-'), self.args[k]) for k in (
+                '--versions', '--variants', '--commits', '--builds', '--repeat', '--jobs',
+                '--seed')),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            },
+            'results': self.results
+        }
+
+    def cleanup(self):
+        if self.server is not None:
+            self.server.shutdown()
+        if not self.args['--keep'] and not self.args['--workdir']:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        elif self.args['--keep']:
+            print "Project kept in {}".format(self.project.path)
+
+
+def compare(report, baseline, tolerance):
+    """Compare medians to the baseline, list of regressed suites returned.
+    """
+    if report['params'] != baseline.get('params'):
+        print "WARNING: baseline was recorded with different parameters"
+
+    regressed = []
+    print "{:<22} {:>10} {:>10} {:>8}".format('suite', 'baseline', 'current', 'change')
+    for name, result in sorted(report['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print "{:<22} {:>10} {:>10.3f}".format(name, '-', result['median'])
+            continue
+        change = (result['median'] - base['median']) / base['median'] * 100
+        status = ''
+        if change > tolerance:
+            regressed.append(name)
+            status = ' REGRESSION'
+        print "{:<22} {:>10.3f} {:>10.3f} {:>+7.1f}%{}".format(
+            name, base['median'], result['median'], change, status)
+    return regressed
+
+
+if __name__ == "__main__":
+    args = docopt(__docopt__)
+    if args['--list']:
+        print "\n".join(SUITES)
+        sys.exit(0)
+
+    bench = Benchmark(args)
+    try:
+        report = bench.run(args['<suite>'])
+    except (ValueError, RuntimeError, subprocess.CalledProcessError) as e:
+        print "Benchmark failed: {}".format(e)
+        sys.exit(1)
+    finally:
+        bench.cleanup()
+
+    if args['--output'] == '-':
+        print json.dumps(report, indent=1, sort_keys=True)
+    elif args['--output']:
+        with open(args['--output'], 'w') as stream:
+            json.dump(report, stream, indent=1, sort_keys=True)
+
+    if args['--baseline']:
+        with open(args['--baseline'], 'r') as stream:
+            regressed = compare(report, json.load(stream), float(args['--tolerance']))
+        if regressed:
+            sys.exit(1)
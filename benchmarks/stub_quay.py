@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the quay.io API used by benchmarks.
+
+Implements just enough of the API for quayio/build.py: build requests,
+build status polling (builds complete after a few polls), file drops and
+chunked context uploads. Connections can be closed after every response
+(like an idle keep-alive timeout) and requests can be dropped without any
+response, which exercises retries of the client. Start it standalone and point the script to it
+with QUAYIO_APIURL=http://127.0.0.1:port/api/v1.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import sys
+import threading
+
+from docopt import docopt
+
+__docopt__ = """
+Usage: benchmarks/stub_quay.py [-p port] [-l latency] [--polls polls] [--close-idle]
+
+Options:
+  -p port --port port          port to listen on [default: 8765]
+  -l latency --latency latency  seconds to delay each response [default: 0]
+  --polls polls                number of status polls before a build completes [default: 3]
+  --close-idle                 close connections after every response without telling clients.
+"""
+
+PHASES = ('waiting', 'building', 'pushing', 'complete')
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler, state is kept on the server.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, data):
+        if self.server.latency:
+            threading.Event().wait(self.server.latency)
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # keep-alive isn't revoked by a header, clients find out on their next request
+        self.close_connection = int(self.server.close_idle)
+
+    def dropped(self):
+        """Close connection without a response if the request is to be dropped.
+        """
+        with self.server.lock:
+            if self.server.drop <= 0:
+                return False
+            self.server.drop -= 1
+        self.close_connection = 1
+        return True
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            size = 0
+            while True:
+                chunk = int(self.rfile.readline().strip(), 16)
+                if chunk == 0:
+                    self.rfile.readline()
+                    return size
+                self.rfile.read(chunk)
+                self.rfile.readline()
+                size += chunk
+        return len(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def do_PUT(self):
+        self.server.count('upload bytes', self.read_body())
+        self.send(200, {})
+
+    def do_POST(self):
+        self.read_body()
+        if self.dropped():
+            self.server.count('dropped')
+            if not self.path.rstrip('/').endswith('/filedrop'):
+                # the build is triggered although nothing is answered
+                self.server.count('builds')
+            return
+        build_id = str(next(self.server.ids))
+        if self.path.rstrip('/').endswith('/filedrop'):
+            self.server.count('filedrops')
+            host, port = self.server.server_address
+            return self.send(200, {'file_id': build_id,
+                                   'url': 'http://{}:{}/upload/{}'.format(host, port, build_id)})
+        self.server.count('builds')
+        self.server.polls[build_id] = 0
+        # /api/v1/repository/{namespace}/{name}/build/
+        namespace, _, name = self.path.split('/repository/', 1)[-1].partition('/')
+        self.send(201, {'id': build_id, 'phase': PHASES[0],
+                        'repository': {'namespace': namespace, 'name': name.split('/')[0]}})
+
+    def do_GET(self):
+        build_id = self.path.rstrip('/').rsplit('/', 1)[-1]
+        self.server.count('polls')
+        if self.dropped():
+            self.server.count('dropped')
+            return
+        with self.server.lock:
+            polls = self.server.polls[build_id] = self.server.polls.get(build_id, 0) + 1
+        phase = PHASES[min(len(PHASES) - 1, polls * (len(PHASES) - 1) // self.server.complete_after)]
+        self.send(200, {'id': build_id, 'phase': phase})
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded stub server, requests are counted per kind.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, polls=3, close_idle=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.close_idle = close_idle
+        # number of next requests answered by closing the connection
+        self.drop = 0
+        self.complete_after = max(1, polls)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.polls = {}
+        self.counters = {}
+
+    @property
+    def api_url(self):
+        return 'http://{}:{}/api/v1'.format(*self.server_address)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+def start_server(port=0, latency=0, polls=3, close_idle=False):
+    """Start stub server in a daemon thread, the server is returned.
+    """
+    server = StubServer(port, latency, polls, close_idle)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    args = docopt(__docopt__)
+    server = StubServer(int(args['--port']), float(args['--latency']), int(args['--polls']),
+                        args['--close-idle'])
+    print "Serving quay.io stub API at {}".format(server.api_url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import sys
+import time
+
+from citools.builder import BUILT, BuildExecutor, summary
+from citools.graph import dockerfile_target
+from citools.template import ConfigError, load_config, project_plan
+from docopt import docopt
+
+# Logger output goes to console, ie it's not reaching STDOUT
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+log.setLevel(logging.INFO)
+
+
+__docopt__ = """
+Usage: build-dockerfiles.py [-v] [-j slots] [--docker path] [-o option]... [-l dir]
+                            [--timeout seconds] [-c template.yaml] [--plan file] [--json]
+                            <dockerfile>...
+
+Options:
+  -j slots --jobs slots                         number of concurrent docker builds [default: 1].
+  --docker path                                 docker binary (DOCKER environment variable
+                                                overrides the default docker).
+  -o option --docker-opt option                 extra docker build option, ie. --pull.
+  -l dir --log-dir dir                          directory of per-target build logs
+                                                [default: build-logs].
+  --timeout seconds                             kill builds running longer than that.
+  -c template.yaml --config_path template.yaml  config with image and registry names
+                                                [default: docker-template.yaml].
+  --plan file                                   take image and registry names from the plan
+                                                written by docker-template.py --plan.
+  --json                                        print results as JSON.
+  -v --verbose                                  shows debug output.
+
+Details:
+    Dockerfiles are {{ version }}/{{ variant }}/Dockerfile paths relative to the
+    current project directory (ie. output of git-updated-dockerfiles.py), - reads
+    them from stdin. Images are tagged {{ registry }}{{ image }}:{{ version }}[-variant].
+    Builds of Dockerfiles referring to other given targets by FROM wait until those
+    are built. Exit code is 1 if any build failed or was skipped.
+"""
+
+
+def project_env(config_path, plan_path=None):
+    """Env of the current directory project, from the plan if given.
+    """
+    try:
+        plan = project_plan(plan_path, log=log) if plan_path else None
+    except ConfigError as e:
+        log.error("ERROR: %s", e)
+        sys.exit(1)
+    if plan is not None:
+        return plan['env']
+    try:
+        return load_config(config_path, log).get('env') or {}
+    except ConfigError as e:
+        log.error("ERROR: %s", e)
+        sys.exit(1)
+
+
+def convert_number(value, name, cast=int):
+    """Positive number option value.
+    """
+    try:
+        number = cast(value)
+        if number <= 0:
+            raise ValueError(value)
+        return number
+    except ValueError:
+        log.error("ERROR: Argument %s expects positive number, given: %s", name, value)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = docopt(__docopt__)
+    if args['--verbose']:
+        log.setLevel(logging.DEBUG)
+
+    dockerfiles = args['<dockerfile>']
+    if dockerfiles == ['-']:
+        dockerfiles = [line.strip() for line in sys.stdin if line.strip()]
+    missing = [d for d in dockerfiles if not os.path.isfile(d)]
+    if missing:
+        log.error("ERROR: Dockerfiles not found: %s", ', '.join(missing))
+        sys.exit(1)
+
+    env = project_env(args['--config_path'], args['--plan'])
+    timeout = args['--timeout'] and convert_number(args['--timeout'], '--timeout', float)
+    executor = BuildExecutor([dockerfile_target(d) for d in dockerfiles],
+                             env.get('image', os.path.basename(os.getcwd())),
+                             env.get('registry', ''),
+                             slots=convert_number(args['--jobs'], '--jobs'),
+                             docker=args['--docker'] or os.environ.get('DOCKER') or 'docker',
+                             log_dir=args['--log-dir'], options=args['--docker-opt'],
+                             timeout=timeout, log=log)
+
+    started, results = time.time(), []
+    try:
+        for result in executor.run():
+            results.append(result)
+            if not args['--json']:
+                log.info("%s %s (%.1fs)", result.status.upper(), result.dockerfile,
+                         result.duration)
+    except (IOError, OSError) as e:
+        log.error("ERROR: %s", e)
+        sys.exit(1)
+    elapsed = time.time() - started
+
+    if args['--json']:
+        print json.dumps({
+            'elapsed': elapsed,
+            'results': [dict(r._asdict(), target=list(r.target)) for r in results]
+        }, indent=2, separators=(',', ': '))
+    else:
+        for line in summary(results, elapsed):
+            log.info("%s", line)
+
+    if any(r.status != BUILT for r in results):
+        sys.exit(1)
@@ -0,0 +1,3 @@
+"""
+Shared modules of docker-citools scripts.
+"""
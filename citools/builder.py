@@ -0,0 +1,182 @@
+"""
+Local docker build executor of generated Dockerfiles.
+
+Version/variant targets are built by `docker build` running in a number of
+slots concurrently. A target whose FROM references a sibling target is held
+back until that build succeeds and skipped if it fails. Output of every build
+goes to its own log file, results carry durations for the summary. The docker
+binary is configurable, so a stub can stand in where no daemon is available.
+"""
+
+import logging
+import os
+import Queue
+
+from citools.execute import limiter, run_logged
+from citools.graph import BuildGraph, image_tag
+from citools.matrix import dockerfile_path
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+BUILT = 'built'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# Result of a target build, log is None for skipped targets.
+BuildResult = namedtuple('BuildResult', 'target dockerfile image status duration log error')
+
+
+class BuildExecutor(object):
+    """
+    Build version/variant targets of the project at path respecting their
+    FROM dependencies.
+    """
+
+    def __init__(self, targets, image, registry='', slots=1, docker='docker',
+                 log_dir='build-logs', options=None, timeout=None, path=None, log=None):
+        self.path = os.path.abspath(path or os.getcwd())
+        self.targets = list(targets)
+        self.image = image
+        self.registry = registry or ''
+        self.slots = max(1, slots)
+        self.docker = docker
+        self.log_dir = log_dir
+        self.options = list(options or [])
+        self.timeout = timeout
+        self.log = log or logging.getLogger(__name__)
+        self.graph = BuildGraph(self.targets, image, self.registry, path=self.path)
+
+    def image_name(self, target):
+        """Full image name of the target, ie. quay.io/org/image:centos7-curl.
+        """
+        return '{}{}:{}'.format(self.registry, self.image, image_tag(*target))
+
+    def log_path(self, target):
+        return os.path.join(self.log_dir, '{}.log'.format(image_tag(*target)))
+
+    def command(self, target):
+        """docker build argv of the target, its directory is the build context.
+        """
+        dockerfile = dockerfile_path(*target)
+        return [self.docker, 'build'] + self.options + \
+            ['-t', self.image_name(target), '-f', dockerfile, os.path.dirname(dockerfile)]
+
+    def build(self, target):
+        """Build the target, BuildResult returned.
+        """
+        dockerfile = dockerfile_path(*target)
+        log_path = self.log_path(target)
+        self.log.debug("Building %s: `%s'", dockerfile, ' '.join(self.command(target)))
+        try:
+            result = run_logged(self.command(target), log_path, cwd=self.path,
+                                timeout=self.timeout)
+        except (IOError, OSError) as e:
+            return BuildResult(target, dockerfile, self.image_name(target), FAILED, 0.0,
+                               None, "Unable to write build log: {}".format(e))
+        if result.failed:
+            error = result.error.strip() or "docker exited with code {}".format(result.returncode)
+            return BuildResult(target, dockerfile, self.image_name(target), FAILED,
+                               result.duration, log_path, error)
+        return BuildResult(target, dockerfile, self.image_name(target), BUILT,
+                           result.duration, log_path, None)
+
+    def safe_build(self, target):
+        """Build the target, any failure is turned into a failed result, so the
+           scheduler waiting for it is never left blocked.
+        """
+        try:
+            return self.build(target)
+        except Exception as e:
+            self.log.debug("Build of %s raised", dockerfile_path(*target), exc_info=True)
+            return BuildResult(target, dockerfile_path(*target), self.image_name(target), FAILED,
+                               0.0, None, "{}: {}".format(type(e).__name__, e))
+
+    def skipped(self, target, reason):
+        return BuildResult(target, dockerfile_path(*target), self.image_name(target), SKIPPED,
+                           0.0, None, reason)
+
+    def skip_dependants(self, target, waiting):
+        """Skip waiting targets depending (transitively) on the target which
+           won't be built, their results are yielded.
+        """
+        failed = [target]
+        while failed:
+            target = failed.pop()
+            for dependant in [t for t in self.targets if target in
+                              self.graph.dependencies.get(t, ()) and t in waiting]:
+                del waiting[dependant]
+                failed.append(dependant)
+                yield self.skipped(dependant, "{} was not built".format(
+                    dockerfile_path(*target)))
+
+    def run(self):
+        """Build all the targets, results are yielded as builds finish. Targets
+           are started in the given order once their dependencies are built.
+        """
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        # all the slots are allowed to run their builds at once
+        if limiter.limit < self.slots:
+            limiter.set(self.slots)
+
+        _, cycles = self.graph.levels()
+        cyclic = set(t for cycle in cycles for t in cycle)
+        for target in self.targets:
+            if target in cyclic:
+                yield self.skipped(target, "dependency cycle")
+
+        selected = set(self.targets)
+        waiting = dict((t, set(d for d in self.graph.dependencies[t] if d in selected))
+                       for t in self.targets if t not in cyclic)
+        for target in self.targets:
+            if target in cyclic:
+                for result in self.skip_dependants(target, waiting):
+                    yield result
+        done = Queue.Queue()
+        pool = ThreadPool(self.slots)
+        running = 0
+        try:
+            while True:
+                for target in [t for t in self.targets if not waiting.get(t, True)]:
+                    del waiting[target]
+                    pool.apply_async(self.safe_build, (target,), callback=done.put)
+                    running += 1
+                if not running:
+                    break
+
+                # block in short intervals, so Ctrl-C isn't deferred
+                while True:
+                    try:
+                        result = done.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running -= 1
+                yield result
+
+                for deps in waiting.values():
+                    deps.discard(result.target)
+                if result.status != BUILT:
+                    for skipped in self.skip_dependants(result.target, waiting):
+                        yield skipped
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def summary(results, elapsed):
+    """Summary lines, per target status and duration followed by totals.
+    """
+    lines = ['***** build summary *****']
+    for result in results:
+        lines.append('{:<8} {:<40} {:>8.1f}s {}'.format(
+            result.status.upper(), result.dockerfile, result.duration,
+            result.log or result.error or ''))
+        if result.status == FAILED and result.error:
+            lines.append('         {}'.format(result.error.splitlines()[-1]))
+    counts = dict((s, sum(1 for r in results if r.status == s)) for s in (BUILT, FAILED, SKIPPED))
+    lines.append('{} built, {} failed, {} skipped in {:.1f}s (build time {:.1f}s)'.format(
+        counts[BUILT], counts[FAILED], counts[SKIPPED], elapsed,
+        sum(r.duration for r in results)))
+    return lines
+
@@ -0,0 +1,154 @@
+"""
+Index of paths changed by commits, used by git-updated-dockerfiles.py --query.
+
+Commits are immutable, so paths changed by a commit (compared to its first
+parent) are computed once with a single git diff-tree run and stored in the
+index keyed by commit SHA. Queries for any range and subdirectory are then
+answered by unions of the indexed sets. A range covers the commits listed by
+git rev-list, so paths changed and later reverted within the range are
+reported as well.
+"""
+
+import json
+import os
+
+from citools.execute import git
+from citools.util import atomic_write
+
+INDEX_VERSION = 1
+INDEX_NAME = 'citools-changes.json'
+
+
+class ChangeIndexError(Exception):
+    """Failure of reading the index, git failures raise execute.CommandError.
+    """
+    pass
+
+
+def default_index_path():
+    """Index stored inside of the git directory of the current repository.
+    """
+    return os.path.join(git('rev-parse', '--git-dir').strip(), INDEX_NAME)
+
+
+def range_spec(revision_range):
+    """rev-list arguments of the range same as compared by git diff, from_rev...to_rev
+       starts at their merge base while a single revision stands for rev..HEAD.
+    """
+    if '...' in revision_range:
+        from_rev, to_rev = revision_range.split('...', 1)
+        base = git('merge-base', from_rev or 'HEAD', to_rev or 'HEAD').strip()
+        return ['^' + base, to_rev or 'HEAD']
+    if '..' in revision_range:
+        from_rev, to_rev = revision_range.split('..', 1)
+        return ['^' + (from_rev or 'HEAD'), to_rev or 'HEAD']
+    return ['^' + revision_range, 'HEAD']
+
+
+class ChangeIndex(object):
+    """
+    Changed paths (relative to the repository root) by commit SHA.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_index_path()
+        self.commits = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as stream:
+                data = json.load(stream)
+        except (IOError, OSError) as e:
+            if os.path.exists(self.path):
+                raise ChangeIndexError("Unable to read change index {}: {}".format(self.path, e))
+            return
+        except ValueError:
+            # corrupted index is rebuilt
+            return
+        if data.get('version') == INDEX_VERSION:
+            self.commits = dict((sha, set(paths)) for sha, paths in data['commits'].items())
+
+    def save(self):
+        """Atomically write the index if new commits were added.
+        """
+        if not self.dirty:
+            return
+        content = json.dumps({'version': INDEX_VERSION,
+                              'commits': dict((s, sorted(p)) for s, p in self.commits.items())},
+                             sort_keys=True, separators=(',', ':'))
+        atomic_write(os.path.abspath(self.path), content + '\n')
+        self.dirty = False
+
+    def range_commits(self, revision_range):
+        """Commits of the range with their parents, list of tuples returned.
+        """
+        output = git('rev-list', '--parents', *range_spec(revision_range))
+        return [tuple(line.split()) for line in output.splitlines() if line.strip()]
+
+    def update(self, commits):
+        """Index commits (tuples of SHA and parents) which aren't indexed yet,
+           all of them are diffed by one git diff-tree run.
+        """
+        missing = sorted(set(c for c in commits if c[0] not in self.commits))
+        if not missing:
+            return
+        # first parent diff, root commits are compared to the empty tree
+        lines = ''.join('{}\n'.format(' '.join(c[:2])) for c in missing)
+        output = git('diff-tree', '--stdin', '-r', '-z', '--name-only', '--no-renames',
+                     '--root', '--always', input=lines)
+
+        expected = [c[0] for c in missing]
+        current = None
+        for token in output.split('\0'):
+            if expected and token == expected[0]:
+                current = self.commits[expected.pop(0)] = set()
+            elif token and current is not None:
+                current.add(token)
+        self.dirty = True
+
+    def paths(self, commits):
+        """Union of paths changed by the indexed commits.
+        """
+        changed = set()
+        for commit in commits:
+            changed.update(self.commits[commit[0]])
+        return changed
+
+    def changed(self, revision_range):
+        """Paths changed by commits of the range, the index is updated if needed.
+        """
+        commits = self.range_commits(revision_range)
+        self.update(commits)
+        return self.paths(commits)
+
+
+def repository_prefix():
+    """Path of the current directory relative to the repository root.
+    """
+    return git('rev-parse', '--show-prefix').strip()
+
+
+def query(index, ranges, paths, select=None):
+    """Changed paths for every range and path (relative to the current directory)
+       combination, list of (range, path, changed paths) returned. Changed paths
+       are relative to the current directory and filtered by the select function.
+    """
+    prefix = repository_prefix()
+    commits = [index.range_commits(r) for r in ranges]
+    # commits missing in the index are diffed at once for all the ranges
+    index.update(c for range_commits in commits for c in range_commits)
+
+    results = []
+    for revision_range, range_commits in zip(ranges, commits):
+        changed = index.paths(range_commits)
+        for path in paths:
+            root = os.path.normpath(os.path.join(prefix, path))
+            root = '' if root == '.' else root + '/'
+            matched = sorted(os.path.relpath(p, prefix or '.') for p in changed
+                             if p.startswith(root))
+            if select is not None:
+                matched = [p for p in matched if select(p)]
+            results.append((revision_range, path, matched))
+    return results
@@ -0,0 +1,247 @@
+"""
+Loading of docker-template.yaml configs.
+
+YAML is parsed by the libyaml based loader when it's available. Parsed files
+are memoized and cached on disk keyed by file path, mtime and content hash,
+so a base config shared by many projects is parsed once per run (and not at
+all while it's unchanged). Cache entries unused for a month are pruned and
+the cache is capped by number of entries, nothing is written to it by read
+only (ie. dry-run and check) loads. A config can extend base configs given by
+its `extends` (or `include`, setting both is an error) key, either one path
+or a list of paths relative to the config. Base configs are merged first in
+the given order, the config itself goes last: dicts (ie. env, mapping) are
+updated and lists (ie. datasources, skip-version) are extended. A base
+reached several times is merged once. Relative datasources of a base config
+are rebased to the extending config directory.
+"""
+
+import collections
+import copy
+import logging
+import os
+import pickle
+import time
+
+from citools.util import atomic_write, digest, read_file
+from mergedict import ConfigDict
+
+BASE_KEYS = ('extends', 'include')
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                         'docker-citools', 'config')
+CACHE_MAX_AGE = 30 * 24 * 3600
+CACHE_MAX_ENTRIES = 512
+
+
+class ConfigError(Exception):
+    """Invalid configuration or render options.
+    """
+    pass
+
+
+def yaml_loader(safe=False):
+    """yaml module and its fastest (safe) loader, libyaml based if available.
+    """
+    import yaml
+    if safe:
+        return (yaml, getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    return (yaml, getattr(yaml, 'CLoader', yaml.Loader))
+
+
+def yaml_dump(data):
+    """Dump data as flow style YAML using libyaml based dumper if available.
+    """
+    import yaml
+    return yaml.dump(data, Dumper=getattr(yaml, 'CDumper', yaml.Dumper), default_flow_style=True)
+
+
+def parse(content, path, safe=False):
+    """Parse YAML content of the config file, ConfigError is raised on failure.
+    """
+    yaml, loader = yaml_loader(safe)
+    try:
+        return yaml.load(content, Loader=loader) or {}
+    except yaml.YAMLError as e:
+        raise ConfigError("Unable to parse config file {}!\n{}".format(path, e))
+
+
+def rebase(data, base_dir, target_dir):
+    """Copy of base config data, relative datasources are made relative to the
+       target directory.
+    """
+    data = copy.deepcopy(data)
+    if isinstance(data.get('datasources'), list) and base_dir != target_dir:
+        data['datasources'] = [
+            os.path.relpath(os.path.join(base_dir, p), target_dir)
+            if isinstance(p, basestring) and not os.path.isabs(p) else p
+            for p in data['datasources']]
+    return data
+
+
+def base_configs(data, path):
+    """Paths of base configs given by extends or include key of the config
+       data, ConfigError is raised if they're invalid.
+    """
+    keys = [k for k in BASE_KEYS if data.get(k) is not None]
+    if len(keys) > 1:
+        raise ConfigError("Config {} sets both {}, use one of them".format(
+            path, ' and '.join(keys)))
+    bases = data[keys[0]] if keys else []
+    if isinstance(bases, basestring):
+        bases = [bases]
+    if not isinstance(bases, list) or not all(isinstance(b, basestring) and b for b in bases):
+        raise ConfigError("Config {} {} is expected to be a path or a list of paths, "
+                          "given: {!r}".format(path, keys[0], bases))
+    return bases
+
+
+class ConfigLoader(object):
+    """
+    Load configs merged with their base configs. Files are read from the
+    working tree unless a reader (ie. of a git revision) is given, then
+    nothing is cached on disk. Safe loader constructs plain YAML types only.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, reader=None, safe=False, log=None):
+        self.cache_dir = cache_dir if reader is None else None
+        self.reader = reader or read_file
+        self.safe = safe
+        self.log = log or logging.getLogger(__name__)
+        self.parsed = {}
+        self.bases = {}
+        self.pruned = False
+
+    def cache_key(self, path, content):
+        try:
+            mtime = os.path.getmtime(path) if self.cache_dir else None
+        except OSError:
+            mtime = None
+        return digest('{}\0{}\0{}\0{}'.format(os.path.abspath(path), mtime, self.safe,
+                                             digest(content)))
+
+    def parse_file(self, path, readonly=False):
+        """Parsed document of the file, None if it doesn't exist. Read only
+           parsing doesn't write to the disk cache.
+        """
+        content = self.reader(path)
+        if content is None:
+            return None
+        key = self.cache_key(path, content)
+        if key in self.parsed:
+            return self.parsed[key]
+
+        entry = self.cache_dir and os.path.join(self.cache_dir, key)
+        data = None
+        if entry:
+            try:
+                with open(entry, 'rb') as stream:
+                    data = pickle.load(stream)
+                if not readonly:
+                    # entries age since they were last used
+                    os.utime(entry, None)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError, ValueError,
+                    AttributeError, ImportError):
+                data = None
+        if data is None:
+            data = parse(content, path, self.safe)
+            if entry and not readonly:
+                self.store(entry, data, path)
+
+        if not isinstance(data, dict):
+            raise ConfigError("Config file {} is expected to be a mapping".format(path))
+        self.parsed[key] = data
+        return data
+
+    def store(self, entry, data, path):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            if not self.pruned:
+                self.prune()
+            atomic_write(entry, pickle.dumps(data, 2))
+        except (IOError, OSError, pickle.PicklingError, TypeError) as e:
+            # cache is an optimization only
+            self.log.debug("Unable to cache config %s: %s", path, e)
+
+    def prune(self, max_age=CACHE_MAX_AGE, max_entries=CACHE_MAX_ENTRIES):
+        """Remove cache entries unused for max_age seconds and the least
+           recently used ones above max_entries, done once per loader.
+        """
+        self.pruned = True
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(entry), entry))
+            except OSError:
+                pass
+        entries.sort(reverse=True)
+        expired = time.time() - max_age
+        for index, (mtime, entry) in enumerate(entries):
+            if mtime < expired or index >= max_entries:
+                try:
+                    os.remove(entry)
+                except OSError:
+                    pass
+
+    def resolve(self, path, chain, stack=(), readonly=False):
+        """Add base configs of the file followed by the file itself to the chain
+           (dict of path to parsed document), each of them is added once.
+        """
+        if path in stack:
+            raise ConfigError("Config {} extends itself".format(path))
+        data = self.parse_file(path, readonly)
+        if data is None:
+            if stack:
+                raise ConfigError("Base config {} of {} doesn't exist".format(path, stack[-1]))
+            return
+
+        bases = base_configs(data, path)
+        directory = os.path.dirname(path)
+        self.bases[path] = [os.path.normpath(os.path.join(directory, b)) for b in bases]
+        for base in self.bases[path]:
+            if base not in chain:
+                self.resolve(base, chain, stack + (path,), readonly)
+        chain[path] = data
+
+    def load(self, path, readonly=False):
+        """Config merged with its base configs, None if it doesn't exist.
+           ConfigError is raised if it can't be parsed or a base is missing.
+        """
+        path = os.path.normpath(path)
+        chain = collections.OrderedDict()
+        self.resolve(path, chain, readonly=readonly)
+        if not chain:
+            return None
+        if len(chain) == 1:
+            return copy.deepcopy(chain[path])
+
+        directory = os.path.dirname(path)
+        merged = ConfigDict()
+        for filename, data in chain.items():
+            data = dict((k, v) for k, v in data.items() if k not in BASE_KEYS)
+            merged.merge(rebase(data, os.path.dirname(filename), directory))
+        return dict(merged)
+
+    def loaded(self, path):
+        return os.path.normpath(path) in self.bases
+
+    def files(self, path):
+        """Config file followed by all of its (loaded) base configs.
+        """
+        path = os.path.normpath(path)
+        files = [path]
+        for base in self.bases.get(path, []):
+            files.extend(f for f in self.files(base) if f not in files)
+        return files
+
+
+_loader = None
+
+
+def default_loader():
+    """Loader shared within the process, so base configs are parsed once.
+    """
+    global _loader
+    if _loader is None:
+        _loader = ConfigLoader()
+    return _loader
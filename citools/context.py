@@ -0,0 +1,374 @@
+"""
+Stable digests of Docker build contexts.
+
+A context digest covers the normalized Dockerfile instructions (comments,
+blank lines, line continuations and extra whitespace don't matter) and the
+files referenced by COPY/ADD instructions, honoring .dockerignore. Files are
+identified by their git blob hash and mode, so digests of a git revision and
+of the working tree are comparable and revisions are hashed without reading
+every file.
+"""
+
+import hashlib
+import json
+import os
+import re
+import stat
+
+from citools.execute import git
+from citools.util import atomic_write
+
+DIRECTIVE_RE = re.compile(r'^\s*#\s*([a-zA-Z]+)\s*=\s*(.+?)\s*$')
+GLOB_CHARS = re.compile(r'[*?\[]')
+URL_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+MANIFEST_VERSION = 1
+
+
+class DigestError(Exception):
+    """Failure to read a manifest, git failures raise execute.CommandError.
+    """
+    pass
+
+
+def blob_hash(content):
+    """git blob hash of the content.
+    """
+    return hashlib.sha1('blob {}\0'.format(len(content)) + content).hexdigest()
+
+
+def collapse_whitespace(text):
+    """Collapse runs of whitespace outside of quotes.
+    """
+    result, quote, space = [], None, False
+    for c in text.strip():
+        if quote is None and c.isspace():
+            space = True
+            continue
+        if space:
+            result.append(' ')
+            space = False
+        if c in '"\'':
+            quote = None if quote == c else (c if quote is None else quote)
+        result.append(c)
+    return ''.join(result)
+
+
+def normalize_dockerfile(content):
+    """List of normalized Dockerfile instructions, parser directives go first.
+    """
+    lines = content.splitlines()
+    escape = '\\'
+    instructions = []
+    # parser directives are only recognized at the very top
+    while lines:
+        match = DIRECTIVE_RE.match(lines[0])
+        if not match or match.group(1).lower() not in ('syntax', 'escape'):
+            break
+        name, value = match.group(1).lower(), match.group(2)
+        if name == 'escape':
+            escape = value
+        instructions.append('# {}={}'.format(name, value))
+        lines.pop(0)
+
+    def instruction(parts):
+        keyword, _, rest = collapse_whitespace(' '.join(parts)).partition(' ')
+        return ' '.join(filter(None, [keyword.upper(), rest]))
+
+    current = []
+    for line in lines:
+        stripped = line.strip()
+        # comments and blank lines are allowed within continuations too
+        if not stripped or stripped.startswith('#'):
+            continue
+        if stripped.endswith(escape):
+            current.append(stripped[:-len(escape)])
+            continue
+        instructions.append(instruction(current + [stripped]))
+        current = []
+    if current:
+        instructions.append(instruction(current))
+    return instructions
+
+
+def copy_sources(instructions):
+    """Sources of COPY/ADD instructions relative to the context, sources of
+       other stages or images and remote URLs are skipped.
+    """
+    sources = []
+    for instruction in instructions:
+        keyword, _, rest = instruction.partition(' ')
+        if keyword not in ('COPY', 'ADD'):
+            continue
+        flags = []
+        while rest.startswith('--'):
+            flag, _, rest = rest.partition(' ')
+            flags.append(flag)
+        if any(f.startswith('--from') for f in flags):
+            continue
+        args = rest.split()
+        # exec form, ie. COPY ["src", "dest"]
+        if rest.startswith('['):
+            try:
+                args = json.loads(rest)
+            except ValueError:
+                pass
+        sources.extend(s for s in args[:-1] if not URL_RE.match(s))
+    return sources
+
+
+def glob_regex(pattern):
+    """Compile glob pattern where * and ? don't match / and ** matches any
+       number of directories.
+    """
+    i, regex = 0, []
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            body = pattern[i + 1:end]
+            if body[0] in '!^':
+                body = '^' + body[1:]
+            regex.append('[{}]'.format(body.replace('\\', '\\\\')))
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile('^(?:{})$'.format(''.join(regex)))
+
+
+def clean_path(path):
+    """Normalized context relative path, leading / and ./ are stripped.
+    """
+    path = os.path.normpath(path.strip()).lstrip('/')
+    return '' if path == '.' else path
+
+
+def parents(path):
+    """Path followed by its parent directories.
+    """
+    while path:
+        yield path
+        path = os.path.dirname(path)
+
+
+class DockerIgnore(object):
+    """
+    .dockerignore rules, the last matching pattern wins and ! negates it.
+    Path is excluded if it or any of its parent directories is.
+    """
+
+    def __init__(self, content=''):
+        self.rules = []
+        for line in (content or '').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            pattern = clean_path(line[1:] if negate else line)
+            if pattern:
+                self.rules.append((glob_regex(pattern), negate))
+
+    def excluded(self, path):
+        excluded = False
+        for regex, negate in self.rules:
+            if any(regex.match(p) for p in parents(path)):
+                excluded = not negate
+        return excluded
+
+
+def match_sources(files, sources):
+    """Files (context relative paths) referenced by COPY/ADD sources.
+    """
+    matched = set()
+    for source in sources:
+        source = clean_path(source)
+        if not source:
+            return set(files)
+        if GLOB_CHARS.search(source):
+            regex = glob_regex(source)
+            matched.update(f for f in files if any(regex.match(p) for p in parents(f)))
+        else:
+            matched.update(f for f in files if f == source or f.startswith(source + '/'))
+    return matched
+
+
+class WorkTree(object):
+    """
+    Files of the working tree under the current directory.
+    """
+    name = 'working tree'
+
+    def __init__(self, root='.'):
+        self.root = root
+        self._files = None
+
+    @property
+    def files(self):
+        """Sorted list of files relative to the root, .git is skipped.
+        """
+        if self._files is None:
+            files = []
+            for directory, dirnames, filenames in os.walk(self.root):
+                dirnames[:] = sorted(d for d in dirnames if d != '.git')
+                for name in filenames:
+                    files.append(os.path.relpath(os.path.join(directory, name), self.root))
+            self._files = sorted(files)
+        return self._files
+
+    def read(self, path):
+        """File content, None if it doesn't exist.
+        """
+        try:
+            with open(os.path.join(self.root, path), 'rb') as stream:
+                return stream.read()
+        except (IOError, OSError):
+            return None
+
+    def entry(self, path):
+        """git mode and blob hash of the file.
+        """
+        fullpath = os.path.join(self.root, path)
+        st = os.lstat(fullpath)
+        if stat.S_ISLNK(st.st_mode):
+            return ('120000', blob_hash(os.readlink(fullpath)))
+        mode = '100755' if st.st_mode & stat.S_IXUSR else '100644'
+        return (mode, blob_hash(self.read(path) or ''))
+
+
+class GitTree(object):
+    """
+    Files of a git revision under the current directory.
+    """
+
+    def __init__(self, revision):
+        self.name = revision
+        self.entries = {}
+        for record in git('ls-tree', '-r', '-z', revision, './').split('\0'):
+            if not record:
+                continue
+            info, path = record.split('\t', 1)
+            mode, kind, sha = info.split()
+            if kind == 'blob':
+                self.entries[path] = (mode, sha)
+        self.files = sorted(self.entries)
+        self._contents = {}
+
+    def prefetch(self, paths):
+        """Read content of many files at once.
+        """
+        shas = [self.entries[p][1] for p in paths
+                if p in self.entries and p not in self._contents]
+        if not shas:
+            return
+        output = git('cat-file', '--batch', input='\n'.join(shas) + '\n')
+        blobs, offset = {}, 0
+        while offset < len(output):
+            header_end = output.index('\n', offset)
+            sha, _, size = output[offset:header_end].split()
+            start = header_end + 1
+            blobs[sha] = output[start:start + int(size)]
+            offset = start + int(size) + 1
+        for path in paths:
+            if path in self.entries:
+                self._contents[path] = blobs.get(self.entries[path][1])
+
+    def read(self, path):
+        if path not in self.entries:
+            return None
+        if path not in self._contents:
+            self.prefetch([path])
+        return self._contents[path]
+
+    def entry(self, path):
+        return self.entries[path]
+
+
+def dockerfiles(tree):
+    """Dockerfiles of the tree.
+    """
+    return [f for f in tree.files if os.path.basename(f) == 'Dockerfile']
+
+
+def context_digest(tree, dockerfile, files=None):
+    """Digest of the build context of the Dockerfile, files are the tree files
+       of the context directory (relative to the tree).
+    """
+    context = os.path.dirname(dockerfile)
+    prefix = context + '/' if context else ''
+    if files is None:
+        files = [f for f in tree.files if f.startswith(prefix)]
+    instructions = normalize_dockerfile(tree.read(dockerfile) or '')
+    ignore = DockerIgnore(tree.read(prefix + '.dockerignore'))
+    relative = [f[len(prefix):] for f in files]
+    included = [f for f in relative if not ignore.excluded(f)]
+
+    sha = hashlib.sha256()
+    for instruction in instructions:
+        sha.update(instruction + '\n')
+    for path in sorted(match_sources(included, copy_sources(instructions))):
+        mode, blob = tree.entry(prefix + path)
+        sha.update('{}\0{}\0{}\n'.format(path, mode, blob))
+    return sha.hexdigest()
+
+
+def tree_digests(tree, paths=None):
+    """Context digests of Dockerfiles (all of the tree by default), dict by
+       Dockerfile path returned.
+    """
+    paths = dockerfiles(tree) if paths is None else paths
+    if hasattr(tree, 'prefetch'):
+        tree.prefetch(paths + [os.path.join(os.path.dirname(p), '.dockerignore') for p in paths])
+
+    # files are grouped by the context directory
+    contexts = dict((os.path.dirname(p), []) for p in paths)
+    for path in tree.files:
+        for context in parents(os.path.dirname(path)):
+            if context in contexts:
+                contexts[context].append(path)
+        if '' in contexts:
+            contexts[''].append(path)
+
+    return dict((p, context_digest(tree, p, contexts[os.path.dirname(p)])) for p in paths)
+
+
+def changed_contexts(base, current):
+    """Sorted list of Dockerfiles whose digest differs from the base, new ones
+       are included while removed ones are not.
+    """
+    return sorted(p for p, digest in current.items() if base.get(p) != digest)
+
+
+def load_manifest(path):
+    """Digests recorded in the manifest, missing manifest is treated as empty.
+    """
+    try:
+        with open(path, 'r') as stream:
+            data = json.load(stream)
+    except (IOError, OSError) as e:
+        if os.path.exists(path):
+            raise DigestError("Unable to read manifest {}: {}".format(path, e))
+        return {}
+    except ValueError as e:
+        raise DigestError("Unable to parse manifest {}: {}".format(path, e))
+    if data.get('version') != MANIFEST_VERSION:
+        return {}
+    return data.get('digests', {})
+
+
+def save_manifest(path, digests):
+    """Atomically write digests to the manifest.
+    """
+    content = json.dumps({'version': MANIFEST_VERSION, 'digests': digests},
+                         indent=1, sort_keys=True, separators=(',', ': '))
+    atomic_write(os.path.abspath(path), content + '\n')
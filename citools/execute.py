@@ -0,0 +1,307 @@
+"""
+Subprocess execution shared by docker-citools scripts.
+
+Commands are given as argv lists and run directly. A command string is run by
+bash only if it uses shell features (pipes, redirections, expansions, globs),
+otherwise it's split into argv, so no shell process is paid for. Number of
+concurrently running commands is capped, output can be streamed line by line
+rather than buffered and commands are killed once their timeout expires.
+Wall time and count of spawned processes are recorded for instrumentation.
+"""
+
+import errno
+import multiprocessing
+import os
+import re
+import shlex
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+
+SHELL = '/bin/bash'
+SHELL_CHARS = re.compile(r'[|&;<>()$`*?\[\]~{}\n]')
+
+# Result of a command, output is empty for streamed commands.
+Result = namedtuple('Result', 'command output error returncode success failed duration timedout')
+
+# Per-thread count and wall time of spawned processes.
+_local = threading.local()
+
+
+class CommandError(Exception):
+    """Failure of a command run by run_checked, its Result is kept.
+    """
+
+    def __init__(self, message, result):
+        super(CommandError, self).__init__(message)
+        self.result = result
+
+
+def needs_shell(command):
+    """Check whether command string uses shell features.
+    """
+    return bool(SHELL_CHARS.search(command))
+
+
+def command_argv(command):
+    """argv of the command, strings using shell features are run by bash.
+    """
+    if not isinstance(command, basestring):
+        return list(command)
+    if needs_shell(command):
+        return [SHELL, '-c', command]
+    return shlex.split(command)
+
+
+def command_name(argv):
+    """Name of the program used for instrumentation, bash -c commands are
+       named by their first word.
+    """
+    if argv[:2] == [SHELL, '-c']:
+        return 'bash'
+    return os.path.basename(argv[0]) if argv else ''
+
+
+class Stats(object):
+    """
+    Thread-safe count, wall time and timeouts of commands by program name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def add(self, name, duration, timedout=False):
+        with self.lock:
+            count, total, timeouts = self.commands.get(name, (0, 0.0, 0))
+            self.commands[name] = (count + 1, total + duration, timeouts + int(timedout))
+
+    def snapshot(self):
+        """Dict of program name to its count, total wall time and timeouts.
+        """
+        with self.lock:
+            return dict((name, {'count': c, 'total': t, 'timeouts': o})
+                        for name, (c, t, o) in self.commands.items())
+
+
+stats = Stats()
+
+
+class Limiter(object):
+    """
+    Cap of concurrently running commands of the process (ie. across the
+    threads of a render pool). A thread holds one slot at most, commands it
+    runs while holding it (ie. while iterating a Stream) don't take another
+    one, so they can't deadlock.
+    """
+
+    def __init__(self, limit):
+        self.local = threading.local()
+        self.set(limit)
+
+    def set(self, limit):
+        self.limit = max(1, limit)
+        self.semaphore = threading.BoundedSemaphore(self.limit)
+
+    def __enter__(self):
+        held = getattr(self.local, 'held', None)
+        if held is None:
+            self.semaphore.acquire()
+            self.local.held = (self.semaphore, 1)
+        else:
+            self.local.held = (held[0], held[1] + 1)
+        return self
+
+    def __exit__(self, *exc):
+        semaphore, depth = self.local.held
+        if depth > 1:
+            self.local.held = (semaphore, depth - 1)
+            return
+        self.local.held = None
+        # slot goes back to the semaphore it was taken from (the limit might
+        # have been set meanwhile)
+        semaphore.release()
+
+
+limiter = Limiter(multiprocessing.cpu_count() * 2)
+
+
+def set_limit(limit):
+    """Set the maximum number of concurrently running commands.
+    """
+    limiter.set(limit)
+
+
+def spawn_count():
+    """Number of processes spawned by the current thread.
+    """
+    return getattr(_local, 'count', 0)
+
+
+def spawn_time():
+    """Wall time of processes spawned by the current thread.
+    """
+    return getattr(_local, 'time', 0.0)
+
+
+class Process(object):
+    """
+    Running command, it's killed (with its process group) if it's still
+    running after timeout seconds.
+    """
+
+    def __init__(self, command, cwd=None, env=None, timeout=None, stdin=None,
+                 stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+        self.command = command
+        self.argv = command_argv(command)
+        self.timedout = False
+        self.timer = None
+        self.started = time.time()
+        _local.count = spawn_count() + 1
+        self.proc = subprocess.Popen(self.argv, cwd=cwd, env=env, stdin=stdin,
+                                     stdout=stdout, stderr=stderr, close_fds=True,
+                                     preexec_fn=os.setsid if timeout else None)
+        if timeout:
+            self.timer = threading.Timer(timeout, self.kill, (True,))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self, timedout=False):
+        self.timedout = self.timedout or timedout
+        try:
+            if self.timer is not None:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
+            # already finished
+            pass
+
+    def finish(self):
+        """Wait for the process and record its stats, duration returned.
+        """
+        self.proc.wait()
+        if self.timer is not None:
+            self.timer.cancel()
+        duration = time.time() - self.started
+        _local.time = spawn_time() + duration
+        stats.add(command_name(self.argv), duration, self.timedout)
+        return duration
+
+    def result(self, output, error, duration):
+        code = self.proc.returncode
+        if self.timedout:
+            error = (error or '') + "Command timed out after {:.1f}s\n".format(duration)
+        return Result(self.command, output, error, code, code == 0 and not self.timedout,
+                      code != 0 or self.timedout, duration, self.timedout)
+
+
+def not_found(command, e):
+    """Result of a command which couldn't be started, same as the shell's one.
+    """
+    code = 127 if e.errno == errno.ENOENT else 126
+    message = "{}: {}\n".format(command_argv(command)[0], e.strerror)
+    return Result(command, message, message, code, False, True, 0.0, False)
+
+
+def run(command, cwd=None, env=None, timeout=None, input=None, merge_stderr=True):
+    """Run command buffering its output, Result returned. stderr is merged into
+       the output unless merge_stderr is False (then it's the error).
+    """
+    with limiter:
+        try:
+            process = Process(command, cwd, env, timeout,
+                              stdin=subprocess.PIPE if input is not None else None,
+                              stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE)
+        except OSError as e:
+            return not_found(command, e)
+        try:
+            output, error = process.proc.communicate(input)
+        finally:
+            duration = process.finish()
+    return process.result(output, error or '', duration)
+
+
+def run_checked(command, cwd=None, env=None, timeout=None, input=None):
+    """Run command, its output (stderr is kept apart) returned. CommandError is
+       raised on failure.
+    """
+    result = run(command, cwd, env, timeout, input, merge_stderr=False)
+    if result.failed:
+        argv = command_argv(command)
+        raise CommandError("`{}' failed: {}".format(' '.join(argv), result.error.strip()), result)
+    return result.output
+
+
+def git(*args, **kwargs):
+    """Run git command, its output returned. CommandError is raised on failure.
+    """
+    return run_checked(('git',) + args, cwd=kwargs.get('cwd'), input=kwargs.get('input'))
+
+
+def run_logged(command, path, cwd=None, env=None, timeout=None):
+    """Run command writing its output (stderr included) to the log file as it
+       comes, Result (with empty output) returned.
+    """
+    with limiter:
+        with open(path, 'wb') as logfile:
+            try:
+                process = Process(command, cwd, env, timeout, stdout=logfile,
+                                  stderr=subprocess.STDOUT)
+            except OSError as e:
+                result = not_found(command, e)
+                logfile.write(result.error)
+                return result
+            duration = process.finish()
+            result = process.result('', '', duration)
+            logfile.write(result.error)
+    return result
+
+
+class Stream(object):
+    """
+    Run command yielding its output line by line, nothing is buffered but
+    stderr (kept in a temporary file). Result (with empty output) is
+    available once iteration is over, the command is killed if iteration
+    is stopped early. The command holds a limiter slot while it's iterated,
+    commands run meanwhile by the same thread share it.
+
+        lines = Stream(['git', 'ls-files'])
+        for line in lines:
+            ...
+        lines.result.failed
+    """
+
+    def __init__(self, command, cwd=None, env=None, timeout=None):
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.result = None
+
+    def __iter__(self):
+        with limiter:
+            errfile = tempfile.TemporaryFile()
+            try:
+                try:
+                    process = Process(self.command, self.cwd, self.env, self.timeout,
+                                      stderr=errfile)
+                except OSError as e:
+                    self.result = not_found(self.command, e)
+                    return
+                try:
+                    for line in iter(process.proc.stdout.readline, ''):
+                        yield line
+                finally:
+                    if process.proc.poll() is None:
+                        process.kill()
+                    process.proc.stdout.close()
+                    duration = process.finish()
+                    errfile.seek(0)
+                    self.result = process.result('', errfile.read(), duration)
+            finally:
+                errfile.close()
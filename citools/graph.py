@@ -0,0 +1,149 @@
+"""
+Build dependency graph of generated Dockerfiles.
+
+Dockerfiles reference images of sibling targets in their FROM lines, ie.
+FROM {{ registry }}{{ image }}:{{ version }}-scm. References are resolved back
+to local version/variant targets, so that targets can be scheduled in levels
+where each level depends only on the previous ones.
+"""
+
+import os
+import re
+
+from citools.matrix import dockerfile_path
+
+FROM_RE = re.compile(r'^\s*FROM\s+(.+)$', re.IGNORECASE)
+
+
+def parse_from(content):
+    """List of images referenced by FROM instructions of Dockerfile content.
+    """
+    images = []
+    for line in content.splitlines():
+        match = FROM_RE.match(line)
+        if not match:
+            continue
+        # skip flags such as --platform=..., stage name follows the image
+        words = [w for w in match.group(1).split() if not w.startswith('--')]
+        if words:
+            images.append(words[0])
+    return images
+
+
+def split_image(reference):
+    """Split image reference into repository and tag (latest by default).
+    """
+    reference = reference.split('@', 1)[0]
+    repository, _, tag = reference.rpartition(':')
+    # colon might belong to registry host:port
+    if not repository or '/' in tag:
+        return (reference, 'latest')
+    return (repository, tag)
+
+
+def image_tag(version, variant):
+    """Image tag of the version/variant target.
+    """
+    return '{}-{}'.format(version, variant) if variant else version
+
+
+def registry_namespace(registry):
+    """Registry prefix without its host, ie. quay.io/org/ -> org/.
+    """
+    host, _, rest = registry.partition('/')
+    if rest and ('.' in host or ':' in host or host == 'localhost'):
+        return rest
+    return registry
+
+
+def dockerfile_target(path):
+    """Version/variant target of {{ version }}/{{ variant }}/Dockerfile path.
+    """
+    split = os.path.dirname(os.path.normpath(path)).split('/')
+    return (split[0], split[1] if len(split) > 1 else '')
+
+
+class BuildGraph(object):
+    """
+    Dependency graph of version/variant targets built from FROM references.
+    Local references which don't correspond to any known target are collected
+    as dangling.
+    """
+
+    def __init__(self, targets, image, registry='', known_targets=None, path=None):
+        self.path = path or os.getcwd()
+        self.targets = list(targets)
+        self.image = image
+        self.registry = registry or ''
+        self.dependencies = dict((t, set()) for t in self.targets)
+        self.dangling = []
+
+        known = set(known_targets or ()) | set(self.targets)
+        self.tags = dict((image_tag(*t), t) for t in known)
+        for target in self.targets:
+            self.add_references(target)
+
+    def is_local(self, repository):
+        """Check whether repository refers to the project image, ie. image,
+           registry/namespace/image or namespace/image (registry host omitted).
+        """
+        return repository in (self.image, self.registry + self.image,
+                              registry_namespace(self.registry) + self.image)
+
+    def read_dockerfile(self, target):
+        """Content of the target Dockerfile, empty if it doesn't exist.
+        """
+        try:
+            with open(os.path.join(self.path, dockerfile_path(*target)), 'r') as stream:
+                return stream.read()
+        except (IOError, OSError):
+            return ''
+
+    def add_references(self, target):
+        """Resolve FROM references of the target into dependencies.
+        """
+        for reference in parse_from(self.read_dockerfile(target)):
+            repository, tag = split_image(reference)
+            if not self.is_local(repository):
+                continue
+            dependency = self.tags.get(tag)
+            if dependency is None:
+                self.dangling.append((target, reference))
+            # dependencies on targets outside of the graph are considered satisfied
+            elif dependency in self.dependencies:
+                self.dependencies[target].add(dependency)
+
+    def levels(self, key=None):
+        """Topological plan grouped into levels, tuple of levels and targets
+           which are part of cycles returned. Levels are sorted using key.
+        """
+        remaining = dict((t, set(d)) for t, d in self.dependencies.items())
+        levels = []
+        while remaining:
+            level = [t for t, deps in remaining.items() if not deps]
+            if not level:
+                break
+            level.sort(key=key)
+            levels.append(level)
+            for target in level:
+                del remaining[target]
+            for deps in remaining.values():
+                deps.difference_update(level)
+
+        return (levels, self.cycles(remaining))
+
+    def cycles(self, targets):
+        """List of dependency cycles found among the given targets.
+        """
+        cycles, visited = [], set()
+        for start in sorted(targets):
+            path, node = [], start
+            # follow dependencies until a node repeats, targets left after
+            # topological sort always have a dependency within the rest.
+            while node not in visited and node not in path:
+                path.append(node)
+                node = sorted(d for d in self.dependencies[node] if d in targets)[0]
+            if node in path:
+                cycles.append(path[path.index(node):])
+            visited.update(path)
+        return cycles
@@ -0,0 +1,276 @@
+"""
+Version/variant matrix resolution shared by citools scripts.
+
+Projects follow {{ version }}/{{ variant }}/Dockerfile convention, where
+versions are directories of the project and variants are given by
+Dockerfile.template[-variant] files. Versions of a variant can be restricted
+by mapping and excluded by skip-version patterns, which support bash globing
+and brace expansion.
+"""
+
+import fnmatch
+import glob
+import logging
+import os
+import re
+
+
+def brace_expand(pattern):
+    """Perform bash brace expansion, ie. centos{6,7} expands to centos6, centos7
+       and fedora{22..24} to fedora22, fedora23, fedora24.
+    """
+    depth = 0
+    for i, c in enumerate(pattern):
+        if c == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == '}' and depth:
+            depth -= 1
+            if depth > 0:
+                continue
+            alternatives = _brace_alternatives(pattern[start + 1:i])
+            # braces without comma or range (ie. {a}) are taken literally
+            if alternatives is None:
+                continue
+            suffixes = brace_expand(pattern[i + 1:])
+            return [pattern[:start] + a + suffix
+                    for alternative in alternatives
+                    for a in brace_expand(alternative)
+                    for suffix in suffixes]
+    return [pattern]
+
+
+def _brace_alternatives(body):
+    """Split brace body into alternatives, None is returned if body is not expandable.
+    """
+    parts, depth, last = [], 0, 0
+    for i, c in enumerate(body):
+        if c == '{':
+            depth += 1
+        elif c == '}' and depth:
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(body[last:i])
+            last = i + 1
+    if parts:
+        return parts + [body[last:]]
+
+    # sequence expression {x..y}
+    match = re.match(r'^(-?\d+|[a-zA-Z])\.\.(-?\d+|[a-zA-Z])$', body)
+    if not match:
+        return None
+    first, last = match.groups()
+    if first.lstrip('-').isdigit() and last.lstrip('-').isdigit():
+        first, last = int(first), int(last)
+        step = 1 if first <= last else -1
+        return [str(i) for i in range(first, last + step, step)]
+    elif first.isalpha() and last.isalpha():
+        step = 1 if first <= last else -1
+        return [chr(i) for i in range(ord(first), ord(last) + step, step)]
+    return None
+
+
+class DirMatcher(object):
+    """
+    Bash-compatible glob and brace expansion matcher. The directory is scanned
+    only once and all patterns are matched against the cached listing.
+    """
+    magic = re.compile(r'[*?[]')
+
+    def __init__(self, path=None):
+        self.path = path or os.getcwd()
+        self._listing = None
+
+    @property
+    def listing(self):
+        """Directory entries, in os.listdir order.
+        """
+        if self._listing is None:
+            self._listing = os.listdir(self.path)
+        return self._listing
+
+    def match(self, patterns):
+        """List of directory entries matching any of the given patterns. Entries
+           are listed in directory order.
+        """
+        literals, regexes, nested = set(), [], []
+        for pattern in patterns:
+            for expanded in brace_expand(pattern):
+                if expanded == '~' or expanded.startswith('~/'):
+                    expanded = os.path.expanduser(expanded)
+                if '/' in expanded:
+                    # patterns spanning directories are rare, fallback to glob
+                    # (relative to the directory, same as the listing)
+                    if os.path.isabs(expanded):
+                        nested.extend(sorted(glob.glob(expanded)))
+                    else:
+                        nested.extend(sorted(
+                            os.path.relpath(p, self.path)
+                            for p in glob.glob(os.path.join(self.path, expanded))))
+                elif not self.magic.search(expanded):
+                    literals.add(expanded)
+                else:
+                    regex = fnmatch.translate(expanded)
+                    # bash globs don't match hidden entries unless explicitly asked
+                    if not expanded.startswith('.'):
+                        regex = r'(?!\.)' + regex
+                    regexes.append(regex)
+
+        # all globs are matched in a single pass by one combined regex
+        matcher = re.compile('|'.join('(?:{})'.format(r) for r in regexes)).match \
+            if regexes else (lambda _: False)
+        matched = [e for e in self.listing if e in literals or matcher(e)]
+        return matched + [e for e in nested if e not in matched]
+
+
+class Matrix(object):
+    """
+    Resolved version/variant matrix of a Dockerfiles project.
+    """
+
+    def __init__(self, mapping=None, skip_versions=None, versions=None, variants=None,
+                 path=None, log=None):
+        self.path = path or os.getcwd()
+        self.log = log or logging.getLogger(__name__)
+        self.matcher = DirMatcher(self.path)
+        self.versions = versions or []
+        self.variants = variants or []
+        self.skip_versions = skip_versions or []
+        self.mapping = self.resolve_mapping(mapping or {})
+        self._version_list = None
+        self._variant_list = None
+
+    def resolve_mapping(self, mapping):
+        """Run bash glob for variant: versions
+        """
+        glob_dict = {}
+        for variant, versions in mapping.items():
+            # Change _default variant
+            if variant == '_default':
+                variant = ''
+
+            # save mapping if mapping:variant mapped to null
+            if versions is None:
+                glob_dict[variant] = None
+                continue
+            # no mapping provided
+            elif not versions:
+                continue
+            glob_dict[variant] = set(self.matcher.match(versions))
+
+        self.log.debug("Mapping after bash globing: %s",
+                       dict((k, v and sorted(v)) for k, v in glob_dict.items()))
+        return glob_dict
+
+    @property
+    def version_list(self):
+        """Calculate version list to be updated, based on versions available and
+           versions which should be skipped.
+        """
+        if self._version_list is not None:
+            return self._version_list
+
+        # Favour versions given set via cli, otherwise do directory glob
+        if self.versions:
+            version_directories = self.versions
+            self.log.debug('Version list overrided from CLI!')
+        else:
+            version_directories = [d for d in self.matcher.match(['*'])
+                                   if os.path.isdir(os.path.join(self.path, d))]
+
+        skip_versions = set(self.matcher.match(self.skip_versions))
+
+        self._version_list = [i for i in version_directories if i not in skip_versions]
+        self.log.debug("Target versions: %s", str(self._version_list))
+        return self._version_list
+
+    @property
+    def variant_list(self):
+        """Get list of available variants, based on variants given via cli
+           or glob
+        """
+        if self._variant_list is not None:
+            return self._variant_list
+
+        if self.variants:
+            variant_list = list(self.variants)
+            self.log.debug('Variant list overrided from CLI!')
+        else:
+            variant_list = [f for f in self.matcher.match(['Dockerfile.template*'])
+                            if os.path.isfile(os.path.join(self.path, f))]
+            variant_list = [f.replace('Dockerfile.template', '').strip('-') for f in variant_list]
+
+        # Change _default variant to its actual value (empty string)
+        if '_default' in variant_list:
+            ri = variant_list.index('_default')
+            variant_list[ri] = ''
+
+        self._variant_list = variant_list
+        self.log.debug("Target variants: %s", self._variant_list)
+        return self._variant_list
+
+    def variant_versions(self, variant):
+        """Set of versions the variant is rendered for.
+        """
+        default = object()
+        mapped_versions = self.mapping.get(variant, default)
+        if mapped_versions is default:
+            # mapping:variant doesn't exist, this means that
+            # variant is valid for all versions.
+            return set(self.version_list)
+        return mapped_versions or set()
+
+    def pairs(self):
+        """List of version, variant pairs to be processed.
+        """
+        variant_versions = {}
+        for variant in self.variant_list:
+            if self.mapping.get(variant, ()) is None:
+                self.log.debug("No versions will be processed for `%s'", variant)
+                continue
+
+            variant_versions[variant] = self.variant_versions(variant)
+            self.log.debug("Versions %s will be processed for `%s'",
+                           ', '.join(sorted(variant_versions[variant])), variant or '_default')
+
+        # Dockerfile is updated if it's version is available in mapped versions
+        return [(version, variant)
+                for version in self.version_list
+                for variant in self.variant_list
+                if version in variant_versions.get(variant, ())]
+
+
+class PlannedMatrix(object):
+    """
+    Matrix resolved in advance, ie. targets of a plan written by
+    docker-template.py --plan.
+    """
+
+    def __init__(self, targets):
+        self._pairs = [(t['version'], '' if t['variant'] == '_default' else t['variant'])
+                       for t in targets]
+        self.version_list = _unique(v for v, _ in self._pairs)
+        self.variant_list = _unique(v for _, v in self._pairs)
+
+    def pairs(self):
+        return list(self._pairs)
+
+
+def _unique(items):
+    """Items without duplicates in their original order.
+    """
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
+
+
+def template_path(variant):
+    """Template file name of the variant.
+    """
+    return 'Dockerfile.template' + ('-{}'.format(variant) if variant else '')
+
+
+def dockerfile_path(version, variant):
+    """Relative path of the version/variant Dockerfile.
+    """
+    return os.path.join(version, variant, 'Dockerfile')
@@ -0,0 +1,139 @@
+"""
+Deterministic sharding of version/variant targets across CI nodes.
+
+Targets which depend on each other by FROM references are kept on the same
+shard, so a node can build its slice in level order. Groups of targets are
+balanced by durations recorded in previous runs (ie. timings written by
+docker-template.py --timings-file), falling back to target counts. Every
+node computes the same partition from the same inputs, shard reports of all
+the nodes can be merged to check each target was processed exactly once.
+"""
+
+import json
+import re
+
+from citools.util import atomic_write
+
+SHARD_RE = re.compile(r'^(\d+)/(\d+)$')
+
+
+class ShardError(Exception):
+    """Invalid shard specification, durations or reports.
+    """
+    pass
+
+
+def parse_shard(value):
+    """Parse i/N shard specification (1-based), tuple of index and count returned.
+    """
+    match = SHARD_RE.match(value or '')
+    if match:
+        index, count = int(match.group(1)), int(match.group(2))
+        if 1 <= index <= count:
+            return (index, count)
+    raise ShardError("Shard is expected as i/N where 1 <= i <= N, given: {}".format(value))
+
+
+def load_durations(path):
+    """Target durations in seconds, either from a timings trace (its targets
+       totals) or from a plain mapping of target to seconds.
+    """
+    try:
+        with open(path, 'r') as stream:
+            data = json.load(stream)
+        if 'targets' in data:
+            return dict((t, float(s.get('total', 0))) for t, s in data['targets'].items())
+        return dict((t, float(s)) for t, s in data.items())
+    except (IOError, OSError, ValueError, TypeError, AttributeError) as e:
+        raise ShardError("Unable to load durations {}: {}".format(path, e))
+
+
+def components(targets, dependencies=None):
+    """Groups of targets connected by dependencies, sorted lists returned.
+    """
+    parent = dict((t, t) for t in targets)
+
+    def find(target):
+        while parent[target] != target:
+            parent[target] = parent[parent[target]]
+            target = parent[target]
+        return target
+
+    for target, deps in (dependencies or {}).items():
+        for dep in deps:
+            if target in parent and dep in parent:
+                parent[find(target)] = find(dep)
+
+    groups = {}
+    for target in targets:
+        groups.setdefault(find(target), []).append(target)
+    return sorted(sorted(g) for g in groups.values())
+
+
+def partition(targets, count, durations=None, dependencies=None):
+    """Split targets into count shards, groups of dependent targets are
+       assigned whole, the most expensive first to the least loaded shard.
+       Targets without recorded duration cost the average one.
+    """
+    durations = durations or {}
+    known = [durations[t] for t in targets if t in durations]
+    default = sum(known) / len(known) if known else 1.0
+
+    def cost(group):
+        return sum(durations.get(t, default) for t in group)
+
+    loads = [0.0] * count
+    assigned = {}
+    for group in sorted(components(targets, dependencies), key=lambda g: (-cost(g), g[0])):
+        index = min(range(count), key=lambda i: (loads[i], i))
+        loads[index] += cost(group)
+        assigned.update((t, index) for t in group)
+
+    return [[t for t in targets if assigned[t] == i] for i in range(count)]
+
+
+def shard_targets(targets, shard, durations=None, dependencies=None):
+    """Targets of the (index, count) shard in the given order.
+    """
+    index, count = shard
+    return partition(targets, count, durations, dependencies)[index - 1]
+
+
+def write_report(path, shard, targets, selected):
+    """Write shard report, all the targets and the ones processed by the shard.
+    """
+    content = json.dumps({'shard': list(shard), 'targets': list(targets),
+                          'selected': list(selected)},
+                         indent=1, sort_keys=True, separators=(',', ': '))
+    atomic_write(path, content + '\n')
+
+
+def merge_reports(reports):
+    """Check that shard reports cover every target exactly once, list of
+       problems returned (empty if all is fine).
+    """
+    if not reports:
+        return ["No shard reports given"]
+
+    problems = []
+    count = reports[0]['shard'][1]
+    targets = reports[0]['targets']
+    if any(r['shard'][1] != count or r['targets'] != targets for r in reports[1:]):
+        return ["Shard reports were produced for different shard counts or targets"]
+
+    indexes = [r['shard'][0] for r in reports]
+    for index in range(1, count + 1):
+        if indexes.count(index) != 1:
+            problems.append("Shard {}/{} reported {} times".format(index, count,
+                                                                  indexes.count(index)))
+
+    covered = {}
+    for report in reports:
+        for target in report['selected']:
+            covered[target] = covered.get(target, 0) + 1
+    for target in targets:
+        if covered.get(target, 0) != 1:
+            problems.append("Target {} covered {} times".format(target, covered.get(target, 0)))
+    for target in sorted(set(covered) - set(targets)):
+        problems.append("Target {} is unknown".format(target))
+    return problems
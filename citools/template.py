@@ -0,0 +1,1150 @@
+"""
+Dockerfile rendering core of docker-template.py usable as a library.
+
+A RenderPlan resolves the version/variant matrix of a project directory and
+renders, compares and writes its Dockerfiles, yielding structured results.
+Nothing here depends on the command line or on the current directory, so a
+long-running process can render many projects. Heavy dependencies (jinja2,
+yaml) are imported only when they're needed.
+
+    from citools.template import render_all
+    for result in render_all(None, path='/src/project', dry_run=True):
+        print result.relpath, result.changed
+"""
+
+import contextlib
+import difflib
+import errno
+import functools
+import glob
+import hashlib
+import imp
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+from citools.config import ConfigError, default_loader, yaml_dump
+from citools.execute import run, spawn_count, spawn_time, stats as command_stats
+from citools.graph import BuildGraph, image_tag
+from citools.matrix import Matrix, dockerfile_path, template_path
+from citools.util import atomic_write, digest, read_file
+from collections import namedtuple
+
+DEFAULT_CONFIG = 'docker-template.yaml'
+PLAN_VERSION = 1
+RENDERERS = ('native', 'dj')
+
+# Result of a version/variant Dockerfile update, consumed by the reporting side.
+UpdateResult = namedtuple('UpdateResult',
+                          'version variant relpath changed diff digest error stats')
+
+# Plans used by pool workers (inherited on fork).
+_plans = []
+
+
+class RenderError(Exception):
+    """Dockerfile rendering failure.
+    """
+    pass
+
+
+def _update_task(task):
+    """Pool worker entry point, updates version/variant pair of a plan.
+    """
+    index, version, variant = task
+    return _plans[index].update_dockerfile(version, variant)
+
+
+def process_tasks(plans, tasks, jobs=1, log=None):
+    """Update dockerfiles of (plan index, version, variant) tasks sequentially
+       or using a worker pool shared by the plans, results are yielded in order.
+    """
+    if jobs < 2 or len(tasks) < 2:
+        for index, version, variant in tasks:
+            yield plans[index].update_dockerfile(version, variant)
+        return
+
+    global _plans
+    _plans = plans
+    log = log or logging.getLogger(__name__)
+    # Prepare shared state before workers are started, so that
+    # it's loaded only once and inherited by every worker.
+    used = set(index for index, _, _ in tasks)
+    for index in sorted(used):
+        plans[index].prepare_workers()
+    if all(plans[index].renderer_name == 'dj' for index in used):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+    else:
+        pool = multiprocessing.Pool(jobs)
+
+    log.debug("Processing %d dockerfiles using %d workers", len(tasks), jobs)
+    try:
+        # imap preserves order, so the output is the same as of sequential run.
+        for result in pool.imap(_update_task, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def unified_diff(current, content, relpath):
+    """Unified diff of current and rendered content, missing file is diffed as empty.
+    """
+    fromfile = relpath if current is not None else '/dev/null'
+    lines = difflib.unified_diff((current or '').splitlines(True), content.splitlines(True),
+                                 fromfile, relpath)
+    # Mark missing newline at end of file similar to diff(1)
+    return ''.join(l if l.endswith('\n') else l + '\n\\ No newline at end of file\n'
+                   for l in lines)
+
+
+def load_config(config_path, log=None, readonly=False):
+    """Load yaml config merged with the base configs it extends (see
+       citools.config), missing config is logged and treated as empty.
+       ConfigError is raised if config can't be parsed. Read only loads
+       (ie. dry-run) don't write to the config cache.
+    """
+    log = log or logging.getLogger(__name__)
+    try:
+        config = default_loader().load(config_path, readonly)
+    except (IOError, OSError) as e:
+        log.error("Unable to load config file!")
+        log.error("%s", e)
+        return {}
+    if config is None:
+        # config may not exist, so skip it gracefully.
+        log.error("Unable to load config file!")
+        log.error("[Errno %d] No such file or directory: '%s'", errno.ENOENT, config_path)
+        return {}
+    return config
+
+
+def config_files(config_path):
+    """Config file followed by the base configs it extends.
+    """
+    loader = default_loader()
+    if not loader.loaded(config_path):
+        try:
+            loader.load(config_path, readonly=True)
+        except (ConfigError, IOError, OSError):
+            pass
+    return loader.files(config_path)
+
+
+class Timings(object):
+    """
+    Per-stage and per-target durations and counters of a run.
+    """
+    target_stages = ('render', 'compare', 'diff', 'write')
+
+    def __init__(self):
+        self.stages = {}
+        self.targets = {}
+        self.counters = dict.fromkeys(('spawns', 'bytes rendered', 'files changed',
+                                       'cache hits', 'cache misses'), 0)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure duration of the enclosed block as a stage.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.time() - start)
+
+    def add_stage(self, name, duration):
+        total, count = self.stages.get(name, (0, 0))
+        self.stages[name] = (total + duration, count + 1)
+
+    def add_target(self, relpath, stats):
+        """Record stats of a target, its stage durations and counters are accumulated.
+        """
+        self.targets[relpath] = stats
+        for name in self.target_stages:
+            if name in stats:
+                self.add_stage(name, stats[name])
+        self.counters['spawns'] += stats.get('spawns', 0)
+        self.counters['bytes rendered'] += stats.get('bytes', 0)
+        self.counters['files changed'] += 1 if stats.get('changed') else 0
+
+    def summary(self, slowest=10):
+        """Summary lines, stages and targets sorted by duration.
+        """
+        lines = ['***** timings *****', '{:<20} {:>10} {:>8}'.format('stage', 'total, s', 'count')]
+        for name, (total, count) in sorted(self.stages.items(), key=lambda i: -i[1][0]):
+            lines.append('{:<20} {:>10.3f} {:>8}'.format(name, total, count))
+
+        targets = sorted(self.targets.items(), key=lambda i: -i[1].get('total', 0))[:slowest]
+        if targets:
+            lines.append('slowest targets:')
+            lines.extend('  {:<40} {:>8.3f}'.format(relpath, stats.get('total', 0))
+                         for relpath, stats in targets)
+        commands = command_stats.snapshot()
+        if commands:
+            lines.append('commands:')
+            lines.extend('  {:<20} {:>10.3f} {:>8} {:>4} timed out'.format(
+                name, c['total'], c['count'], c['timeouts']) for name, c in sorted(commands.items()))
+        lines.append(', '.join('{}: {}'.format(k, v) for k, v in sorted(self.counters.items())))
+        return lines
+
+    def dump(self, path):
+        """Write timings as JSON trace.
+        """
+        data = {
+            'stages': dict((k, {'total': t, 'count': c}) for k, (t, c) in self.stages.items()),
+            'targets': self.targets,
+            'counters': self.counters,
+            'commands': command_stats.snapshot()
+        }
+        atomic_write(path, json.dumps(data, indent=1, sort_keys=True,
+                                      separators=(',', ': ')) + '\n')
+
+
+class DatasourceCache(object):
+    """
+    Memoize datasource filters and globals, so that they're evaluated once per
+    run for the same arguments. Results are optionally stored on disk (one file
+    per entry), which shares them between pool workers and later runs. Entries
+    are keyed on the datasource file, its input files and the call arguments.
+    """
+
+    def __init__(self, path=None, ttl=0, inputs=None, root=None, readonly=False):
+        self.path = path
+        self.ttl = ttl
+        self.readonly = readonly
+        self.inputs_digest = self.files_digest(inputs or [], root)
+        self.memory = {}
+
+    @staticmethod
+    def files_digest(patterns, root=None):
+        """Hash of the content of files matching glob patterns relative to root
+           (current directory by default).
+        """
+        root = root or os.getcwd()
+        sha = hashlib.sha256()
+        paths = set(p for pattern in patterns for p in glob.glob(os.path.join(root, pattern)))
+        for path in sorted(paths):
+            content = read_file(path) if os.path.isfile(path) else None
+            sha.update('{}\0{}\0'.format(os.path.relpath(path, root),
+                                          content and digest(content)))
+        return sha.hexdigest()
+
+    def clear(self):
+        """Remove on-disk cache entries.
+        """
+        self.memory = {}
+        if self.path and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def memoize(self, func, name, definition):
+        """Wrap datasource function, definition is the hash of its datasource file.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                key = digest(pickle.dumps((definition, self.inputs_digest, name, args,
+                                           sorted(kwargs.items())), 2))
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # arguments such as jinja context can't be used as a key
+                return func(*args, **kwargs)
+
+            if key not in self.memory:
+                found, value = self.load(key)
+                if not found:
+                    value = func(*args, **kwargs)
+                    self.store(key, value)
+                self.memory[key] = value
+            return self.memory[key]
+
+        return wrapper
+
+    def load(self, key):
+        """Load entry from disk, tuple of found flag and value returned.
+        """
+        if not self.path:
+            return (False, None)
+        entry = os.path.join(self.path, key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(entry) > self.ttl:
+                return (False, None)
+            with open(entry, 'rb') as stream:
+                return (True, pickle.load(stream))
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return (False, None)
+
+    def store(self, key, value):
+        if not self.path or self.readonly:
+            return
+        try:
+            atomic_write(os.path.join(self.path, key), pickle.dumps(value, 2))
+        except (IOError, OSError, pickle.PicklingError, TypeError):
+            # unpicklable results are kept in memory only
+            pass
+
+
+class NativeRenderer(object):
+    """
+    In-process docker-jinja compatible renderer. Datasources are loaded and
+    templates are compiled only once, then reused for every version.
+    """
+
+    def __init__(self, env, datasources=None, cache=None, compiled=None):
+        self.env = env
+        self.datasources = datasources or []
+        self.cache = cache
+        # compiled template code by source and environment hash, might be shared
+        # by renderers
+        self.compiled = {} if compiled is None else compiled
+        self._environment = None
+        self._environment_key = None
+        self._templates = {}
+
+    @staticmethod
+    def datasource_files(datasources):
+        """List of datasource files, docker-jinja contrib is included when available.
+        """
+        files = list(datasources)
+        try:
+            from djinja import contrib
+            modules = [getattr(contrib, c) for c in dir(contrib) if not c.startswith('_')]
+            files.extend([os.path.splitext(m.__file__)[0] + '.py' for m in modules])
+        except ImportError:
+            pass
+        return files
+
+    @property
+    def environment(self):
+        """Jinja environment populated with datasource filters and globals.
+        """
+        if self._environment is not None:
+            return self._environment
+
+        from jinja2 import Environment
+
+        environment = Environment()
+        definitions = []
+        for index, path in enumerate(self.datasource_files(self.datasources)):
+            if not os.path.exists(path):
+                raise IOError("Unable to load datasource file: {}".format(path))
+            # module is unique to the datasource path and loaded afresh, so neither
+            # other projects' datasources nor its previous version leak into it
+            name = 'djinja_datasource_{}'.format(digest(os.path.abspath(path))[:16])
+            sys.modules.pop(name, None)
+            module = imp.load_source(name, path)
+            # only project datasources are cached, contrib ones depend on environment
+            cached = self.cache is not None and index < len(self.datasources)
+            source_digest = digest(read_file(path))
+            definition = cached and source_digest
+            # Follow docker-jinja naming convention for filters and globals.
+            for attr in dir(module):
+                if attr.lower().startswith('_filter_'):
+                    registry, funcname = environment.filters, attr[len('_filter_'):]
+                elif attr.lower().startswith('_global_'):
+                    registry, funcname = environment.globals, attr[len('_global_'):]
+                else:
+                    continue
+                func = getattr(module, attr)
+                if cached:
+                    func = self.cache.memoize(func, attr, definition)
+                registry[funcname] = func
+                definitions.append('{}\0{}\0{}'.format(attr, name, source_digest))
+
+        self._environment_key = digest('\0'.join(sorted(definitions)))
+        self._environment = environment
+        return self._environment
+
+    def template(self, path):
+        """Compiled template, each template file is compiled only once and
+           identical templates rendered with the same filters and globals share
+           the compiled code.
+        """
+        if path not in self._templates:
+            environment = self.environment
+            with open(path, 'r') as stream:
+                source = stream.read()
+            # compiled code is valid for environments with the same filters and globals
+            key = (digest(source), self._environment_key)
+            if key not in self.compiled:
+                self.compiled[key] = environment.compile(source)
+            self._templates[path] = environment.template_class.from_code(
+                environment, self.compiled[key], environment.make_globals(None))
+        return self._templates[path]
+
+    def forget(self, path):
+        """Drop compiled template of the path, so that it's read again.
+        """
+        self._templates.pop(path, None)
+
+    def render(self, template, **context):
+        """Render template with env merged with the given context.
+        """
+        data = dict(self.env)
+        data.update(context)
+        return self.template(template).render(**data)
+
+
+class RenderCache(object):
+    """
+    Content-addressed render cache manifest. Each version/variant/Dockerfile entry
+    holds the hash of the render inputs and the hash of the written target.
+    """
+    format_version = 1
+
+    def __init__(self, path, rebuild=False, log=None):
+        self.path = path
+        self.log = log or logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self.modified = rebuild
+        self.entries = {} if rebuild else self.load()
+
+    def load(self):
+        """Load manifest entries, unreadable manifest is treated as empty.
+        """
+        try:
+            with open(self.path, 'r') as stream:
+                data = json.load(stream)
+            if data.get('version') == self.format_version:
+                return data['entries']
+        except (IOError, OSError, ValueError, KeyError, AttributeError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                self.log.debug("Ignoring unreadable render cache %s: %s", self.path, e)
+        return {}
+
+    def fresh(self, relpath, key, target_digest):
+        """Check whether target is up-to-date with the render inputs.
+        """
+        entry = self.entries.get(relpath)
+        fresh = entry is not None and key is not None and target_digest is not None and \
+            entry == {'key': key, 'target': target_digest}
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.log.debug("Render cache %s: %s", 'hit' if fresh else 'miss', relpath)
+        return fresh
+
+    def update(self, relpath, key, target_digest):
+        """Record render inputs hash and target hash.
+        """
+        entry = {'key': key, 'target': target_digest}
+        if key is not None and self.entries.get(relpath) != entry:
+            self.entries[relpath] = entry
+            self.modified = True
+
+    def save(self):
+        """Atomically write manifest if it was modified.
+        """
+        if not self.modified:
+            return
+        content = json.dumps({'version': self.format_version, 'entries': self.entries},
+                             indent=1, sort_keys=True, separators=(',', ': '))
+        try:
+            atomic_write(self.path, content + '\n')
+        except (IOError, OSError) as e:
+            self.log.error("Unable to write render cache %s!", self.path)
+            self.log.error("%s", e)
+        self.modified = False
+
+
+class RenderPlan(object):
+    """
+    Rendering plan of a Dockerfile project: the version/variant matrix of the
+    project directory along with its configuration and render options.
+    Configuration is the docker-template.yaml data, it's loaded from the
+    project (or from config_path) unless given.
+    """
+
+    def __init__(self, path=None, config=None, versions=None, variants=None, env=None,
+                 skip_versions=None, config_path=None, renderer='native', jobs=1,
+                 cache=True, rebuild_cache=False, ds_cache_ttl=None, ds_cache_clear=False,
+                 dry_run=False, diff=False, shard=None, durations=None, timeout=None,
+                 compiled=None, log=None):
+        self.path = os.path.abspath(path or os.getcwd())
+        self.log = log or logging.getLogger(__name__)
+        self.timings = Timings()
+        if renderer not in RENDERERS:
+            raise ConfigError("Renderer is expected to be either native or dj, "
+                              "given: {}".format(renderer))
+        self.renderer_name = renderer
+        self.jobs = self._convert_jobs(jobs)
+        self.dry_run = dry_run
+        self.diff = diff
+        self.timeout = timeout
+        self.compiled = {} if compiled is None else compiled
+        self.shard = shard
+        self.durations = durations
+        # all the targets and the ones of the shard
+        self.shard_report = None
+        self.keys = {}
+        self.config_file = self.project_path(config_path or DEFAULT_CONFIG)
+        self.options = {'versions': versions, 'variants': variants, 'env': env or {},
+                        'skip_versions': skip_versions or [], 'ds_cache_ttl': ds_cache_ttl}
+
+        if config is None:
+            with self.timings.stage('config'):
+                config = load_config(self.config_file, self.log, self.dry_run)
+        self.configure(config)
+        if ds_cache_clear:
+            self.log.debug("Clearing datasource cache %s", self.datasource_cache.path)
+            self.datasource_cache.clear()
+        with self.timings.stage('mapping'):
+            self.update_matrix()
+
+        self.cache = None
+        if cache:
+            self.cache = RenderCache(self.project_path('.docker-template.cache'),
+                                     rebuild_cache, self.log)
+
+    def configure(self, config):
+        """Apply configuration, renderer state depending on it is reset.
+        """
+        self.config = dict(config)
+        self.env = dict(self.config.get('env') or {})
+        self.env.update(self.options['env'])
+        self.datasources = [self.project_path(p) if isinstance(p, basestring) else p
+                            for p in self.config.get('datasources') or []]
+
+        self._djinja_conffile = None
+        self._renderer = None
+        self._template_digests = {}
+        self.datasource_cache = self._datasource_cache(self.options['ds_cache_ttl'])
+        self.config_digest = self._config_digest()
+
+    def update_matrix(self):
+        """Resolve version/variant matrix of the project directory.
+        """
+        skip = list(self.config.get('skip-version') or []) + list(self.options['skip_versions'])
+        self.matrix = Matrix(self.config.get('mapping'), skip, self.options['versions'],
+                             self.options['variants'], path=self.path, log=self.log)
+
+    def refresh(self, changed):
+        """Refresh plan state after the given project files have changed, list
+           of version/variant pairs affected by the changes returned. Compiled
+           templates and the resolved matrix are kept unless they're affected.
+        """
+        changed = set(os.path.join(self.path, p) for p in changed)
+        previous = set(self.matrix.pairs())
+        affected = set()
+        everything = False
+        # matrix depends on the config and on project directory entries
+        resolve = False
+
+        if changed.intersection(config_files(self.config_file)):
+            resolve = True
+            config = dict(load_config(self.config_file, self.log, self.dry_run))
+            keys = ('env', 'datasources', 'datasource-cache')
+            everything = any(config.get(k) != self.config.get(k) for k in keys)
+            self.configure(config)
+        if changed.intersection(p for p in self.datasources if isinstance(p, basestring)):
+            everything = True
+            self.configure(self.config)
+
+        for path in changed:
+            name = os.path.relpath(path, self.path)
+            if name == 'Dockerfile.template' or name.startswith('Dockerfile.template-'):
+                variant = name[len('Dockerfile.template-'):]
+                # added or removed templates change variants
+                resolve = resolve or not os.path.isfile(path) or \
+                    variant not in self.matrix.variant_list
+                self._template_digests.pop(path, None)
+                if self._renderer is not None:
+                    self._renderer.forget(path)
+                affected.update(p for p in previous if p[1] == variant)
+            elif not os.path.isfile(path) and path not in self.watched_files():
+                # version directory (or any entry) added or removed
+                resolve = True
+
+        # new versions and variants, mapping or skip-version changes
+        if resolve:
+            self.update_matrix()
+        pairs = self.matrix.pairs()
+        if everything:
+            return pairs
+        affected.update(set(pairs) - previous)
+        return [p for p in pairs if p in affected]
+
+    def watched_files(self):
+        """Config (with its bases) and datasource files watched besides project
+           directory entries.
+        """
+        return config_files(self.config_file) + \
+            [p for p in self.datasources if isinstance(p, basestring)]
+
+    def owns(self, path):
+        """Check whether changed path belongs to the project.
+        """
+        return os.path.dirname(path) == self.path or path in self.watched_files()
+
+    def project_path(self, relpath):
+        """Absolute path of the project relative path.
+        """
+        return os.path.join(self.path, relpath)
+
+    @staticmethod
+    def _convert_jobs(jobs):
+        """Convert number of parallel workers, 0 stands for CPU count.
+        """
+        try:
+            jobs = int(jobs)
+            if jobs < 0:
+                raise ValueError(jobs)
+        except ValueError:
+            raise ConfigError("Number of jobs is expected to be a non-negative number, "
+                              "given: {}".format(jobs))
+        return jobs or multiprocessing.cpu_count()
+
+    def _datasource_cache(self, ttl=None):
+        """Datasource cache configured by datasource-cache config and options.
+        """
+        options = self.config.get('datasource-cache') or {}
+        ttl = ttl or options.get('ttl') or 0
+        path = None
+        if 'datasource-cache' in self.config:
+            path = self.project_path(options.get('path', '.docker-template.dscache'))
+        try:
+            ttl = float(ttl)
+        except ValueError:
+            raise ConfigError("Datasource cache ttl is expected to be a number of seconds, "
+                              "given: {}".format(ttl))
+
+        # dry-run doesn't write anything, on-disk entries are only read
+        return DatasourceCache(path, ttl, options.get('inputs'), self.path, self.dry_run)
+
+    def _config_digest(self):
+        """Hash of the configuration which affects rendering.
+        """
+        data = {
+            'env': self.env,
+            'datasources': self.config.get('datasources') or [],
+            'mapping': self.config.get('mapping'),
+            'renderer': self.renderer_name,
+            'datasource_files': {},
+            'datasource_inputs': self.datasource_cache.inputs_digest
+        }
+        for path in self.datasources:
+            content = read_file(path) if isinstance(path, basestring) else None
+            data['datasource_files'][str(os.path.relpath(path, self.path))] = \
+                content and digest(content)
+
+        return digest(json.dumps(data, sort_keys=True, default=str))
+
+    @property
+    def version_list(self):
+        """Target versions, based on versions available and versions which should be skipped.
+        """
+        return self.matrix.version_list
+
+    @property
+    def variant_list(self):
+        """Target variants, based on variants given or glob.
+        """
+        return self.matrix.variant_list
+
+    def pairs(self):
+        """List of version, variant pairs to be processed, only the ones of
+           the shard if sharding is requested.
+        """
+        with self.timings.stage('matrix'):
+            pairs = self.matrix.pairs()
+        if self.shard is None:
+            return pairs
+
+        from citools.shard import shard_targets
+
+        with self.timings.stage('shard'):
+            targets = [dockerfile_path(*p) for p in pairs]
+            selected = shard_targets(targets, self.shard, self.durations,
+                                     self.dependencies(pairs))
+        self.shard_report = (targets, selected)
+        selected = set(selected)
+        return [p for p, t in zip(pairs, targets) if t in selected]
+
+    def dependencies(self, pairs, prefix=''):
+        """FROM dependencies between Dockerfiles of the pairs (generated ones are
+           read), dependencies lists by Dockerfile path prefixed with prefix returned.
+        """
+        graph = BuildGraph(pairs, self.env.get('image', os.path.basename(self.path)),
+                           self.env.get('registry', ''), path=self.path)
+        return dict((os.path.join(prefix, dockerfile_path(*t)),
+                     [os.path.join(prefix, dockerfile_path(*d)) for d in deps])
+                    for t, deps in graph.dependencies.items())
+
+    def execute(self, pairs=None):
+        """Render Dockerfiles of the plan (or the given pairs), update results are
+           yielded in order. Up-to-date targets are skipped according to the render
+           cache, which is saved once the generator is exhausted or closed.
+        """
+        pairs = self.prepare(pairs)
+        try:
+            with self.timings.stage('process'):
+                for result in self.update_dockerfiles(pairs):
+                    self.record(result)
+                    yield result
+        finally:
+            self.finish()
+
+    def prepare(self, pairs=None):
+        """List of version, variant pairs to be rendered, up-to-date ones are
+           skipped according to the render cache.
+        """
+        if pairs is None:
+            pairs = self.pairs()
+        self.keys = {}
+        if self.cache is not None:
+            with self.timings.stage('cache lookup'):
+                pairs, self.keys = self.cache_lookup(pairs)
+        return pairs
+
+    def finish(self):
+        """Save the render cache once results are recorded.
+        """
+        if self.cache is None:
+            return
+        self.log.debug("Render cache: %d hits, %d misses", self.cache.hits, self.cache.misses)
+        self.timings.counters['cache hits'] = self.cache.hits
+        self.timings.counters['cache misses'] = self.cache.misses
+        if not self.dry_run:
+            with self.timings.stage('cache save'):
+                self.cache.save()
+
+    def run(self):
+        """Render Dockerfiles of the plan, list of update results returned.
+        """
+        return list(self.execute())
+
+    def record(self, result):
+        """Account update result in timings and the render cache.
+        """
+        self.timings.add_target(result.relpath, result.stats)
+        # Target matches rendered content unless it's a dry-run change.
+        if self.cache is not None and not result.error and \
+                not (result.changed and self.dry_run):
+            self.cache.update(result.relpath, self.keys.get(result.relpath), result.digest)
+
+    def cache_lookup(self, pairs):
+        """Filter out pairs whose targets are up-to-date according to the render
+           cache. Tuple of remaining pairs and their cache keys returned.
+        """
+        remaining = []
+        keys = {}
+        for version, variant in pairs:
+            relpath = dockerfile_path(version, variant)
+            key = self.cache_key(version, variant)
+            try:
+                current = read_file(self.project_path(relpath))
+            except (IOError, OSError):
+                current = None
+
+            if self.cache.fresh(relpath, key, current and digest(current)):
+                continue
+            remaining.append((version, variant))
+            keys[relpath] = key
+
+        return (remaining, keys)
+
+    def cache_key(self, version, variant):
+        """Hash of the render inputs of the version/variant pair, None is returned
+           if template can not be read.
+        """
+        opts = self.render_options(version, variant)
+        template = opts['template']
+        if template not in self._template_digests:
+            try:
+                content = read_file(template)
+            except (IOError, OSError):
+                content = None
+            self._template_digests[template] = content and digest(content)
+
+        if self._template_digests[template] is None:
+            return None
+        return digest(json.dumps([self.config_digest, self._template_digests[template],
+                                  opts['version'], opts['variant'], opts['image']]))
+
+    def update_dockerfiles(self, pairs):
+        """Update dockerfiles of the given version/variant pairs sequentially
+           or using a worker pool, results are yielded in order.
+        """
+        return process_tasks([self], [(0, version, variant) for version, variant in pairs],
+                             self.jobs, self.log)
+
+    def prepare_workers(self):
+        """Prepare state shared by pool workers before they're started.
+        """
+        if self.renderer_name == 'dj':
+            self.log.debug("Docker djinja config: %s", self.djinja_conffile.name)
+        else:
+            self.warm_renderer()
+
+    @property
+    def djinja_conffile(self):
+        """Generate temporary docker djinja config, RenderError is raised
+           if it can't be written.
+        """
+        if self._djinja_conffile is not None:
+            return self._djinja_conffile
+
+        data = {'datasources': self.config.get('datasources', {})}
+        data.update(self.env)
+        tmpfile = tempfile.NamedTemporaryFile()
+        try:
+            tmpfile.write(yaml_dump(data))
+            tmpfile.seek(0)
+            self.log.debug("Tempfile content written: \n%s", tmpfile.read())
+        except (IOError, OSError) as e:
+            raise RenderError("Unable to write docker djinja config file!\n{}".format(e))
+
+        self._djinja_conffile = tmpfile
+        return self._djinja_conffile
+
+    def update_dockerfile(self, version, variant):
+        """Update dockerfile if rendered content is changed, update result returned.
+        """
+        relpath = dockerfile_path(version, variant)
+        target_path = self.project_path(relpath)
+        stats = {'version': version, 'variant': variant or '_default'}
+        spawns, spawned = spawn_count(), spawn_time()
+        started = lap = time.time()
+
+        def stage(name):
+            # record duration of the stage since the previous one
+            now, stats[name] = time.time(), time.time() - lap
+            stats['total'] = now - started
+            stats['spawns'] = spawn_count() - spawns
+            stats['spawn time'] = spawn_time() - spawned
+            return now
+
+        try:
+            content = self.render_dockerfile(version, variant)
+            lap = stage('render')
+            current = read_file(target_path)
+        except RenderError as e:
+            stage('render')
+            return UpdateResult(version, variant, relpath, False, None, None, str(e), stats)
+        except (IOError, OSError) as e:
+            return UpdateResult(version, variant, relpath, False, None, None,
+                                "Unable to read `{}'!\n{}".format(relpath, e), stats)
+
+        changed = content != current
+        stats['bytes'], stats['changed'] = len(content), changed
+        lap = stage('compare')
+        diff = None
+        # Diff is only computed when it's requested.
+        if changed and self.diff:
+            diff = unified_diff(current, content, relpath)
+            lap = stage('diff')
+
+        if changed and not self.dry_run:
+            self.log.debug("Writing rendered Dockerfile to target path %s", target_path)
+            try:
+                atomic_write(target_path, content)
+            except (IOError, OSError) as e:
+                return UpdateResult(version, variant, relpath, changed, diff, None,
+                                    "Unable to write `{}'!\n{}".format(relpath, e), stats)
+            lap = stage('write')
+
+        return UpdateResult(version, variant, relpath, changed, diff, digest(content), None,
+                            stats)
+
+    @property
+    def renderer(self):
+        """In-process renderer shared by all the version/variant pairs.
+        """
+        if self._renderer is not None:
+            return self._renderer
+
+        self._renderer = NativeRenderer(self.env, self.datasources, self.datasource_cache,
+                                        self.compiled)
+        return self._renderer
+
+    def warm_renderer(self):
+        """Load datasources and compile templates of all target variants.
+        """
+        from jinja2 import TemplateError
+
+        try:
+            for variant in self.variant_list:
+                self.renderer.template(self.render_options('', variant)['template'])
+        except (IOError, OSError, ImportError, TemplateError) as e:
+            # failure is reported for the first pair which uses the template
+            self.log.debug("Unable to compile templates ahead: %s", e)
+
+    def render_dockerfile(self, version, variant):
+        """Render dockerfile using the selected renderer, rendered content
+           is returned. RenderError is raised on failure.
+        """
+        if self.renderer_name == 'dj':
+            djcmd, opts = self.docker_djinja_command(version, variant)
+
+            # Run docker djinja
+            self.log.debug("update command: `%s'", ' '.join(djcmd))
+            result = run(djcmd, cwd=self.path, timeout=self.timeout)
+            try:
+                if result.failed:
+                    # timeout is reported as the error
+                    raise RenderError((result.output + result.error).strip() or
+                                      "dj exited with code {}".format(result.returncode))
+                return read_file(opts['target'])
+            except (IOError, OSError) as e:
+                raise RenderError("Unable to read dj output!\n{}".format(e))
+            finally:
+                if os.path.exists(opts['target']):
+                    os.remove(opts['target'])
+
+        from jinja2 import TemplateError
+
+        opts = self.render_options(version, variant)
+        self.log.debug("rendering `%s' in-process for %s/%s", opts['template'],
+                       version, opts['variant'])
+        try:
+            content = self.renderer.render(opts['template'], version=opts['version'],
+                                           variant=opts['variant'], image=opts['image'])
+        except (IOError, OSError, ImportError, TemplateError) as e:
+            raise RenderError("Unable to render `{}'!\n{}".format(opts['template'], e))
+        return content.encode('utf-8')
+
+    def docker_djinja_command(self, version, variant):
+        """Docker djinja argv and options, tuple returned.
+        """
+        dj = ['dj', '-q', '-c', '{config}', '-d', '{template}', '-o', '{target}',
+              '-e', 'version={version}', '-e', 'variant={variant}', '-e', 'image={image}']
+
+        tmp = tempfile.NamedTemporaryFile(prefix="docker-rendred-{}_{}-".format(version, variant))
+        target_temp = tmp.name
+        tmp.close()
+
+        opts = self.render_options(version, variant)
+        opts['config'] = self.djinja_conffile.name
+        opts['target'] = target_temp
+        return ([arg.format(**opts) for arg in dj], opts)
+
+    def render_options(self, version, variant):
+        """Rendering options of the given version and variant.
+        """
+        return {
+            'template': self.project_path(template_path(variant)),
+            'version': version,
+            'variant': variant or '_default',
+            'image': self.env.get('image', os.path.basename(self.path))
+        }
+
+    def export(self):
+        """Resolved matrix of the project: targets with their templates, render
+           context, image names and output paths (see dump_plan).
+        """
+        image = self.env.get('image', os.path.basename(self.path))
+        targets = []
+        for version, variant in self.pairs():
+            opts = self.render_options(version, variant)
+            targets.append({
+                'version': version,
+                'variant': opts['variant'],
+                'dockerfile': dockerfile_path(version, variant),
+                'template': template_path(variant),
+                'image': self.env.get('registry', '') + image,
+                'tag': image_tag(version, variant),
+                'context': {'version': version, 'variant': opts['variant'], 'image': image}
+            })
+        return {
+            'path': self.path,
+            'key': matrix_key(self.path, self.config_file),
+            'config': os.path.relpath(self.config_file, self.path),
+            'env': self.env,
+            'options': dict((k, self.options[k]) for k in ('versions', 'variants',
+                                                           'skip_versions', 'env')),
+            'targets': targets
+        }
+
+
+class ProjectsPlan(object):
+    """
+    Rendering plans of many projects processed in one go. Pairs of all the
+    projects are rendered by a shared worker pool and identical templates are
+    compiled only once. Options are passed to every project RenderPlan.
+    """
+
+    def __init__(self, paths, versions=None, variants=None, jobs=1, shard=None,
+                 durations=None, log=None, **options):
+        self.log = log or logging.getLogger(__name__)
+        self.jobs = RenderPlan._convert_jobs(jobs)
+        self.compiled = {}
+        self.plans = [RenderPlan(path, None, versions, variants, jobs=1, compiled=self.compiled,
+                                 log=self.log, **options) for path in paths]
+        self.timings = Timings()
+        self.shard = shard
+        self.durations = durations
+        self.shard_report = None
+
+    def pairs(self):
+        """Lists of version, variant pairs to be processed by project plan, the
+           shard is selected among targets of all the projects.
+        """
+        pairs = [plan.pairs() for plan in self.plans]
+        if self.shard is None:
+            return pairs
+
+        from citools.shard import shard_targets
+
+        with self.timings.stage('shard'):
+            targets, dependencies = [], {}
+            for plan, plan_pairs in zip(self.plans, pairs):
+                prefix = os.path.relpath(plan.path)
+                targets.append([os.path.join(prefix, dockerfile_path(*p)) for p in plan_pairs])
+                dependencies.update(plan.dependencies(plan_pairs, prefix))
+            all_targets = [t for plan_targets in targets for t in plan_targets]
+            selected = shard_targets(all_targets, self.shard, self.durations, dependencies)
+        self.shard_report = (all_targets, selected)
+        selected = set(selected)
+        return [[p for p, t in zip(plan_pairs, plan_targets) if t in selected]
+                for plan_pairs, plan_targets in zip(pairs, targets)]
+
+    def execute(self):
+        """Render Dockerfiles of all the projects, tuples of the project plan
+           and its update result are yielded in the project order.
+        """
+        tasks = []
+        for index, (plan, pairs) in enumerate(zip(self.plans, self.pairs())):
+            tasks.extend((index, version, variant) for version, variant in plan.prepare(pairs))
+
+        try:
+            with self.timings.stage('process'):
+                results = process_tasks(self.plans, tasks, self.jobs, self.log)
+                for (index, _, _), result in itertools.izip(tasks, results):
+                    plan = self.plans[index]
+                    plan.record(result)
+                    yield (plan, result)
+        finally:
+            for plan in self.plans:
+                plan.finish()
+
+    def run(self):
+        """Render Dockerfiles of all the projects, dict of update results
+           lists by project path returned.
+        """
+        results = dict((plan.path, []) for plan in self.plans)
+        for plan, result in self.execute():
+            results[plan.path].append(result)
+        return results
+
+    def export(self):
+        """Resolved matrices of all the projects.
+        """
+        return [plan.export() for plan in self.plans]
+
+    def merged_timings(self, root=None):
+        """Timings of all the projects, targets are prefixed with project path
+           relative to root.
+        """
+        timings = Timings()
+        timings.stages = dict(self.timings.stages)
+        for plan in self.plans:
+            prefix = os.path.relpath(plan.path, root or os.getcwd())
+            for name, (total, count) in plan.timings.stages.items():
+                if name not in Timings.target_stages:
+                    current = timings.stages.get(name, (0, 0))
+                    timings.stages[name] = (current[0] + total, current[1] + count)
+            for relpath, stats in plan.timings.targets.items():
+                timings.add_target(os.path.join(prefix, relpath), stats)
+            timings.counters['cache hits'] += plan.timings.counters['cache hits']
+            timings.counters['cache misses'] += plan.timings.counters['cache misses']
+        return timings
+
+
+def discover_projects(root, config_name=DEFAULT_CONFIG):
+    """List of project directories under root having config file, hidden
+       directories and directories of found projects are not searched.
+    """
+    projects = []
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        if os.path.isfile(os.path.join(directory, config_name)):
+            projects.append(os.path.normpath(directory))
+            dirnames[:] = []
+    return projects
+
+
+def matrix_key(path, config_file):
+    """Hash of the config and of the project directory listing (directories and
+       templates), the resolved matrix stays the same as long as the key does
+       (given the same options).
+    """
+    sha = hashlib.sha256()
+    for filename in config_files(config_file):
+        sha.update('{}\0'.format(digest(read_file(filename) or '')))
+    for entry in sorted(os.listdir(path)):
+        if os.path.isdir(os.path.join(path, entry)):
+            sha.update('{}\0d\0'.format(entry))
+        elif entry.startswith('Dockerfile.template'):
+            sha.update('{}\0f\0'.format(entry))
+    return sha.hexdigest()
+
+
+def dump_plan(projects, path):
+    """Write resolved matrices of projects (exported by plans) as JSON, project
+       paths are stored relative to the plan file.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    projects = [dict(p, path=os.path.relpath(p['path'], root)) for p in projects]
+    content = json.dumps({'version': PLAN_VERSION, 'projects': projects}, default=str,
+                         indent=1, sort_keys=True, separators=(',', ': '))
+    atomic_write(os.path.abspath(path), content + '\n')
+
+
+def load_plan(path):
+    """Load resolved matrices of projects written by dump_plan, project paths
+       are made absolute. ConfigError is raised if plan can't be read.
+    """
+    try:
+        with open(path, 'r') as stream:
+            data = json.load(stream)
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError("unsupported plan version {}".format(data.get('version')))
+        root = os.path.dirname(os.path.abspath(path))
+        return [dict(p, path=os.path.normpath(os.path.join(root, p['path'])))
+                for p in data['projects']]
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ConfigError("Unable to load plan {}!\n{}".format(path, e))
+
+
+def project_plan(path, project_path=None, log=None):
+    """Resolved matrix of the project (current directory by default) loaded from
+       the plan file, None is returned if it's stale. ConfigError is raised if
+       the project is not in the plan.
+    """
+    log = log or logging.getLogger(__name__)
+    project_path = os.path.abspath(project_path or os.getcwd())
+    for project in load_plan(path):
+        if project['path'] != project_path:
+            continue
+        if project['key'] != matrix_key(project_path, os.path.join(project_path,
+                                                                   project['config'])):
+            log.warning("Plan of %s is stale, the matrix is resolved again", project_path)
+            return None
+        return project
+    raise ConfigError("Project {} is not in plan {}".format(project_path, path))
+
+
+def render_projects(paths, versions=None, variants=None, **options):
+    """Render Dockerfiles of many projects using a shared worker pool, dict of
+       update results lists by project path returned.
+    """
+    return ProjectsPlan(paths, versions, variants, **options).run()
+
+
+def render_all(config, versions=None, variants=None, path=None, **options):
+    """Render all version/variant Dockerfiles of the project at path (current
+       directory by default), list of update results returned. Config is
+       docker-template.yaml data, None loads it from the project. Other options
+       are passed to RenderPlan.
+    """
+    return RenderPlan(path, config, versions, variants, **options).run()
@@ -0,0 +1,52 @@
+"""
+File helpers shared by docker-citools modules, they don't depend on any of
+the tools (nor on the rendering core).
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+
+
+def read_file(path):
+    """Read file content, None is returned if file doesn't exist.
+    """
+    try:
+        with open(path, 'rb') as stream:
+            return stream.read()
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def atomic_write(path, content, mode=0644):
+    """Write content to a temporary file in the target directory and atomically
+       move it into place, parent directories are created if needed.
+    """
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0777
+
+    fd, tmppath = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(path)), dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(content)
+        os.chmod(tmppath, mode)
+        os.rename(tmppath, path)
+    except (IOError, OSError):
+        os.remove(tmppath)
+        raise
+
+
+def digest(content):
+    """Content hash (ie. of render and config cache entries).
+    """
+    return hashlib.sha256(content).hexdigest()
@@ -0,0 +1,136 @@
+"""
+Change watchers of Dockerfile projects used by docker-template.py --watch.
+
+Entries of project directories (templates, config, version directories) and
+extra files such as datasources are watched. inotify is used when pyinotify
+is available, otherwise watched paths are polled. Hidden entries (ie. render
+cache) and changes inside version directories are ignored, so Dockerfiles
+written by rendering don't trigger further renders.
+"""
+
+import logging
+import os
+import stat
+import time
+
+MISSING = -1
+
+
+def watched_entry(roots, files, path):
+    """Check whether changed path is watched.
+    """
+    if path in files:
+        return True
+    return os.path.dirname(path) in roots and not os.path.basename(path).startswith('.')
+
+
+class PollingWatcher(object):
+    """
+    Detect changes by comparing stat snapshots of watched paths, only
+    presence of directories is compared.
+    """
+
+    def __init__(self, roots, files=None, interval=1.0):
+        self.roots = set(roots)
+        self.files = set(files or [])
+        self.interval = interval
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        paths = set(self.files)
+        for root in self.roots:
+            try:
+                paths.update(os.path.join(root, n) for n in os.listdir(root)
+                             if not n.startswith('.'))
+            except OSError:
+                pass
+
+        state = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            state[path] = None if stat.S_ISDIR(st.st_mode) else (st.st_mtime, st.st_size)
+        return state
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds for changes, set of changed paths returned.
+        """
+        deadline = time.time() + timeout
+        while True:
+            current = self.snapshot()
+            changed = set(p for p in set(current) | set(self.state)
+                          if current.get(p, MISSING) != self.state.get(p, MISSING))
+            self.state = current
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Collect inotify events of watched directories (non-recursively).
+    """
+
+    def __init__(self, roots, files=None):
+        import pyinotify
+
+        self.roots = set(roots)
+        self.files = set(files or [])
+        self.events = set()
+        self.manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE | \
+            pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+        for directory in self.roots | set(os.path.dirname(f) for f in self.files):
+            if os.path.isdir(directory):
+                self.manager.add_watch(directory, mask)
+        self.notifier = pyinotify.Notifier(self.manager, self.collect)
+
+    def collect(self, event):
+        if watched_entry(self.roots, self.files, event.pathname):
+            self.events.add(event.pathname)
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds for changes, set of changed paths returned.
+        """
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed, self.events = self.events, set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+def create_watcher(roots, files=None, interval=1.0, log=None):
+    """inotify watcher of the given directories and files, polling one is
+       returned if pyinotify isn't available.
+    """
+    log = log or logging.getLogger(__name__)
+    try:
+        watcher = InotifyWatcher(roots, files)
+        log.debug("Watching changes using inotify")
+    except ImportError:
+        watcher = PollingWatcher(roots, files, interval)
+        log.debug("pyinotify is not available, polling for changes every %ss", interval)
+    return watcher
+
+
+def wait_changes(watcher, delay=0.3):
+    """Block until changes are detected and no more changes arrive within delay
+       seconds (bursts are debounced), all the changed paths returned.
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.changes(60)
+    while True:
+        more = watcher.changes(delay)
+        if not more:
+            return changed
+        changed.update(more)
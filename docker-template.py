@@ -1,22 +1,30 @@
 #!/usr/bin/env python
 
-import glob
+import contextlib
+import cProfile
 import logging
-import subprocess
-import tempfile
+import pstats
 import os
 import sys
 
-from collections import namedtuple
+from citools.shard import ShardError, load_durations, parse_shard, write_report
+from citools.template import ConfigError, ProjectsPlan, RenderError, RenderPlan, \
+    discover_projects, dump_plan
+from citools.watch import create_watcher, wait_changes
 from docopt import docopt
 from mergedict import ConfigDict
 
 
-import yaml
-
 logger = None
 __docopt__ = """
 Usage: update-template.py [-q] [-d] [-v] [-e env]... [-c template.yaml] [-s version]...
+                          [-r renderer] [-j jobs] [--no-cache | --rebuild-cache]
+                          [--ds-cache-ttl seconds] [--ds-cache-clear] [--timeout seconds]
+                          [--timings] [--timings-file file] [--profile file]
+                          [-p dir]... [--discover dir]...
+                          [-w [--debounce seconds] [--poll-interval seconds]]
+                          [--check | --check-all | --plan file]
+                          [--shard i/N [--durations file] [--shard-report file]]
                           [<version> ...] [--] [<variant> ...]
 
 Options:
@@ -26,6 +34,44 @@ Options:
   -s --skip-version version                     skip generation of Dockerfiles for given versions.
   -d --dry-run                                  show execution trace, but don't take any actions.
   -e --env envhash                              variable in form "key=value" used in the rendering.
+  -r --renderer renderer                        rendering engine, either native (in-process) or dj
+                                                (docker-jinja subprocess) [default: native].
+  -j --jobs jobs                                number of parallel workers, 0 means one per CPU
+                                                [default: 1].
+  --timeout seconds                             kill dj renderer processes running longer than that.
+  --no-cache                                    don't use render cache (.docker-template.cache).
+  --rebuild-cache                               discard render cache entries and rebuild them.
+  --ds-cache-ttl seconds                        override datasource cache entries time to live.
+  --ds-cache-clear                              clear datasource cache before rendering.
+  --timings                                     print per-stage and per-target timings summary.
+  --timings-file file                           write timings as JSON trace to the file.
+  --profile file                                profile dockerfiles processing with cProfile and
+                                                write stats to the file.
+  -p dir --project dir                          render the project directory, can be given many times.
+  --discover dir                                render all projects found under the directory (having
+                                                docker-template.yaml or -c config).
+  -w --watch                                    watch templates, config and version directories and
+                                                re-render affected Dockerfiles on changes.
+  --debounce seconds                            wait for no more changes before rendering
+                                                [default: 0.3].
+  --poll-interval seconds                       polling interval used if inotify is not available
+                                                [default: 1].
+  --check                                       check whether Dockerfiles are up-to-date without
+                                                writing anything, stop at the first stale one.
+  --check-all                                   same as --check, but list all stale Dockerfiles.
+  --plan file                                   write the resolved matrix (targets, templates, render
+                                                context, image names) as JSON without rendering, it's
+                                                consumed by git-updated-dockerfiles.py and quayio/build.py.
+  --shard i/N                                   process only Dockerfiles of the i-th of N shards,
+                                                Dockerfiles depending on each other are kept together.
+  --durations file                              per-Dockerfile durations balancing the shards, either
+                                                timings written by --timings-file or a mapping to seconds.
+  --shard-report file                           write all the Dockerfiles and the ones of the shard,
+                                                reports of all the shards are checked by merge-shards.py.
+
+Details:
+    In check mode stale Dockerfiles are printed to stdout and exit code is 2
+    if any is found (1 stands for failures).
 """
 
 
@@ -46,31 +92,6 @@ def parse_args():
     return args
 
 
-def shell_out(command, shell='/bin/bash'):
-    """
-    Basic shell command execution wrapper, returns command output.
-    """
-    klass_struct = namedtuple('ostruct', 'command output returncode success failed')
-    # open a subprocess merging to stdout and stderr
-    proc = subprocess.Popen(command, shell=True,
-                            executable=shell,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    output, _ = proc.communicate()
-    return klass_struct(command, output, proc.returncode,
-                        proc.returncode == 0, proc.returncode != 0)
-
-
-def dirglob(globstr):
-    """Perform bash glob operation
-    """
-    res = shell_out('ls -1d {}'.format(globstr))
-    if res.success:
-        return filter(None, res.output.split("\n"))
-    else:
-        return []
-
-
 class Log(object):
     """
     Setup basic console logging.
@@ -148,68 +169,83 @@ class CLIOpts(object):
             return logging.INFO
 
 
-class TemplateConfig(object):
+class UpdateDockerfiles(object):
     """
-    Class loads template.yaml config.
+    Command line front-end of the render plan, reports update results.
+    In multi-project mode all the projects are rendered in one go.
     """
-    log = Log.console_logger(CLIOpts.get()['loglevel'])
 
     def __init__(self):
-        self.cli = CLIOpts.get()
-        self._config_path = None
-        self._data = None
-
-    @property
-    def config_path(self):
-        """YAML config file path (default: docker-template.yaml)
-        """
-        if self._config_path is not None:
-            return self._config_path
-
-        config_path = self.cli['config_path'] or 'docker-template.yaml'
-        config_path = os.path.join(os.getcwd(), config_path)
-        self._config_path = os.path.normpath(config_path)
-        return self._config_path
-
-    @property
-    def data(self):
-        """ Data loaded from config.yml file
-        """
-        if self._data is not None:
-            return self._data
-
-        data = {}
+        # Get cli options and conver env=value list to dict
+        self.config = CLIOpts.get()
+        self.log = Log.console_logger(self.config['loglevel'])
+        env = self._convert_envlist(self.config.get('env', []))
+        self.projects = self.project_list()
+        self.check = self.config['check'] or self.config['check-all']
+
+        options = dict(
+            env=env,
+            skip_versions=self.config['skip-version'],
+            config_path=self.config['config_path'],
+            renderer=self.config['renderer'],
+            jobs=self.config['jobs'],
+            cache=not self.config['no-cache'],
+            rebuild_cache=self.config['rebuild-cache'],
+            ds_cache_ttl=self.config['ds-cache-ttl'],
+            ds_cache_clear=self.config['ds-cache-clear'],
+            dry_run=self.config['dry-run'] or self.check,
+            # Diff is only computed when it's going to be logged.
+            diff=not (self.config['quiet'] or self.check) and self.log.isEnabledFor(logging.INFO),
+            log=self.log)
         try:
-            data = yaml.load(open(self.config_path, 'r'))
-        except (IOError, OSError) as e:
-            # config may not exist, so skip it gracefully.
-            self.log.error("Unable to load config file!")
-            self.log.error("%s", e)
-        except yaml.YAMLError as e:
-            self.log.error("Unable to parse config file!")
+            if self.config['timeout']:
+                options['timeout'] = self.convert_timeout(self.config['timeout'])
+            if self.config['shard']:
+                options['shard'] = parse_shard(self.config['shard'])
+                if self.config['durations']:
+                    options['durations'] = load_durations(self.config['durations'])
+            if self.projects is None:
+                self.plan = RenderPlan(os.getcwd(), None, self.config['versions'],
+                                       self.config['variants'], **options)
+            else:
+                self.plan = ProjectsPlan(self.projects, self.config['versions'],
+                                         self.config['variants'], **options)
+        except (ConfigError, ShardError) as e:
             self.log.error("%s", e)
             sys.exit(1)
 
-        self._data = ConfigDict(data)
-        return self._data
-
-
-class UpdateDockerfiles(object):
-    log = Log.console_logger(CLIOpts.get()['loglevel'])
-
-    def __init__(self):
-        # Get cli options and conver env=value list to dict
-        cliopts = CLIOpts().get()
-        cliopts['env'] = self._convert_envlist(cliopts.get('env', []))
-
-        self.config = TemplateConfig().data
-        self._variant_list = None
-        self._version_list = None
-        self._djinja_conffile = None
-
-        # cliopts override template config default values
-        self.config.merge(cliopts)
-        self.update_mapping()
+    @staticmethod
+    def convert_timeout(value):
+        """Positive number of seconds, ConfigError is raised otherwise.
+        """
+        try:
+            timeout = float(value)
+        except ValueError:
+            timeout = 0
+        if timeout <= 0:
+            raise ConfigError("Argument --timeout expects positive number of seconds, "
+                              "given: {}".format(value))
+        return timeout
+
+    def project_list(self):
+        """Project directories given or discovered, None if not in multi-project mode.
+        """
+        if not self.config['project'] and not self.config['discover']:
+            return None
+
+        projects = []
+        config_name = self.config['config_path'] or 'docker-template.yaml'
+        for path in self.config['project'] + [p for root in self.config['discover']
+                                              for p in discover_projects(root, config_name)]:
+            path = os.path.abspath(path)
+            if path not in projects:
+                projects.append(path)
+
+        if not projects:
+            self.log.error("No projects found!")
+            sys.exit(1)
+        self.log.debug("Projects: %s", projects)
+        return projects
 
     def _convert_envlist(self, env_args):
         """Split env=value list into dict env: value
@@ -227,201 +263,204 @@ class UpdateDockerfiles(object):
 
         return envhash
 
-    def update_mapping(self):
-        """Run bash glob for variant: versions
-        """
-        glob_dict = {}
-        mapping = self.config.get('mapping') or {}
-        for variant, versions in mapping.items():
-            # Change _default variant
-            if variant == '_default':
-                variant = ''
-
-            # save mapping if mapping:variant mapped to null
-            if versions is None:
-                glob_dict[variant] = None
-                continue
-            # no mapping provided
-            elif not versions:
-                continue
-            versions = [dirglob(v) for v in versions]
-            # flatten versions list
-            glob_dict[variant] = [i for sublist in versions for i in sublist]
-
-        self.log.debug("Mapping after bash globing: %s", glob_dict)
-        self.config['mapping'] = glob_dict
-
     @property
-    def version_list(self):
-        """Calculate version list to be updated, based on versions available and
-           versions which should be skipped.
-        """
-        if self._version_list is not None:
-            return self._version_list
-
-        # Favour versions given set via cli, otherwise do directory glob
-        if self.config['versions']:
-            version_directories = self.config['versions']
-            self.log.debug('Version list overrided from CLI!')
-        else:
-            version_directories = [d for d in glob.glob('*') if os.path.isdir(d)]
+    def plans(self):
+        return self.plan.plans if self.projects else [self.plan]
 
-        skip_versions = []
-        for skip_globstr in self.config['skip-version']:
-            skip_versions = skip_versions + dirglob(skip_globstr)
-
-        self._version_list = [i for i in version_directories if i not in skip_versions]
-        self.log.debug("Target versions: %s", str(self._version_list))
-        return self._version_list
-
-    @property
-    def variant_list(self):
-        """Get list of available variants, based on variants given via cli
-           or glob
+    def process_dockerfiles(self, fatal=True):
+        """Process dockerfiles accoriding to given configuration.
         """
-        if self._variant_list is not None:
-            return self._variant_list
+        counts = {}
+        try:
+            with contextlib.closing(self.plan.execute()) as results:
+                for item in results:
+                    plan, result = item if self.projects else (self.plan, item)
+                    self.report(result, plan, fatal)
+                    counts.setdefault(plan.path, [0, 0])[0 if result.changed else 1] += 1
+        except RenderError as e:
+            self.log.error("%s", e)
+            if fatal:
+                sys.exit(1)
 
-        if self.config['variants']:
-            variant_list = self.config['variants']
-            self.log.debug('Variant list overrided from CLI!')
-        else:
-            variant_list = [f for f in glob.glob('Dockerfile.template*') if os.path.isfile(f)]
-            variant_list = [f.replace('Dockerfile.template', '').strip('-') for f in variant_list]
+        if self.projects and not self.config['quiet']:
+            for plan in self.plan.plans:
+                changed, unchanged = counts.get(plan.path, [0, 0])
+                self.log.info("***** project %s: %d changed, %d unchanged, %d up-to-date",
+                              os.path.relpath(plan.path), changed, unchanged,
+                              plan.cache.hits if plan.cache else 0)
+
+    def check_dockerfiles(self):
+        """Check whether Dockerfiles are up-to-date, nothing is written. Stale
+           Dockerfiles are printed and rendering stops at the first one unless
+           all of them are requested. Exit code 2 is used if any is stale.
+        """
+        stale = 0
+        try:
+            with contextlib.closing(self.plan.execute()) as results:
+                for item in results:
+                    plan, result = item if self.projects else (self.plan, item)
+                    if result.error:
+                        self.log.error(result.error)
+                        sys.exit(1)
+                    if result.changed:
+                        # !this is printed to stdout!
+                        print self.display_path(plan, result.relpath)
+                        stale += 1
+                        if not self.config['check-all']:
+                            break
+        except RenderError as e:
+            self.log.error("%s", e)
+            sys.exit(1)
 
-        # Change _default variant to its actual value (empty string)
-        if '_default' in variant_list:
-            ri = variant_list.index('_default')
-            variant_list[ri] = ''
+        if stale:
+            sys.exit(2)
 
-        self._variant_list = variant_list
-        self.log.debug("Target variants: %s", self._variant_list)
-        return self._variant_list
+    def watch(self):
+        """Render dockerfiles, then watch for changes and re-render only the affected
+           version/variant pairs until interrupted. Failures are reported only.
+        """
+        try:
+            debounce = float(self.config['debounce'])
+            interval = float(self.config['poll-interval'])
+        except ValueError as e:
+            self.log.error("Arguments --debounce and --poll-interval expect number of "
+                           "seconds: %s", e)
+            sys.exit(1)
 
-    def process_dockerfiles(self):
-        """Process dockerfiles accoriding to given configuration.
+        self.process_dockerfiles(fatal=False)
+        watcher = None
+        try:
+            while True:
+                files = set(f for plan in self.plans for f in plan.watched_files())
+                if watcher is None or watcher.files != files:
+                    if watcher is not None:
+                        watcher.close()
+                    watcher = create_watcher([plan.path for plan in self.plans], files,
+                                             interval, self.log)
+                    if not self.config['quiet']:
+                        self.log.info("Watching for changes, press Ctrl-C to stop...")
+
+                changed = wait_changes(watcher, debounce)
+                self.log.debug("Changed: %s", ', '.join(sorted(changed)))
+                for plan in self.plans:
+                    self.update_changed(plan, [p for p in changed if plan.owns(p)])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def update_changed(self, plan, changed):
+        """Re-render pairs of the plan affected by the changed paths.
         """
-        default = object()
-        for version in self.version_list:
-            for variant in self.variant_list:
-                mapped_versions = self.config['mapping'].get(variant, default)
-
-                if mapped_versions is default:
-                    # mapping:variant doesn't exist, this means that
-                    # variant is valid for all versions.
-                    mapped_versions = self.version_list
-                elif mapped_versions is None:
-                    self.log.debug("No versions will be processed for `%s'", variant)
-                    continue
-
-                self.log.debug("Versions %s will be processed for `%s'",
-                               ', '.join(mapped_versions), variant or '_default')
-
-                # Update dockerfile if it's available in mapped_versions
-                if version in mapped_versions:
-                    self.update_dockerfile(version, variant)
+        if not changed:
+            return
+        try:
+            pairs = plan.refresh(changed)
+            self.log.debug("Re-rendering %d dockerfiles of %s", len(pairs), plan.path)
+            with contextlib.closing(plan.execute(pairs)) as results:
+                for result in results:
+                    self.report(result, plan, fatal=False)
+        except (ConfigError, RenderError) as e:
+            self.log.error("%s", e)
 
     @property
-    def djinja_conffile(self):
-        """Generate temporary docker djinja config
+    def timings(self):
+        """Timings of the run, projects timings are merged in multi-project mode.
         """
-        if self._djinja_conffile is not None:
-            return self._djinja_conffile
+        if self.projects:
+            return self.plan.merged_timings()
+        return self.plan.timings
 
-        tmpfile = tempfile.NamedTemporaryFile()
-        data = ConfigDict({
-            'datasources': self.config.get('datasources', {})
-        })
-        data.merge(self.config['env'])
+    def report_timings(self):
+        """Print timings summary and write JSON trace if requested.
+        """
+        if self.config['timings']:
+            for line in self.timings.summary():
+                self.log.info("%s", line)
+        if self.config['timings-file']:
+            try:
+                self.timings.dump(self.config['timings-file'])
+            except (IOError, OSError) as e:
+                self.log.error("Unable to write timings file!")
+                self.log.error("%s", e)
 
+    def write_plan(self):
+        """Write resolved matrices of the projects to the plan file.
+        """
+        projects = self.plan.export() if self.projects else [self.plan.export()]
         try:
-            tmpfile.write(yaml.dump(dict(data.viewitems()), default_flow_style=True))
-            tmpfile.seek(0)
-            self.log.debug("Tempfile content written: \n%s", tmpfile.read())
+            dump_plan(projects, self.config['plan'])
         except (IOError, OSError) as e:
-            # config may not exist, so skip it gracefully.
-            self.log.error("Unable to write docker djinja config file!")
+            self.log.error("Unable to write plan file!")
             self.log.error("%s", e)
             sys.exit(1)
+        self.log.debug("Plan of %d targets written to %s",
+                       sum(len(p['targets']) for p in projects), self.config['plan'])
+
+    def write_shard_report(self):
+        """Write shard report if requested and the shard was selected.
+        """
+        if not self.config['shard-report'] or self.plan.shard_report is None:
+            return
+        try:
+            write_report(self.config['shard-report'], self.plan.shard, *self.plan.shard_report)
+        except (IOError, OSError) as e:
+            self.log.error("Unable to write shard report!")
+            self.log.error("%s", e)
 
-        self._djinja_conffile = tmpfile
-        return self._djinja_conffile
+    @staticmethod
+    def display_path(plan, relpath):
+        """Path of the project Dockerfile relative to the current directory.
+        """
+        return os.path.relpath(plan.project_path(relpath))
 
-    def update_dockerfile(self, version, variant):
-        """Update dockerfile if rendered content is changed.
+    def report(self, result, plan, fatal=True):
+        """Report update result, failures terminate the execution if fatal.
         """
-        target_path = os.path.join(os.getcwd(), version, variant, 'Dockerfile')
-        djcmd, opts = self.docker_djinja_command(version, variant)
-
-        # Run docker djinja
-        self.log.debug("update command: `%s'", djcmd)
-        result = shell_out(djcmd)
-        if result.failed:
-            self.log.error(result.output)
-            sys.exit(1)
+        if result.error:
+            self.log.error(result.error)
+            if fatal:
+                sys.exit(1)
+            return
 
-        # Compare just rendered temp file and target file.
-        diff_path = None
-        if not os.path.isfile(target_path):
-            tmp = tempfile.NamedTemporaryFile(prefix='Dockerfile-{}_{}'.format(version, variant))
-            diff_path = tmp.name
-            tmp.close()
-            shell_out('touch {}'.format(diff_path))
-
-        # diff exits with 1 if files differ
-        diff = shell_out('diff -u {} {}'.format(diff_path or target_path, opts['target']))
-        if diff_path:
-            shell_out('rm -f {}'.format(diff_path))
-
-        if diff.failed:
-            relpath = os.path.join(version, variant, 'Dockerfile')
+        relpath = self.display_path(plan, result.relpath)
+        if result.changed:
             if self.config['quiet']:
                 # !this is printed to stdout!
                 print relpath
             else:
                 self.log.info('***** content update %s *****', relpath)
-                self.log.info("%s", diff.output)
-
-            if not self.config['dry-run']:
-                self.log.debug("Creating parent directories for `%s' using mkdir -p.", target_path)
-                shell_out('mkdir -p {}'.format(os.path.dirname(target_path)))
-
-                self.log.debug("Moving rendered Dockerfile to target path %s", target_path)
-                shell_out('mv {} {}'.format(opts['target'], target_path))
+                self.log.info("%s", result.diff)
         else:
             self.log.debug("No content to update!")
 
-        # Clean up
-        shell_out('rm -f {}'.format(opts['target']))
 
-    def docker_djinja_command(self, version, variant):
-        """Docker djinja invocation string and options, tuple returned.
-        """
-        cwd = os.getcwd()
-        dj = "dj -q -c {config} -d {template} -o {target} " \
-             "-e version={version} -e variant={variant} -e image={image}"
-
-        tmp = tempfile.NamedTemporaryFile(prefix="docker-rendred-{}_{}-".format(version, variant))
-        target_temp = tmp.name
-        tmp.close()
-
-        # Set template path
-        template = 'Dockerfile.template'
-        if variant:
-            template = template + '-{}'.format(variant)
-        template = os.path.join(cwd, template)
-
-        opts = {
-            'config': self.djinja_conffile.name,
-            'template': template,
-            'target': target_temp,
-            'version': version,
-            'variant': variant or '_default',
-            'image': self.config['env'].get('image', os.path.basename(cwd))
-        }
-        return (dj.format(**opts), opts)
+def profile_call(func, path):
+    """Run func under cProfile and write stats to path.
+    """
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func)
+    finally:
+        profile.dump_stats(path)
+        Log.logger.debug("Profile stats written to %s", path)
+        if Log.logger.isEnabledFor(logging.DEBUG):
+            pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
 
 
 if __name__ == "__main__":
     update = UpdateDockerfiles()
-    update.process_dockerfiles()
+    process = update.check_dockerfiles if update.check else update.process_dockerfiles
+    try:
+        if update.config['plan']:
+            update.write_plan()
+        elif update.config['watch']:
+            update.watch()
+        elif update.config['profile']:
+            profile_call(process, update.config['profile'])
+        else:
+            process()
+    finally:
+        update.report_timings()
+        update.write_shard_report()
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
+import json
 import logging
-import subprocess
+import os
 import sys
 
-from collections import namedtuple
+from citools import changes, context, execute, shard
+from citools.config import ConfigError, ConfigLoader
+from citools.graph import BuildGraph, dockerfile_target
+from citools.matrix import Matrix, PlannedMatrix, dockerfile_path, template_path
+from citools.template import project_plan
 from docopt import docopt
 
 # Logger output goes to console, ie it's not reaching STDOUT
@@ -14,67 +19,387 @@ console.setLevel(logging.INFO)
 log.addHandler(console)
 log.setLevel(logging.INFO)
 
+# Working tree configs are shared by all the loads, so base configs are parsed once.
+config_loader = ConfigLoader(safe=True, log=log)
+
 
 __docopt__ = """
-Usage: get-updated-dockerfiles.py <version-diff> [--] [<variant> ...]
+Usage: get-updated-dockerfiles.py [-i] [-c template.yaml] [--plan file] [-l [--json]]
+                                  [--shard i/N [--durations file] [--shard-report file]]
+                                  <version-diff> [--] [<variant> ...]
+       get-updated-dockerfiles.py -D [-m manifest] [-u] [-c template.yaml] [--plan file]
+                                  [-l [--json]]
+                                  [--shard i/N [--durations file] [--shard-report file]]
+                                  [<version-diff>] [--] [<variant> ...]
+       get-updated-dockerfiles.py -Q [--index file] [--json] (-R range)... [-P path]...
+
+Options:
+  -i --impact                                   list version/variant Dockerfiles affected by changes of
+                                                templates, config and version directories.
+  -c template.yaml --config_path template.yaml  path to yaml config file used by impact analysis
+                                                [default: docker-template.yaml].
+  --plan file                                   resolved matrix written by docker-template.py --plan,
+                                                it's used instead of resolving the config unless stale.
+  -l --levels                                   order Dockerfiles by their FROM dependencies and group
+                                                them into levels which can be built concurrently.
+  --json                                        print levels, cycles and dangling references (or query
+                                                results) as JSON.
+  -D --digest                                   list Dockerfiles whose build context digest differs
+                                                between revisions, or from the manifest if no
+                                                revisions are given.
+  -m manifest --manifest manifest               build context digests manifest
+                                                [default: .docker-contexts.json].
+  -u --update-manifest                          record digests of the current (or to) revision.
+  -Q --query                                    list updated Dockerfiles for every given range and path
+                                                using the index of paths changed by commits.
+  -R range --range range                        revision range of the query (from..to, from...to or
+                                                rev standing for rev..HEAD).
+  -P path --path path                           directory of the query [default: .].
+  --index file                                  change index file (citools-changes.json in the git
+                                                directory by default).
+  --shard i/N                                   list only Dockerfiles of the i-th of N shards, Dockerfiles
+                                                depending on each other are kept on the same shard.
+  --durations file                              per-Dockerfile durations balancing the shards, either
+                                                docker-template.py timings or a mapping to seconds.
+  --shard-report file                           write all the Dockerfiles and the ones of the shard,
+                                                reports of all the shards are checked by merge-shards.py.
 """
 
 
-def shell_out(command, shell='/bin/bash'):
+def updated_dockerfiles(revision_diff, relative=False):
+    """Return list of updated dockerfiles from_rev...to_rev or relative revision offset HEAD~n
     """
-    Basic shell command execution wrapper, returns command output.
+    command = ['git', 'diff', '--name-only'] + (['--relative'] if relative else []) + \
+        [revision_diff, './']
+    # diff of many paths is streamed, only Dockerfiles are kept
+    git_diff = execute.Stream(command)
+    dockerfiles = [p.rstrip('\n') for p in git_diff if p.rstrip('\n').endswith('Dockerfile')]
+    if git_diff.result.failed:
+        log.debug(git_diff.result.error)
+    if not dockerfiles:
+        log.info("No dockerfiles have been updated!")
+        sys.exit(0)
+
+    return dockerfiles
+
+
+def changed_paths(revision_diff):
+    """Return list of paths changed from_rev...to_rev, relative to the current directory
     """
-    klass_struct = namedtuple('ostruct', 'command output returncode success failed')
-    # open a subprocess merging to stdout and stderr
-    proc = subprocess.Popen(command, shell=True,
-                            executable=shell,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
-    output, _ = proc.communicate()
-    return klass_struct(command, output, proc.returncode,
-                        proc.returncode == 0, proc.returncode != 0)
+    try:
+        output = execute.git('diff', '--name-only', '--relative', revision_diff, './')
+    except execute.CommandError as e:
+        log.error("%s", e)
+        sys.exit(1)
 
+    return filter(None, output.split("\n"))
 
-def updated_dockerfiles(revision_diff):
-    """Return list of updated dockerfiles from_rev...to_rev or relative revision offset HEAD~n
+
+def base_revision(revision_diff):
+    """Return the revision changes are compared against, ie. from_rev
     """
-    git_diff = shell_out("git diff --name-only {} ./ | grep 'Dockerfile$'".format(revision_diff))
-    if git_diff.failed:
-        log.info("No dockerfiles have been updated!")
-        sys.exit(0)
+    if '...' in revision_diff:
+        from_rev, to_rev = revision_diff.split('...', 1)
+        try:
+            return execute.git('merge-base', from_rev or 'HEAD', to_rev or 'HEAD').strip()
+        except execute.CommandError as e:
+            log.error("%s", e)
+            sys.exit(1)
+
+    return revision_diff.split('..', 1)[0] or 'HEAD'
+
+
+def config_changed(revision_diff, config_path):
+    """Check whether the config or any of its base configs (which may be outside
+       of the current directory) changed.
+    """
+    files = config_loader.files(config_path)
+    try:
+        execute.git('diff', '--quiet', revision_diff, '--', *files)
+    except execute.CommandError as e:
+        # git diff --quiet exits with 1 when there are changes
+        return e.result.returncode == 1
+    return False
+
+
+def revision_reader(revision):
+    """Reader of files at the given revision, None is returned for missing files.
+    """
+    def read(path):
+        try:
+            return execute.git('show', "{}:./{}".format(revision, path))
+        except execute.CommandError:
+            log.debug("No config %s at %s", path, revision)
+            return None
+    return read
+
+
+def load_config(config_path, revision=None):
+    """Load yaml config (merged with the base configs it extends) from the working
+       tree or from the given revision, missing config is treated as empty.
+    """
+    if revision is None:
+        loader = config_loader
+    else:
+        loader = ConfigLoader(reader=revision_reader(revision), safe=True, log=log)
+
+    try:
+        return loader.load(config_path) or {}
+    except ConfigError as e:
+        log.error("%s", e)
+        sys.exit(1)
+
+
+def config_matrix(config):
+    """Version/variant matrix of the current directory resolved same as by docker-template.py
+    """
+    return Matrix(config.get('mapping'), config.get('skip-version'), log=log)
+
+
+def read_plan(plan_path):
+    """Resolved matrix of the current directory project, None if it's stale.
+    """
+    try:
+        return project_plan(plan_path, log=log)
+    except ConfigError as e:
+        log.error("ERROR: %s", e)
+        sys.exit(1)
+
+
+def project_matrix(config_path, plan=None):
+    """Env and version/variant matrix of the current directory, taken from the
+       plan if given, tuple returned.
+    """
+    if plan is not None:
+        return (plan['env'], PlannedMatrix(plan['targets']))
+    config = load_config(config_path)
+    return (config.get('env') or {}, config_matrix(config))
+
+
+def impacted_dockerfiles(revision_diff, config_path, plan=None):
+    """Return list of version/variant Dockerfiles which should be re-rendered due to
+       changes of templates, config, datasources and version directories.
+    """
+    changed = changed_paths(revision_diff)
+    base = base_revision(revision_diff)
+    config = load_config(config_path)
+    matrix = PlannedMatrix(plan['targets']) if plan else config_matrix(config)
+    pairs = matrix.pairs()
+
+    affected = set()
+    if config_changed(revision_diff, config_path):
+        base_config = load_config(config_path, base)
+        for key in ('env', 'datasources'):
+            if config.get(key) != base_config.get(key):
+                log.debug("Config `%s' changed, all the Dockerfiles are affected", key)
+                affected.update(pairs)
+        if any(config.get(k) != base_config.get(k) for k in ('mapping', 'skip-version')):
+            # mapping and skip-version changes affect newly generated pairs only
+            affected.update(set(pairs) - set(config_matrix(base_config).pairs()))
+
+    try:
+        base_versions = set(execute.git('ls-tree', '--name-only', base, './').split("\n"))
+    except execute.CommandError:
+        base_versions = set()
+    datasources = set(os.path.normpath(p) for p in config.get('datasources') or [])
+    templates = dict((template_path(v), v) for v in matrix.variant_list)
+
+    for path in changed:
+        parts = path.split('/')
+        if path in datasources:
+            log.debug("Datasource %s changed, all the Dockerfiles are affected", path)
+            affected.update(pairs)
+        elif path in templates:
+            affected.update(p for p in pairs if p[1] == templates[path])
+        elif parts[0] in matrix.version_list and len(parts) > 1:
+            version = parts[0]
+            # new version directory, all its variants are affected
+            if version not in base_versions:
+                affected.update(p for p in pairs if p[0] == version)
+            elif len(parts) > 2 and parts[1] in matrix.variant_list:
+                affected.add((version, parts[1]))
+            else:
+                affected.add((version, ''))
 
-    return git_diff.output.strip().split("\n")
+    return [dockerfile_path(*p) for p in pairs if p in affected]
+
+
+def digest_revisions(revision_diff):
+    """Trees compared by the revision diff, from_rev..to_rev compares revisions
+       while from_rev alone compares it against the working tree.
+    """
+    if '..' not in revision_diff:
+        return (context.GitTree(revision_diff), context.WorkTree())
+    base = base_revision(revision_diff)
+    to_rev = revision_diff.split('..', 1)[1].lstrip('.') or 'HEAD'
+    return (context.GitTree(base), context.GitTree(to_rev))
+
+
+def digest_dockerfiles(revision_diff, manifest, update=False):
+    """Return list of Dockerfiles whose build context digest differs between
+       revisions or from the digests recorded in the manifest.
+    """
+    try:
+        if revision_diff:
+            base_tree, tree = digest_revisions(revision_diff)
+            base = context.tree_digests(base_tree)
+        else:
+            base, tree = context.load_manifest(manifest), context.WorkTree()
+        current = context.tree_digests(tree)
+        if update:
+            context.save_manifest(manifest, current)
+    except (context.DigestError, execute.CommandError, IOError, OSError) as e:
+        log.error("Unable to compute build context digests!\n%s", e)
+        sys.exit(1)
+
+    return context.changed_contexts(base, current)
 
 
 def order_files_by_variant(dockerfiles_list, variant_order):
     """Sort Dockerfile list ordered by variant, following convention
        {{ version }}/{{ variant }}/Dockerfile
     """
-    def compare(path_a, path_b):
-        split_a = path_a.replace('/Dockerfile', '').split('/')
-        split_b = path_b.replace('/Dockerfile', '').split('/')
+    dockerfiles_list.sort(key=variant_order_key(variant_order))
+    return dockerfiles_list
+
+
+def variant_order_key(variant_order):
+    """Sort key of version/variant paths ordered by version, then by variant order.
+       Variants missing in the order go last.
+    """
+    rank = dict((variant, i) for i, variant in enumerate(variant_order))
+
+    def key(path):
+        split = path.replace('/Dockerfile', '').split('/')
         # update list with _default variant, i.e. equal to ''
-        for l in (split_a, split_b):
-            if len(l) < 2:
-                l.append('_default')
-
-        # if versions are equal compare by variant
-        versions_compared = cmp(split_a[0], split_b[0])
-        if versions_compared == 0:
-            return cmp(variant_order.index(split_a[1]), variant_order.index(split_b[1]))
-        else:
-            return versions_compared
+        if len(split) < 2:
+            split.append('_default')
+        return (split[0], rank.get(split[1], len(rank)), split[1])
 
-    # sort using our custom order method
-    dockerfiles_list.sort(compare)
-    return dockerfiles_list
+    return key
+
+
+def build_levels(dockerfiles_list, config_path, variant_order=None, plan=None):
+    """Group Dockerfiles into levels following their FROM dependencies, tuple of
+       levels, cycles and dangling references returned.
+    """
+    env, matrix = project_matrix(config_path, plan)
+    image = env.get('image', os.path.basename(os.getcwd()))
+
+    targets = [dockerfile_target(p) for p in dockerfiles_list]
+    graph = BuildGraph(targets, image, env.get('registry', ''),
+                       known_targets=matrix.pairs())
+
+    key = variant_order_key(variant_order or [])
+    levels, cycles = graph.levels(key=lambda t: key(dockerfile_path(*t)))
+    levels = [[dockerfile_path(*t) for t in level] for level in levels]
+    cycles = [[dockerfile_path(*t) for t in cycle] for cycle in cycles]
+    dangling = [(dockerfile_path(*t), ref) for t, ref in graph.dangling]
+    return (levels, cycles, dangling)
+
+
+def shard_dockerfiles(dockerfiles_list, config_path, args, plan=None):
+    """Dockerfiles of the shard requested by --shard, the shard report is written
+       if requested.
+    """
+    try:
+        selected_shard = shard.parse_shard(args['--shard'])
+        durations = shard.load_durations(args['--durations']) if args['--durations'] else None
+    except shard.ShardError as e:
+        log.error("ERROR: %s", e)
+        sys.exit(1)
+
+    env, _ = project_matrix(config_path, plan)
+    targets = [dockerfile_target(p) for p in dockerfiles_list]
+    graph = BuildGraph(targets, env.get('image', os.path.basename(os.getcwd())),
+                       env.get('registry', ''))
+    dependencies = dict((dockerfile_path(*t), [dockerfile_path(*d) for d in deps])
+                        for t, deps in graph.dependencies.items())
+
+    selected = shard.shard_targets(dockerfiles_list, selected_shard, durations, dependencies)
+    if args['--shard-report']:
+        shard.write_report(args['--shard-report'], selected_shard, dockerfiles_list, selected)
+    return selected
+
+
+def query_dockerfiles(ranges, paths, index_path=None, as_json=False):
+    """Print updated Dockerfiles of every range and path combination grouped by
+       query, changed paths of commits are read from (and added to) the index.
+    """
+    try:
+        index = changes.ChangeIndex(index_path)
+        results = changes.query(index, ranges, paths,
+                                select=lambda p: p.endswith('Dockerfile'))
+        index.save()
+    except (changes.ChangeIndexError, execute.CommandError, IOError, OSError) as e:
+        log.error("Unable to query changes!\n%s", e)
+        sys.exit(1)
+
+    if as_json:
+        print json.dumps([{'range': r, 'path': p, 'dockerfiles': d} for r, p, d in results],
+                         indent=2, separators=(',', ': '))
+    else:
+        for revision_range, path, dockerfiles in results:
+            print "# {} {}".format(revision_range, path)
+            for dockerfile in dockerfiles:
+                print dockerfile
+
+
+def print_levels(levels, cycles, dangling, as_json=False):
+    """Print build levels one per line (space separated) or as JSON, exit
+       with non-zero code if there are dependency cycles.
+    """
+    for path, reference in dangling:
+        log.warning("WARNING: %s refers to unknown local image %s", path, reference)
+    for cycle in cycles:
+        log.error("ERROR: dependency cycle %s", ' -> '.join(cycle + cycle[:1]))
+
+    if as_json:
+        print json.dumps({
+            'levels': levels,
+            'cycles': cycles,
+            'dangling': [{'dockerfile': p, 'from': r} for p, r in dangling]
+        }, indent=2, separators=(',', ': '))
+    else:
+        for level in levels:
+            print ' '.join(level)
+
+    if cycles:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     args = docopt(__docopt__)
-    updated_files = updated_dockerfiles(args['<version-diff>'])
+    # optional revisions are followed by optional --
+    if args['<version-diff>'] == '--':
+        args['<version-diff>'] = None
+    if args['--query']:
+        query_dockerfiles(args['--range'], args['--path'], args['--index'], args['--json'])
+        sys.exit(0)
+    plan = read_plan(args['--plan']) if args['--plan'] else None
+    if args['--digest']:
+        updated_files = digest_dockerfiles(args['<version-diff>'], args['--manifest'],
+                                           args['--update-manifest'])
+        if not updated_files:
+            log.info("No build contexts have changed!")
+            sys.exit(0)
+    elif args['--impact']:
+        updated_files = impacted_dockerfiles(args['<version-diff>'], args['--config_path'],
+                                             plan)
+        if not updated_files:
+            log.info("No dockerfiles are affected!")
+            sys.exit(0)
+    else:
+        updated_files = updated_dockerfiles(args['<version-diff>'],
+                                            relative=args['--levels'] or args['--shard'])
+
+    if args['--shard']:
+        updated_files = shard_dockerfiles(updated_files, args['--config_path'], args, plan)
 
-    if not args['<variant>']:
+    if args['--levels']:
+        print_levels(*build_levels(updated_files, args['--config_path'], args['<variant>'],
+                                   plan), as_json=args['--json'])
+    elif not args['<variant>']:
         if updated_files:
             print "\n".join(updated_files)
     else:
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import sys
+
+from citools.shard import merge_reports
+from docopt import docopt
+
+# Logger output goes to console, ie it's not reaching STDOUT
+log = logging.getLogger(__name__)
+console = logging.StreamHandler()
+console.setLevel(logging.INFO)
+log.addHandler(console)
+log.setLevel(logging.INFO)
+
+
+__docopt__ = """
+Usage: merge-shards.py [--json] <report>...
+
+Options:
+  --json                                        print all the targets processed by the shards as JSON.
+
+Details:
+    Shard reports written by --shard-report of docker-template.py or
+    git-updated-dockerfiles.py are checked to cover every target exactly
+    once, exit code is 1 if they don't.
+"""
+
+
+def load_reports(paths):
+    """Load shard reports, exit with non-zero code if any can't be read.
+    """
+    reports = []
+    for path in paths:
+        try:
+            with open(path, 'r') as stream:
+                reports.append(json.load(stream))
+        except (IOError, OSError, ValueError) as e:
+            log.error("ERROR: Unable to load shard report %s: %s", path, e)
+            sys.exit(1)
+    return reports
+
+
+if __name__ == "__main__":
+    args = docopt(__docopt__)
+    reports = load_reports(args['<report>'])
+    problems = merge_reports(reports)
+    for problem in problems:
+        log.error("ERROR: %s", problem)
+    if problems:
+        sys.exit(1)
+
+    selected = sorted(t for r in reports for t in r['selected'])
+    if args['--json']:
+        print json.dumps({'targets': selected}, indent=2, separators=(',', ': '))
+    else:
+        log.info("All %d targets covered by %d shards", len(selected), len(reports))
@@ -1,59 +1,231 @@
 #!/usr/bin/env python
 
-import subprocess
+import csv
+import errno
+import hashlib
+import heapq
+import httplib
 import os
+import random
+import select
+import socket
+import stat
 import sys
 import json
+import tarfile
+import threading
+import time
+import urlparse
 
 from collections import namedtuple
 from docopt import docopt
 from jinja2 import Template
+from multiprocessing.pool import ThreadPool
 
 
 logger = None
 __docopt__ = """
-Usage: quay/build.py -r repo -d url -t tag -p robot
+Usage: quay/build.py -r repo (-d url | -C dir) -t tag -p robot [-a url]
+       quay/build.py -b file [-f format] [-c concurrency] [--rate rate] [-a url]
+                     [-w [--interval secs] [--deadline secs]]
+       quay/build.py -w [-c concurrency] [--interval secs] [--deadline secs] [-a url] <build>...
+       quay/build.py -P file -p robot [-c concurrency] [--rate rate] [-a url]
+                     [-w [--interval secs] [--deadline secs]] [<dockerfile>...]
 
 Options:
   -r repo --repository repo             repository in form org/reponame
   -d url --dockerfile url               url path to a dockerfile
+  -C dir --context dir                  local build context directory, it's streamed to quay.io
+                                        as a gzip tarball
   -t tag --tag tag                      tag which is used during build
   -p robot --pull-robot robot           pull robot which is used
+  -b file --batch file                  trigger builds for records read from file, - stands for stdin
+  -P file --plan file                   trigger builds of targets of the plan written by
+                                        docker-template.py --plan (all of them or the given
+                                        Dockerfiles, - reads them from stdin)
+  -f format --format format             batch records format, either ndjson or csv [default: ndjson]
+  -c concurrency --concurrency concurrency
+                                        number of concurrent build requests [default: 4]
+  --rate rate                           maximum number of build requests per second, 0 means
+                                        unlimited [default: 0]
+  -a url --api-url url                  quay.io API base URL (QUAYIO_APIURL environment variable
+                                        overrides the default https://quay.io/api/v1)
+  -w --wait                             wait for builds given as org/repo/build-id (- reads them
+                                        from stdin) or triggered in batch mode to finish
+  --interval secs                       initial polling interval, it grows exponentially up to
+                                        a minute [default: 5]
+  --deadline secs                       overall time to wait for builds [default: 3600]
 
 Details:
     QUAY_ACCESSTOKEN environment variable is required to trigger a build!
+
+    Batch records have repository, tag, pull_robot and either dockerfile or context
+    fields, given either as JSON objects (one per line) or as CSV with a header row.
+
+    Plan targets are built from their directories as contexts, repository is the
+    target image name without the registry host (ie. quay.io/org/repo -> org/repo).
+
+    While waiting exit code is 0 if all builds completed, 1 if any build failed
+    (builds which are not found or can't be polled count as failed) and 2 if
+    deadline has been reached without failures.
 """
 
+DEFAULT_APIURL = 'https://quay.io/api/v1'
+BATCH_FIELDS = ('repository', 'tag', 'pull_robot')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+FAILED_PHASES = ('error', 'internalerror', 'cancelled', 'expired')
+# Phases of builds which are deleted (HTTP 404) or can't be polled, treated as failed.
+POLL_FAILED_PHASES = ('notfound', 'pollerror')
+MAX_POLL_INTERVAL = 60
+MAX_POLL_ERRORS = 5
+# Methods which are safe to resend if a kept-alive connection gets closed.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
 
-def shell_out(command, stdin_data=None, shell='/bin/bash'):
-    """
-    Basic shell command execution wrapper, returns command output.
-    """
-    klass_struct = namedtuple('ostruct', 'command output returncode success failed')
-    # open a subprocess merging to stdout and stderr
-    stdin = None if stdin_data is None else subprocess.PIPE
+# Result of a single build request.
+BuildResult = namedtuple('BuildResult', 'record status data error')
 
-    proc = subprocess.Popen(command, shell=True,
-                            executable=shell,
-                            stdin=stdin,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT)
 
-    if stdin_data is not None:
-        proc.stdin.write(stdin_data)
+_payload_template = None
 
-    output, _ = proc.communicate()
-    return klass_struct(command, output, proc.returncode,
-                        proc.returncode == 0, proc.returncode != 0)
 
+def payload_template():
+    """Build payload template, it's read and compiled only once.
+    """
+    global _payload_template
+    if _payload_template is not None:
+        return _payload_template
 
-def get_payload(**context):
     basedir = os.path.dirname(__file__)
     payload_filepath = os.path.join(os.path.realpath(basedir), '.build-payload')
 
     with open(payload_filepath, 'r') as stream:
-        template = Template(stream.read(), keep_trailing_newline=True)
-    return template.render(**context)
+        _payload_template = Template(stream.read(), keep_trailing_newline=True)
+    return _payload_template
+
+
+def get_payload(**context):
+    return payload_template().render(**context)
+
+
+def api_url(url=None):
+    """quay.io API base URL, given explicitly or via QUAYIO_APIURL.
+    """
+    return (url or os.environ.get('QUAYIO_APIURL') or DEFAULT_APIURL).rstrip('/')
+
+
+def access_token():
+    """quay.io access token from the environment.
+    """
+    token = os.environ.get('QUAYIO_ACCESSTOKEN')
+    if not token:
+        raise RuntimeError("QUAYIO_ACCESSTOKEN environment variable is required")
+    return token
+
+
+class QuayClient(object):
+    """
+    quay.io API client keeping one keep-alive connection per thread, so that
+    a pool of threads reuses its connections (and TLS sessions) across requests.
+    """
+
+    def __init__(self, base_url, token, timeout=60):
+        url = urlparse.urlparse(base_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connection(self, fresh=False):
+        """Connection bound to the current thread, a kept-alive connection
+           which has been closed by the server meanwhile is replaced.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and not fresh and not self.dropped(conn):
+            return conn
+        if conn is not None:
+            conn.close()
+
+        klass = httplib.HTTPSConnection if self.scheme == 'https' else httplib.HTTPConnection
+        self._local.conn = klass(self.netloc, timeout=self.timeout)
+        return self._local.conn
+
+    @staticmethod
+    def dropped(conn):
+        """Check whether idle connection has been closed by the server, ie.
+           its socket is readable (at EOF) before anything was sent.
+        """
+        if conn.sock is None:
+            return False
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def request(self, method, path, body=None):
+        """Perform API request, tuple of HTTP status and response body returned.
+           A request on a kept-alive connection is retried once on a fresh one
+           only if it can't have been processed: sending it failed or, for
+           idempotent methods, the connection was closed without any response.
+        """
+        headers = {
+            'Authorization': 'Bearer {}'.format(self.token),
+            'Content-Type': 'application/json'
+        }
+        for attempt in (0, 1):
+            conn = self.connection(fresh=attempt > 0)
+            # connection is reused if its socket is already open
+            retry = attempt == 0 and conn.sock is not None
+            try:
+                try:
+                    conn.request(method, self.prefix + path, body, headers)
+                except (httplib.HTTPException, socket.error):
+                    if retry:
+                        continue
+                    raise
+                try:
+                    response = conn.getresponse()
+                except (httplib.BadStatusLine, socket.error) as e:
+                    # closed without a status line or reset, the request might
+                    # have been processed though
+                    closed = isinstance(e, httplib.BadStatusLine) or \
+                        e.errno in (errno.ECONNRESET, errno.EPIPE)
+                    if retry and closed and method in IDEMPOTENT_METHODS:
+                        continue
+                    raise
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                raise
+            return (response.status, data)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RateLimiter(object):
+    """
+    Thread-safe limiter spacing calls to at most rate per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
 
 def print_build_result(json_string):
@@ -69,34 +241,495 @@ def print_build_result(json_string):
     print json.dumps(bdict, indent=2)
 
 
-def trigger_build(repository, payload_data):
+def request_build(client, repository, payload_data):
+    """Request quay.io repository build, BuildResult returned.
+    """
+    record = {'repository': repository}
+    path = "/repository/{}/build/".format(repository.strip('/'))
+    try:
+        status, data = client.request('POST', path, payload_data)
+    except (httplib.HTTPException, socket.error) as e:
+        return BuildResult(record, None, None, str(e) or e.__class__.__name__)
+
+    if status >= 300:
+        return BuildResult(record, status, data, "HTTP {}: {}".format(status, data.strip()))
+    return BuildResult(record, status, data, None)
+
+
+def trigger_build(repository, record, url=None):
     """Trigger quay.io repository build
     """
-    access_token = os.environ.get('QUAYIO_ACCESSTOKEN')
-    quayio_apiurl = 'https://quay.io/api/v1/repository'
+    client = QuayClient(api_url(url), access_token())
+    try:
+        result = request_build(client, repository, build_payload(record, ContextUploader(client)))
+    except (IOError, OSError, ValueError) as e:
+        result = BuildResult(record, None, None, str(e))
+    client.close()
 
-    if not access_token:
-        raise RuntimeError("QUAYIO_ACCESSTOKEN environment variable is required")
+    if result.error:
+        print result.error
+        sys.exit(1)
+
+    print_build_result(result.data)
+
+
+def read_records(stream, fmt='ndjson'):
+    """Read batch records from a stream, list of dicts returned.
+    """
+    if fmt == 'csv':
+        records = [dict((k.strip(), (v or '').strip()) for k, v in row.items() if k)
+                   for row in csv.DictReader(stream)]
+    elif fmt == 'ndjson':
+        records = [json.loads(line) for line in stream if line.strip()]
+    else:
+        raise ValueError("unknown batch format {}, expected ndjson or csv".format(fmt))
+
+    for number, record in enumerate(records, 1):
+        missing = [f for f in BATCH_FIELDS if not record.get(f)]
+        if not record.get('dockerfile') and not record.get('context'):
+            missing.append('dockerfile or context')
+        if missing:
+            raise ValueError("record {} misses {}".format(number, ', '.join(missing)))
+    return records
+
+
+def image_repository(image):
+    """quay.io repository (org/repo) of the image name, None if it has no org.
+    """
+    parts = image.split('/')
+    if len(parts) > 1 and ('.' in parts[0] or ':' in parts[0]):
+        parts = parts[1:]
+    return '/'.join(parts) if len(parts) == 2 else None
+
+
+def plan_records(path, pull_robot, dockerfiles=None):
+    """Batch records of the plan targets, only the given Dockerfiles (paths
+       relative to the current directory) unless None. ValueError is raised if
+       the plan is invalid or a Dockerfile is not in the plan.
+    """
+    with open(path, 'r') as stream:
+        plan = json.load(stream)
+    if plan.get('version') != 1:
+        raise ValueError("unsupported plan version {}".format(plan.get('version')))
+
+    root = os.path.dirname(os.path.abspath(path))
+    wanted = None if dockerfiles is None else set(os.path.abspath(d) for d in dockerfiles)
+    records = []
+    for project in plan['projects']:
+        for target in project['targets']:
+            dockerfile = os.path.normpath(os.path.join(root, project['path'],
+                                                       target['dockerfile']))
+            if wanted is not None:
+                if dockerfile not in wanted:
+                    continue
+                wanted.discard(dockerfile)
+            repository = image_repository(target['image'])
+            if repository is None:
+                raise ValueError("no quay.io repository for image {} of {}, set registry to "
+                                 "quay.io/org/".format(target['image'], target['dockerfile']))
+            records.append({'repository': repository, 'tag': target['tag'],
+                            'pull_robot': pull_robot, 'context': os.path.dirname(dockerfile)})
+    if wanted:
+        raise ValueError("Dockerfiles not in the plan: {}".format(
+            ', '.join(sorted(os.path.relpath(d) for d in wanted))))
+    return records
+
+
+def context_digest(path):
+    """Stable hash of a build context directory: relative paths, modes and
+       content of all its entries.
+    """
+    sha = hashlib.sha256()
+    for relpath in context_entries(path):
+        fullpath = os.path.join(path, relpath)
+        st = os.lstat(fullpath)
+        sha.update("{}\0{:o}\0".format(relpath, st.st_mode))
+        if stat.S_ISLNK(st.st_mode):
+            sha.update(os.readlink(fullpath))
+        elif stat.S_ISREG(st.st_mode):
+            with open(fullpath, 'rb') as stream:
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), ''):
+                    sha.update(chunk)
+    return sha.hexdigest()
+
+
+def context_entries(path):
+    """Sorted relative paths of all the entries of a build context directory.
+    """
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in dirs + files:
+            entries.append(os.path.relpath(os.path.join(root, name), path))
+    return sorted(entries)
+
+
+class ChunkedWriter(object):
+    """
+    File-like object sending written data as HTTP chunks, at most
+    UPLOAD_CHUNK_SIZE bytes are buffered.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= UPLOAD_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.size:
+            self.conn.send("{:x}\r\n{}\r\n".format(self.size, ''.join(self.buffer)))
+        self.buffer, self.size = [], 0
+
+    def close(self):
+        self.flush()
+        self.conn.send("0\r\n\r\n")
+
+
+def stream_context(url, path, timeout=600):
+    """Stream gzip tarball of the context directory to the upload url using
+       chunked transfer encoding, no intermediate file is created.
+    """
+    url = urlparse.urlparse(url)
+    klass = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+    conn = klass(url.netloc, timeout=timeout)
+    try:
+        conn.putrequest('PUT', url.path + ('?' + url.query if url.query else ''),
+                        skip_accept_encoding=True)
+        conn.putheader('Content-Type', 'application/x-tar')
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+
+        writer = ChunkedWriter(conn)
+        tar = tarfile.open(fileobj=writer, mode='w|gz')
+        for relpath in context_entries(path):
+            tar.add(os.path.join(path, relpath), arcname=relpath, recursive=False)
+        tar.close()
+        writer.close()
+
+        response = conn.getresponse()
+        data = response.read()
+        if response.status >= 300:
+            raise ValueError("upload failed, HTTP {}: {}".format(response.status, data.strip()))
+    finally:
+        conn.close()
+
+
+class ContextUploader(object):
+    """
+    Upload build contexts to quay.io file drop. Contexts are hashed, so that
+    an identical context is uploaded only once and its file id is reused.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.uploads = {}
+
+    def upload(self, path):
+        """Upload context directory, file id returned.
+        """
+        if not os.path.isdir(path):
+            raise ValueError("build context {} is not a directory".format(path))
+        digest = context_digest(path)
+
+        # first thread uploads the context, the others wait for its file id
+        with self.lock:
+            upload = self.uploads.get(digest)
+            owner = upload is None
+            if owner:
+                upload = self.uploads[digest] = {'done': threading.Event()}
+        if not owner:
+            upload['done'].wait()
+            if 'error' in upload:
+                raise ValueError(upload['error'])
+            return upload['file_id']
+
+        try:
+            upload['file_id'] = self.drop_file(path)
+            return upload['file_id']
+        except (httplib.HTTPException, socket.error, ValueError, KeyError) as e:
+            upload['error'] = "context {} upload failed: {}".format(path, e)
+            raise ValueError(upload['error'])
+        finally:
+            upload['done'].set()
+
+    def drop_file(self, path):
+        status, data = self.client.request('POST', '/filedrop/',
+                                           json.dumps({'mimeType': 'application/x-tar'}))
+        if status >= 300:
+            raise ValueError("HTTP {}: {}".format(status, data.strip()))
+        drop = json.loads(data)
+        stream_context(drop['url'], path)
+        return drop['file_id']
+
+
+def build_payload(record, uploader):
+    """Build payload of a record, build context is uploaded if given.
+    """
+    if record.get('context'):
+        return get_payload(file_id=uploader.upload(record['context']), tag=record['tag'],
+                           pull_robot=record['pull_robot'])
+    return get_payload(archive_url=record['dockerfile'], tag=record['tag'],
+                       pull_robot=record['pull_robot'])
+
+
+def trigger_batch(records, client, concurrency=4, rate=0):
+    """Trigger builds of all the records concurrently, list of BuildResult
+       returned in the order of records.
+    """
+    limiter = RateLimiter(rate)
+    uploader = ContextUploader(client)
+
+    def trigger(record):
+        try:
+            data = build_payload(record, uploader)
+        except (IOError, OSError, ValueError) as e:
+            return BuildResult(record, None, None, str(e))
+        limiter.wait()
+        return request_build(client, record['repository'], data)._replace(record=record)
+
+    # payload template is compiled before workers start
+    payload_template()
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        return pool.map(trigger, records)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def result_build_id(result):
+    """Build id of a triggered build, None if the response body can't be parsed.
+    """
+    try:
+        return json.loads(result.data)['id']
+    except (ValueError, KeyError, TypeError):
+        return None
 
-    command = ('curl -sS -XPOST', '-H "Content-Type: application/json"',
-               '-H "Authorization: Bearer {}"'.format(access_token), '-d @-',
-               "{api}/{repository}/build/".format(api=quayio_apiurl.strip('/'),
-                                                  repository=repository.strip('/')))
 
-    result = shell_out(' '.join(command), payload_data)
+def print_batch_summary(results):
+    """Print per build results and a summary, number of failures returned.
+    """
+    failed = 0
+    for result in results:
+        record = result.record
+        name = "{}:{}".format(record['repository'], record['tag'])
+        if result.error:
+            failed += 1
+            print "FAILED {} ({})".format(name, result.error)
+        else:
+            print "OK {} build {}/{}".format(name, record['repository'],
+                                             result_build_id(result) or 'unknown')
+
+    print "***** {} builds triggered, {} failed".format(len(results) - failed, failed)
+    return failed
+
+
+class BuildPoller(object):
+    """
+    Track phases of many builds using a small pool of threads. Builds are
+    kept in a heap ordered by the time of their next poll, polling interval
+    grows exponentially (with jitter) while a build stays in the same phase.
+    """
+
+    def __init__(self, client, builds, concurrency=4, interval=5, deadline=3600):
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.interval = interval
+        self.deadline = time.time() + deadline
+        self.phases = dict((b, None) for b in builds)
+        self.final = {}
+        self.errors = dict((b, 0) for b in builds)
+        self.attempts = dict((b, 0) for b in builds)
+        self.heap = [(0, b) for b in builds]
+        self.cond = threading.Condition()
+
+    def run(self):
+        """Poll until all builds finish or deadline is reached, dict of
+           build final phases returned (timeout for unfinished builds).
+        """
+        workers = [threading.Thread(target=self.worker) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.final
+
+    def next_build(self):
+        """Wait for the next build due to be polled, None is returned when
+           there's nothing left to poll.
+        """
+        with self.cond:
+            while self.heap:
+                now = time.time()
+                if now >= self.deadline:
+                    while self.heap:
+                        self.finish(heapq.heappop(self.heap)[1], 'timeout')
+                    break
+                due, build = self.heap[0]
+                if due <= now:
+                    return heapq.heappop(self.heap)[1]
+                self.cond.wait(min(due, self.deadline) - now)
+
+    def worker(self):
+        while True:
+            build = self.next_build()
+            if build is None:
+                return
+            phase = self.poll(build)
+            with self.cond:
+                if phase == 'complete' or phase in FAILED_PHASES + POLL_FAILED_PHASES:
+                    self.finish(build, phase)
+                else:
+                    heapq.heappush(self.heap, (time.time() + self.backoff(build), build))
+                self.cond.notify_all()
+
+    def poll(self, build):
+        """Poll build phase and report phase transition.
+        """
+        repository, _, build_id = build.rpartition('/')
+        path = "/repository/{}/build/{}".format(repository, build_id)
+        try:
+            status, data = self.client.request('GET', path)
+            if status == 404:
+                self.report(build, "{} -> notfound (HTTP 404)".format(
+                    self.phases[build] or 'unknown'))
+                self.phases[build] = 'notfound'
+                return 'notfound'
+            if status >= 300:
+                raise ValueError("HTTP {}: {}".format(status, data.strip()))
+            phase = json.loads(data)['phase']
+            self.errors[build] = 0
+        except (httplib.HTTPException, socket.error, ValueError, KeyError) as e:
+            self.errors[build] += 1
+            self.report(build, "poll failed ({})".format(e))
+            return 'pollerror' if self.errors[build] >= MAX_POLL_ERRORS else self.phases[build]
+
+        if phase != self.phases[build]:
+            self.report(build, "{} -> {}".format(self.phases[build] or 'unknown', phase))
+            self.phases[build] = phase
+            self.attempts[build] = 0
+        return phase
+
+    def backoff(self, build):
+        """Delay before the next poll, exponential backoff with jitter.
+        """
+        self.attempts[build] += 1
+        delay = min(MAX_POLL_INTERVAL, self.interval * 2 ** (self.attempts[build] - 1))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def finish(self, build, phase):
+        self.final[build] = phase
+        if phase not in (self.phases[build], 'complete'):
+            self.report(build, phase)
+
+    def report(self, build, message):
+        # threads share stdout, transitions are printed as soon as they happen
+        with self.cond:
+            print "{}: {}".format(build, message)
+            sys.stdout.flush()
 
-    if result.failed:
-        print result.output
+
+def wait_builds(client, builds, concurrency=4, interval=5, deadline=3600):
+    """Wait for builds to finish and print a summary, exit code returned.
+    """
+    final = BuildPoller(client, builds, concurrency, interval, deadline).run()
+    failed = [b for b in builds if final[b] not in ('complete', 'timeout')]
+    timedout = [b for b in builds if final[b] == 'timeout']
+
+    print "***** {} builds complete, {} failed, {} timed out".format(
+        len(builds) - len(failed) - len(timedout), len(failed), len(timedout))
+    for build in failed + timedout:
+        print "{} {}".format(final[build].upper(), build)
+
+    if failed:
+        return 1
+    return 2 if timedout else 0
+
+
+def run_wait(args, builds=None):
+    """Wait mode entry point.
+    """
+    if builds is None:
+        builds = args['<build>']
+        if builds == ['-']:
+            builds = [line.strip() for line in sys.stdin if line.strip()]
+    try:
+        concurrency = int(args['--concurrency'])
+        interval = float(args['--interval'])
+        deadline = float(args['--deadline'])
+        invalid = [b for b in builds if b.count('/') < 2]
+        if invalid:
+            raise ValueError("builds are expected as org/repo/build-id, "
+                             "given {}".format(', '.join(invalid)))
+    except ValueError as e:
+        print "Unable to wait for builds: {}".format(e)
         sys.exit(1)
 
-    print_build_result(result.output)
+    client = QuayClient(api_url(args['--api-url']), access_token())
+    sys.exit(wait_builds(client, builds, concurrency, interval, deadline))
+
+
+def run_batch(args):
+    """Batch and plan modes entry point.
+    """
+    try:
+        concurrency = int(args['--concurrency'])
+        rate = float(args['--rate'])
+        if args['--plan']:
+            dockerfiles = args['<dockerfile>'] or None
+            if dockerfiles == ['-']:
+                dockerfiles = [line.strip() for line in sys.stdin if line.strip()]
+            records = plan_records(args['--plan'], args['--pull-robot'], dockerfiles)
+        elif args['--batch'] == '-':
+            records = read_records(sys.stdin, args['--format'])
+        else:
+            with open(args['--batch'], 'r') as stream:
+                records = read_records(stream, args['--format'])
+    except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        print "Unable to read batch records: {}".format(e)
+        sys.exit(1)
+
+    client = QuayClient(api_url(args['--api-url']), access_token())
+    results = trigger_batch(records, client, concurrency, rate)
+    failed = print_batch_summary(results)
+
+    if args['--wait']:
+        builds = ["{}/{}".format(r.record['repository'], result_build_id(r))
+                  for r in results if not r.error and result_build_id(r)]
+        unknown = len(results) - failed - len(builds)
+        if unknown:
+            # builds of unparsable responses can't be polled, they count as failed
+            print "{} builds with unknown id are not waited for".format(unknown)
+        code = wait_builds(client, builds, concurrency, float(args['--interval']),
+                           float(args['--deadline']))
+        sys.exit(1 if failed or unknown else code)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     args = docopt(__docopt__)
 
-    data = get_payload(archive_url=args['--dockerfile'], tag=args['--tag'],
-                       pull_robot=args['--pull-robot'])
+    if args['--batch'] or args['--plan']:
+        run_batch(args)
+        sys.exit(0)
+    elif args['--wait']:
+        run_wait(args)
+
+    record = {
+        'dockerfile': args['--dockerfile'],
+        'context': args['--context'],
+        'tag': args['--tag'],
+        'pull_robot': args['--pull-robot']
+    }
 
     reponame = args['--repository']
-    trigger_build(reponame, data)
+    trigger_build(reponame, record, args['--api-url'])
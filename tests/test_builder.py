@@ -0,0 +1,70 @@
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from citools.builder import BUILT, FAILED, SKIPPED, BuildExecutor
+
+
+class BuildExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.docker = os.path.join(self.path, 'docker')
+        with open(self.docker, 'w') as stream:
+            stream.write('#!/bin/sh\nexit 0\n')
+        os.chmod(self.docker, os.stat(self.docker).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def dockerfile(self, version, variant, parent):
+        directory = os.path.join(self.path, version, variant)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'Dockerfile'), 'w') as stream:
+            stream.write('FROM {}\n'.format(parent))
+        return (version, variant)
+
+    def test_dependants_of_cycle_are_skipped(self):
+        targets = [self.dockerfile('a', 'x', 'img:a-y'),
+                   self.dockerfile('a', 'y', 'img:a-x'),
+                   self.dockerfile('a', 'z', 'img:a-y'),
+                   self.dockerfile('a', 'w', 'img:a-z'),
+                   self.dockerfile('b', 'x', 'centos:7')]
+        executor = BuildExecutor(targets, 'img', docker=self.docker,
+                                 log_dir=os.path.join(self.path, 'logs'), path=self.path)
+        results = dict((r.target, r) for r in executor.run())
+
+        self.assertEqual(sorted(results), sorted(targets))
+        self.assertEqual(results[('b', 'x')].status, BUILT)
+        for target in targets[:4]:
+            self.assertEqual(results[target].status, SKIPPED)
+        self.assertEqual(results[('a', 'x')].error, "dependency cycle")
+        self.assertEqual(results[('a', 'z')].error, "a/y/Dockerfile was not built")
+        self.assertEqual(results[('a', 'w')].error, "a/z/Dockerfile was not built")
+
+    def test_unexpected_build_error_fails_target(self):
+        targets = [self.dockerfile('a', 'x', 'centos:7'), self.dockerfile('a', 'y', 'img:a-x')]
+        executor = BuildExecutor(targets, 'img', docker=self.docker,
+                                 log_dir=os.path.join(self.path, 'logs'), path=self.path)
+
+        def build(target):
+            raise RuntimeError("boom")
+        executor.build = build
+
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(executor.run()))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), "scheduler blocked")
+        results = dict((r.target, r) for r in results)
+        self.assertEqual(results[('a', 'x')].status, FAILED)
+        self.assertEqual(results[('a', 'x')].error, "RuntimeError: boom")
+        self.assertEqual(results[('a', 'y')].status, SKIPPED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools import execute
+from citools.changes import ChangeIndex, query
+
+ENV = dict(GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+           GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+class ChangeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = os.path.realpath(tempfile.mkdtemp())
+        self.environ = dict(os.environ)
+        os.environ.update(ENV)
+        os.chdir(self.path)
+        execute.git('init', '-q')
+        self.commit({'a/Dockerfile': 'FROM centos\n', 'b/Dockerfile': 'FROM centos\n'})
+        execute.git('tag', 'base')
+        self.commit({'a/Dockerfile': 'FROM fedora\n'})
+        self.commit({'b/scm/Dockerfile': 'FROM b\n'})
+        self.index_path = os.path.join(self.path, '.git', 'index.json')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def commit(self, files):
+        for name, content in files.items():
+            if not os.path.isdir(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+            with open(name, 'w') as stream:
+                stream.write(content)
+        execute.git('add', '-A')
+        execute.git('commit', '-q', '-m', 'change')
+
+    def test_changed(self):
+        index = ChangeIndex(self.index_path)
+        self.assertEqual(index.changed('base'), set(['a/Dockerfile', 'b/scm/Dockerfile']))
+        self.assertEqual(index.changed('HEAD~1..HEAD'), set(['b/scm/Dockerfile']))
+        self.assertEqual(index.changed('base..HEAD~1'), set(['a/Dockerfile']))
+        self.assertEqual(index.changed('HEAD..HEAD'), set())
+
+    def test_root_commit_is_compared_to_empty_tree(self):
+        index = ChangeIndex(self.index_path)
+        root = execute.git('rev-parse', 'base').strip()
+        index.update([(root,)])
+        self.assertEqual(index.commits[root], set(['a/Dockerfile', 'b/Dockerfile']))
+
+    def test_reverted_change_is_reported(self):
+        self.commit({'a/Dockerfile': 'FROM centos\n'})
+        self.assertIn('a/Dockerfile', ChangeIndex(self.index_path).changed('base'))
+
+    def test_index_is_saved_and_reused(self):
+        index = ChangeIndex(self.index_path)
+        expected = index.changed('base')
+        index.save()
+        self.assertTrue(os.path.exists(self.index_path))
+
+        loaded = ChangeIndex(self.index_path)
+        self.assertEqual(sorted(loaded.commits), sorted(index.commits))
+        self.assertEqual(loaded.changed('base'), expected)
+        self.assertFalse(loaded.dirty, "indexed commits are not diffed again")
+
+    def test_corrupted_index_is_rebuilt(self):
+        with open(self.index_path, 'w') as stream:
+            stream.write('{')
+        self.assertEqual(ChangeIndex(self.index_path).changed('HEAD~1'),
+                         set(['b/scm/Dockerfile']))
+
+    def test_query_relative_to_current_directory(self):
+        index = ChangeIndex(self.index_path)
+        os.chdir('b')
+        self.assertEqual(query(index, ['base', 'HEAD~1'], ['.', '../a']),
+                         [('base', '.', ['scm/Dockerfile']),
+                          ('base', '../a', ['../a/Dockerfile']),
+                          ('HEAD~1', '.', ['scm/Dockerfile']),
+                          ('HEAD~1', '../a', [])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools.config import ConfigError, ConfigLoader
+
+
+class ConfigLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.path, 'cache')
+        self.loader = ConfigLoader(cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+        path = os.path.join(self.path, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as stream:
+            stream.write(content)
+        return path
+
+    def test_extends_merges_bases_first(self):
+        self.write('base.yaml', 'env:\n  registry: quay.io/org/\n  hello: world\n'
+                                'skip-version: [junk]\ndatasources: [ds/filters.py]\n')
+        config = self.write('app/docker-template.yaml',
+                            'extends: ../base.yaml\nenv:\n  hello: there\nskip-version: [tmp]\n')
+        self.assertEqual(self.loader.load(config), {
+            'env': {'registry': 'quay.io/org/', 'hello': 'there'},
+            'skip-version': ['junk', 'tmp'],
+            'datasources': ['../ds/filters.py'],
+        })
+        self.assertEqual(self.loader.files(config),
+                         [os.path.normpath(config), os.path.join(self.path, 'base.yaml')])
+
+    def test_base_reached_twice_is_merged_once(self):
+        self.write('base.yaml', 'skip-version: [junk]\n')
+        self.write('a.yaml', 'extends: base.yaml\n')
+        config = self.write('b.yaml', 'include: [base.yaml, a.yaml]\n')
+        self.assertEqual(self.loader.load(config), {'skip-version': ['junk']})
+
+    def test_cycle(self):
+        self.write('a.yaml', 'extends: b.yaml\n')
+        config = self.write('b.yaml', 'extends: a.yaml\n')
+        self.assertRaisesRegexp(ConfigError, 'extends itself', self.loader.load, config)
+
+    def test_missing_base(self):
+        config = self.write('a.yaml', 'extends: missing.yaml\n')
+        self.assertRaisesRegexp(ConfigError, "doesn't exist", self.loader.load, config)
+        self.assertIsNone(self.loader.load(os.path.join(self.path, 'missing.yaml')))
+
+    def test_invalid_bases(self):
+        for content in ('extends: 5\n', 'extends: [a.yaml, 5]\n', 'include: {a: b}\n',
+                        'extends: a.yaml\ninclude: b.yaml\n'):
+            config = self.write('a.yaml', content)
+            self.assertRaisesRegexp(ConfigError, 'Config .*a.yaml', self.loader.load, config)
+
+    def test_invalid_yaml(self):
+        config = self.write('a.yaml', 'env: [\n')
+        self.assertRaisesRegexp(ConfigError, 'Unable to parse', self.loader.load, config)
+
+    def test_readonly_load_does_not_write_cache(self):
+        config = self.write('a.yaml', 'env: {a: b}\n')
+        self.loader.load(config, readonly=True)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+        self.loader.load(config)
+        self.assertFalse(os.path.exists(self.cache_dir), "memoized document is reused")
+        ConfigLoader(cache_dir=self.cache_dir).load(config)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # cached document is read by another loader
+        self.assertEqual(ConfigLoader(cache_dir=self.cache_dir).load(config), {'env': {'a': 'b'}})
+
+    def test_prune(self):
+        os.makedirs(self.cache_dir)
+        for index in range(5):
+            entry = self.write('cache/entry{}'.format(index), '')
+            os.utime(entry, (index * 100, index * 100))
+        self.loader.prune(max_age=1e12, max_entries=3)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['entry2', 'entry3', 'entry4'])
+        self.loader.prune(max_age=1)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools import execute
+from citools.context import DigestError, DockerIgnore, GitTree, WorkTree, blob_hash, \
+    changed_contexts, copy_sources, load_manifest, normalize_dockerfile, save_manifest, \
+    tree_digests
+
+ENV = dict(GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+           GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+class DockerfileTest(unittest.TestCase):
+
+    def test_normalize(self):
+        content = ('# escape=`\n'
+                   'from  centos:7\n'
+                   '# comment\n'
+                   '\n'
+                   'RUN yum install `\n'
+                   '    # inside continuation\n'
+                   '    -y   "a  b"\n')
+        self.assertEqual(normalize_dockerfile(content),
+                         ['# escape=`', 'FROM centos:7', 'RUN yum install -y "a  b"'])
+
+    def test_copy_sources(self):
+        instructions = ['COPY a b /dest/', 'ADD --chown=1:1 c /dest', 'COPY --from=build /x /y',
+                        'ADD http://example.com/f /f', 'COPY ["d e", "/dest"]', 'RUN f']
+        self.assertEqual(copy_sources(instructions), ['a', 'b', 'c', 'd e'])
+
+    def test_dockerignore(self):
+        ignore = DockerIgnore('# comment\n*.log\nbuild\n!build/keep\n**/tmp\n')
+        self.assertTrue(ignore.excluded('a.log'))
+        self.assertFalse(ignore.excluded('dir/a.log'))
+        self.assertTrue(ignore.excluded('build/out'))
+        self.assertFalse(ignore.excluded('build/keep'))
+        self.assertTrue(ignore.excluded('a/b/tmp/c'))
+
+    def test_blob_hash_matches_git(self):
+        self.assertEqual(blob_hash('hello\n'), 'ce013625030ba8dba906f756967f9e9ca394464a')
+
+
+class TreeDigestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = os.path.realpath(tempfile.mkdtemp())
+        self.environ = dict(os.environ)
+        os.environ.update(ENV)
+        os.chdir(self.path)
+        self.write({'a/Dockerfile': 'FROM centos\nCOPY files /files\n',
+                    'a/files/conf': 'x\n',
+                    'a/files/debug.log': 'x\n',
+                    'a/.dockerignore': '**/*.log\n',
+                    'a/README': 'readme\n',
+                    'b/Dockerfile': 'FROM centos\n'})
+        execute.git('init', '-q')
+        execute.git('add', '-A')
+        execute.git('commit', '-q', '-m', 'base')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def write(self, files):
+        for name, content in files.items():
+            if not os.path.isdir(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+            with open(name, 'w') as stream:
+                stream.write(content)
+
+    def test_revision_and_working_tree_digests_match(self):
+        self.assertEqual(tree_digests(GitTree('HEAD')), tree_digests(WorkTree()))
+
+    def test_changed_contexts(self):
+        base = tree_digests(WorkTree())
+        # unreferenced, ignored files and formatting don't change the digest
+        self.write({'a/README': 'changed\n', 'a/files/debug.log': 'changed\n',
+                    'b/Dockerfile': '# comment\nfrom   centos\n'})
+        self.assertEqual(changed_contexts(base, tree_digests(WorkTree())), [])
+
+        self.write({'a/files/conf': 'changed\n', 'c/Dockerfile': 'FROM centos\n'})
+        self.assertEqual(changed_contexts(base, tree_digests(WorkTree())),
+                         ['a/Dockerfile', 'c/Dockerfile'])
+
+    def test_mode_change_changes_digest(self):
+        base = tree_digests(WorkTree())
+        os.chmod('a/files/conf', 0755)
+        self.assertEqual(changed_contexts(base, tree_digests(WorkTree())), ['a/Dockerfile'])
+
+    def test_manifest(self):
+        manifest = os.path.join(self.path, 'manifest.json')
+        self.assertEqual(load_manifest(manifest), {})
+        digests = tree_digests(WorkTree())
+        save_manifest(manifest, digests)
+        self.assertEqual(load_manifest(manifest), digests)
+
+        with open(manifest, 'w') as stream:
+            stream.write('{')
+        self.assertRaises(DigestError, load_manifest, manifest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'docker-template.py')
+
+
+class CheckModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for version in ('centos7', 'fedora23'):
+            os.makedirs(os.path.join(self.path, version))
+        self.write('Dockerfile.template', 'FROM {{ version }}\n')
+        self.write('docker-template.yaml', 'env:\n  registry: quay.io/org/\n')
+        self.assertEqual(self.run_script()[0], 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+        with open(os.path.join(self.path, name), 'w') as stream:
+            stream.write(content)
+
+    def run_script(self, *args):
+        env = dict(os.environ, PYTHONPATH=ROOT, XDG_CACHE_HOME=os.path.join(self.path, '.cache'))
+        process = subprocess.Popen([sys.executable, SCRIPT, '-q'] + list(args), cwd=self.path,
+                                   env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, _ = process.communicate()
+        return (process.returncode, output.split())
+
+    def test_up_to_date(self):
+        self.assertEqual(self.run_script('--check'), (0, []))
+
+    def test_stale_dockerfiles(self):
+        self.write('Dockerfile.template', 'FROM {{ version }}:latest\n')
+        code, stale = self.run_script('--check')
+        self.assertEqual(code, 2)
+        self.assertEqual(len(stale), 1, "check stops at the first stale Dockerfile")
+        code, stale = self.run_script('--check-all')
+        self.assertEqual((code, sorted(stale)), (2, ['centos7/Dockerfile', 'fedora23/Dockerfile']))
+        # nothing is written
+        with open(os.path.join(self.path, 'centos7', 'Dockerfile')) as stream:
+            self.assertEqual(stream.read(), 'FROM centos7')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import threading
+import unittest
+
+from citools import execute
+
+
+class LimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limit = execute.limiter.limit
+        execute.set_limit(1)
+
+    def tearDown(self):
+        execute.set_limit(self.limit)
+
+    def test_commands_run_while_streaming(self):
+        outputs = []
+
+        def consume():
+            for line in execute.Stream(['printf', 'a\\nb\\n']):
+                outputs.append((line.strip(), execute.run(['echo', line.strip()]).output))
+
+        thread = threading.Thread(target=consume)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), "nested command deadlocked")
+        self.assertEqual(outputs, [('a', 'a\n'), ('b', 'b\n')])
+
+    def test_slots_are_released(self):
+        execute.run(['true'])
+        for _ in execute.Stream(['echo', 'x']):
+            pass
+        # the only slot is free again
+        self.assertTrue(execute.limiter.semaphore.acquire(False))
+        execute.limiter.semaphore.release()
+
+
+class RunCheckedTest(unittest.TestCase):
+
+    def test_failure_raises_command_error(self):
+        with self.assertRaises(execute.CommandError) as context:
+            execute.run_checked(['sh', '-c', 'echo oops >&2; exit 3'])
+        self.assertEqual(context.exception.result.returncode, 3)
+        self.assertIn('oops', str(context.exception))
+
+    def test_output_returned(self):
+        self.assertEqual(execute.run_checked('echo ok'), 'ok\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
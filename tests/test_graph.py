@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools.graph import BuildGraph, parse_from, registry_namespace, split_image
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse_from(self):
+        content = 'FROM --platform=linux/amd64 centos:7 AS build\nRUN true\nfrom img:a-scm\n'
+        self.assertEqual(parse_from(content), ['centos:7', 'img:a-scm'])
+
+    def test_split_image(self):
+        self.assertEqual(split_image('centos'), ('centos', 'latest'))
+        self.assertEqual(split_image('quay.io/org/img:a'), ('quay.io/org/img', 'a'))
+        self.assertEqual(split_image('localhost:5000/img'), ('localhost:5000/img', 'latest'))
+        self.assertEqual(split_image('img:a@sha256:abc'), ('img', 'a'))
+
+    def test_registry_namespace(self):
+        self.assertEqual(registry_namespace('quay.io/org/'), 'org/')
+        self.assertEqual(registry_namespace('localhost:5000/org/'), 'org/')
+        self.assertEqual(registry_namespace('localhost/org/'), 'org/')
+        self.assertEqual(registry_namespace('org/'), 'org/')
+        self.assertEqual(registry_namespace(''), '')
+
+
+class BuildGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def dockerfile(self, version, variant, content):
+        directory = os.path.join(self.path, version, variant)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'Dockerfile'), 'w') as stream:
+            stream.write(content)
+        return (version, variant)
+
+    def test_local_references(self):
+        base = self.dockerfile('a', '', 'FROM centos:7\n')
+        targets = [base,
+                   self.dockerfile('a', 'x', 'FROM img:a\n'),
+                   self.dockerfile('a', 'y', 'FROM quay.io/org/img:a\n'),
+                   self.dockerfile('a', 'z', 'FROM org/img:a\n'),
+                   self.dockerfile('a', 'w', 'FROM other/img:a\n')]
+        graph = BuildGraph(targets, 'img', registry='quay.io/org/', path=self.path)
+        for target in targets[1:4]:
+            self.assertEqual(graph.dependencies[target], set([base]), target)
+        self.assertEqual(graph.dependencies[('a', 'w')], set())
+        self.assertEqual(graph.levels(), ([[('a', ''), ('a', 'w')],
+                                           [('a', 'x'), ('a', 'y'), ('a', 'z')]], []))
+
+    def test_dangling_and_cycles(self):
+        targets = [self.dockerfile('a', 'x', 'FROM img:a-y\n'),
+                   self.dockerfile('a', 'y', 'FROM img:a-x\n'),
+                   self.dockerfile('b', '', 'FROM img:missing\n')]
+        graph = BuildGraph(targets, 'img', path=self.path)
+        self.assertEqual(graph.dangling, [(('b', ''), 'img:missing')])
+        self.assertEqual(graph.levels(), ([[('b', '')]], [[('a', 'x'), ('a', 'y')]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools.matrix import DirMatcher, Matrix, brace_expand
+
+
+class DirMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for directory in ('centos6', 'centos7', 'fedora22', '.hidden', 'nested/a1',
+                          'nested/b1'):
+            os.makedirs(os.path.join(self.path, directory))
+        self.cwd = os.getcwd()
+        # patterns must not depend on the current directory
+        os.chdir(tempfile.gettempdir())
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def test_brace_expand(self):
+        self.assertEqual(brace_expand('centos{6,7}'), ['centos6', 'centos7'])
+        self.assertEqual(brace_expand('fedora{22..24}'), ['fedora22', 'fedora23', 'fedora24'])
+
+    def test_globs_and_literals(self):
+        matcher = DirMatcher(self.path)
+        self.assertEqual(sorted(matcher.match(['centos*'])), ['centos6', 'centos7'])
+        self.assertEqual(matcher.match(['fedora22', 'missing']), ['fedora22'])
+        self.assertNotIn('.hidden', matcher.match(['*']))
+
+    def test_nested_patterns_are_relative_to_path(self):
+        matcher = DirMatcher(self.path)
+        self.assertEqual(matcher.match(['nested/*1']), ['nested/a1', 'nested/b1'])
+        self.assertEqual(matcher.match(['nested/{a,c}1']), ['nested/a1'])
+
+    def test_matrix_pairs(self):
+        with open(os.path.join(self.path, 'Dockerfile.template-scm'), 'w') as stream:
+            stream.write('FROM centos\n')
+        matrix = Matrix({'scm': ['centos{6,7}']}, ['nested', 'fedora*'], path=self.path)
+        self.assertEqual(sorted(matrix.pairs()), [('centos6', 'scm'), ('centos7', 'scm')])
+
+
+if __name__ == '__main__':
+    unittest.main()
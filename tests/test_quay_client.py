@@ -0,0 +1,138 @@
+import httplib
+import imp
+import json
+import os
+import sys
+import time
+import unittest
+
+from StringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+build = imp.load_source('quay_build', os.path.join(ROOT, 'quayio', 'build.py'))
+stub_quay = imp.load_source('stub_quay', os.path.join(ROOT, 'benchmarks', 'stub_quay.py'))
+
+BUILD_PATH = '/repository/org/repo/build/'
+
+
+class QuayClientRetryTest(unittest.TestCase):
+
+    def start(self, close_idle=False):
+        self.server = stub_quay.start_server(close_idle=close_idle)
+        self.client = build.QuayClient(self.server.api_url, 'token')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_idle_closed_connection_is_replaced(self):
+        self.start(close_idle=True)
+        self.assertEqual(self.client.request('POST', BUILD_PATH, '{}')[0], 201)
+        # let the server close the kept-alive connection
+        time.sleep(0.2)
+        self.assertEqual(self.client.request('POST', BUILD_PATH, '{}')[0], 201)
+        self.assertEqual(self.server.counters['builds'], 2)
+
+    def test_post_without_response_is_not_resent(self):
+        self.start()
+        self.assertEqual(self.client.request('GET', BUILD_PATH + '1')[0], 200)
+        self.server.drop = 1
+        self.assertRaises(httplib.HTTPException, self.client.request, 'POST', BUILD_PATH, '{}')
+        self.assertEqual(self.server.counters['builds'], 1)
+        # the broken connection isn't reused
+        self.assertEqual(self.client.request('POST', BUILD_PATH, '{}')[0], 201)
+
+    def test_get_without_response_is_retried_on_reused_connection(self):
+        self.start()
+        self.assertEqual(self.client.request('GET', BUILD_PATH + '1')[0], 200)
+        self.server.drop = 1
+        self.assertEqual(self.client.request('GET', BUILD_PATH + '1')[0], 200)
+        self.assertEqual(self.server.counters['polls'], 3)
+
+    def test_fresh_connection_is_not_retried(self):
+        self.start()
+        self.server.drop = 1
+        self.assertRaises(httplib.HTTPException, self.client.request, 'GET', BUILD_PATH + '1')
+        self.assertEqual(self.server.counters['polls'], 1)
+
+
+class ScriptedClient(object):
+    """Client answering polls of every build with its list of responses.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def request(self, method, path):
+        responses = self.responses[path.split('/repository/', 1)[1].replace('/build/', '/')]
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class BuildPollerTest(unittest.TestCase):
+
+    def run_poller(self, responses, deadline=10):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            return build.BuildPoller(ScriptedClient(responses), sorted(responses),
+                                     interval=0, deadline=deadline).run()
+        finally:
+            sys.stdout = stdout
+
+    def test_final_phases(self):
+        phase = lambda name: (200, '{{"phase": "{}"}}'.format(name))
+        final = self.run_poller({
+            'org/a/1': [phase('waiting'), phase('building'), phase('complete')],
+            'org/a/2': [phase('building'), phase('error')],
+            'org/a/3': [(404, 'not found')],
+            'org/a/4': [httplib.BadStatusLine('')],
+            'org/a/5': [(500, 'oops'), phase('complete')],
+        })
+        self.assertEqual(final, {'org/a/1': 'complete', 'org/a/2': 'error',
+                                 'org/a/3': 'notfound', 'org/a/4': 'pollerror',
+                                 'org/a/5': 'complete'})
+
+    def test_deadline(self):
+        final = self.run_poller({'org/a/1': [(200, '{"phase": "building"}')]}, deadline=0)
+        self.assertEqual(final, {'org/a/1': 'timeout'})
+
+    def test_stub_builds_complete(self):
+        server = stub_quay.start_server(polls=2)
+        client = build.QuayClient(server.api_url, 'token')
+        try:
+            builds = ['org/repo/{}'.format(json.loads(
+                client.request('POST', BUILD_PATH, '{}')[1])['id']) for _ in range(3)]
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                self.assertEqual(build.wait_builds(client, builds, interval=0.01), 0)
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(server.counters['polls'], 6)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+
+class BatchSummaryTest(unittest.TestCase):
+
+    def test_unparsable_response_body(self):
+        record = {'repository': 'org/repo', 'tag': 'latest'}
+        results = [build.BuildResult(record, 201, '<html>proxy</html>', None),
+                   build.BuildResult(record, 201, '{"id": "abc"}', None)]
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            failed = build.print_batch_summary(results)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(failed, 0)
+        self.assertIn('OK org/repo:latest build org/repo/unknown', output)
+        self.assertIn('OK org/repo:latest build org/repo/abc', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
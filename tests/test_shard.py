@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools.shard import ShardError, components, load_durations, merge_reports, parse_shard, \
+    partition, shard_targets
+
+TARGETS = ['a/Dockerfile', 'a/scm/Dockerfile', 'b/Dockerfile', 'c/Dockerfile', 'd/Dockerfile']
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/3'), (2, 3))
+        for value in ('0/3', '4/3', '1', 'a/b', None):
+            self.assertRaises(ShardError, parse_shard, value)
+
+    def test_components(self):
+        dependencies = {'a/scm/Dockerfile': ['a/Dockerfile'], 'c/Dockerfile': ['unknown']}
+        self.assertEqual(components(TARGETS, dependencies),
+                         [['a/Dockerfile', 'a/scm/Dockerfile'], ['b/Dockerfile'],
+                          ['c/Dockerfile'], ['d/Dockerfile']])
+
+    def test_partition_keeps_dependent_targets_together(self):
+        dependencies = {'a/scm/Dockerfile': ['a/Dockerfile']}
+        shards = partition(TARGETS, 2, dependencies=dependencies)
+        self.assertEqual(sorted(t for s in shards for t in s), sorted(TARGETS))
+        together = [s for s in shards if 'a/Dockerfile' in s][0]
+        self.assertIn('a/scm/Dockerfile', together)
+
+    def test_partition_is_balanced_by_durations(self):
+        durations = {'a/Dockerfile': 10, 'b/Dockerfile': 4, 'c/Dockerfile': 3, 'd/Dockerfile': 3}
+        shards = partition(['a/Dockerfile', 'b/Dockerfile', 'c/Dockerfile', 'd/Dockerfile'], 2,
+                           durations)
+        self.assertEqual(shards, [['a/Dockerfile'], ['b/Dockerfile', 'c/Dockerfile',
+                                                     'd/Dockerfile']])
+
+    def test_partition_is_deterministic(self):
+        shuffled = list(reversed(TARGETS))
+        self.assertEqual([sorted(s) for s in partition(TARGETS, 3)],
+                         [sorted(s) for s in partition(shuffled, 3)])
+
+    def test_merge_reports(self):
+        reports = [{'shard': [i, 2], 'targets': TARGETS,
+                    'selected': shard_targets(TARGETS, (i, 2))} for i in (1, 2)]
+        self.assertEqual(merge_reports(reports), [])
+        self.assertEqual(merge_reports(reports[:1] * 2)[0], "Shard 1/2 reported 2 times")
+        self.assertEqual(merge_reports([]), ["No shard reports given"])
+
+
+class DurationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, data):
+        path = os.path.join(self.path, 'durations.json')
+        with open(path, 'w') as stream:
+            stream.write(data if isinstance(data, basestring) else json.dumps(data))
+        return path
+
+    def test_timings_trace_and_mapping(self):
+        trace = {'targets': {'a/Dockerfile': {'total': 1.5}}, 'stages': {}}
+        self.assertEqual(load_durations(self.write(trace)), {'a/Dockerfile': 1.5})
+        self.assertEqual(load_durations(self.write({'a/Dockerfile': 2})), {'a/Dockerfile': 2.0})
+
+    def test_invalid(self):
+        self.assertRaises(ShardError, load_durations, self.write('not json'))
+        self.assertRaises(ShardError, load_durations, os.path.join(self.path, 'missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
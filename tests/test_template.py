@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from citools import config
+from citools.config import ConfigLoader
+from citools.template import DatasourceCache, ProjectsPlan, RenderPlan, discover_projects, \
+    dump_plan, project_plan
+
+
+class RenderPlanRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'centos7'))
+        self.write('Dockerfile.template', 'FROM {{ version }}\n')
+        self.write('docker-template.yaml', 'env:\n  registry: quay.io/org/\n')
+        self.plan = RenderPlan(self.path, cache=False, dry_run=True)
+        # matrix is resolved lazily, watch mode renders it before any refresh
+        self.plan.matrix.pairs()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+        with open(os.path.join(self.path, name), 'w') as stream:
+            stream.write(content)
+
+    def test_template_change_keeps_matrix(self):
+        matrix = self.plan.matrix
+        self.write('Dockerfile.template', 'FROM centos\n')
+        self.assertEqual(self.plan.refresh(['Dockerfile.template']), [('centos7', '')])
+        self.assertIs(self.plan.matrix, matrix)
+
+    def test_new_entries_resolve_matrix(self):
+        matrix = self.plan.matrix
+        os.makedirs(os.path.join(self.path, 'fedora23'))
+        self.assertEqual(self.plan.refresh(['fedora23']), [('fedora23', '')])
+        self.assertIsNot(self.plan.matrix, matrix)
+
+        self.write('Dockerfile.template-scm', 'FROM {{ version }}\n')
+        self.assertEqual(sorted(self.plan.refresh(['Dockerfile.template-scm'])),
+                         [('centos7', 'scm'), ('fedora23', 'scm')])
+
+    def test_config_change_resolves_matrix(self):
+        os.makedirs(os.path.join(self.path, 'fedora23'))
+        self.write('docker-template.yaml',
+                   'env:\n  registry: quay.io/org/\nskip-version:\n  - fedora*\n')
+        self.assertEqual(self.plan.refresh(['docker-template.yaml']), [])
+        self.assertEqual(self.plan.matrix.pairs(), [('centos7', '')])
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'centos7'))
+        os.makedirs(os.path.join(self.path, 'fedora23'))
+        self.write('Dockerfile.template', 'FROM {{ version }}\n')
+        self.config = {'env': {'registry': 'quay.io/org/'}}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+        with open(os.path.join(self.path, name), 'w') as stream:
+            stream.write(content)
+
+    def run_plan(self, **options):
+        options.setdefault('config', self.config)
+        plan = RenderPlan(self.path, **options)
+        return sorted(r.relpath for r in plan.run())
+
+    def test_up_to_date_targets_are_skipped(self):
+        self.assertEqual(self.run_plan(), ['centos7/Dockerfile', 'fedora23/Dockerfile'])
+        self.assertEqual(self.run_plan(), [])
+
+    def test_changed_inputs_and_targets_are_rendered(self):
+        self.run_plan()
+        self.write('centos7/Dockerfile', 'FROM edited\n')
+        self.assertEqual(self.run_plan(), ['centos7/Dockerfile'])
+        with open(os.path.join(self.path, 'centos7', 'Dockerfile')) as stream:
+            self.assertEqual(stream.read(), 'FROM centos7')
+
+        self.write('Dockerfile.template', 'FROM {{ version }}:latest\n')
+        self.assertEqual(self.run_plan(), ['centos7/Dockerfile', 'fedora23/Dockerfile'])
+        self.assertEqual(self.run_plan(config={'env': {'registry': 'other/'}}),
+                         ['centos7/Dockerfile', 'fedora23/Dockerfile'])
+        self.assertEqual(self.run_plan(rebuild_cache=True),
+                         ['centos7/Dockerfile', 'fedora23/Dockerfile'])
+
+    def test_dry_run_does_not_update_cache(self):
+        self.run_plan()
+        self.write('Dockerfile.template', 'FROM {{ version }}:latest\n')
+        self.assertEqual(len(self.run_plan(dry_run=True)), 2)
+        self.assertEqual(len(self.run_plan(dry_run=True)), 2)
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.project = os.path.join(self.path, 'project')
+        os.makedirs(os.path.join(self.project, 'centos7'))
+        self.write('Dockerfile.template', 'FROM {{ version }}\n')
+        self.write('Dockerfile.template-scm', 'FROM {{ version }}\n')
+        self.write('docker-template.yaml', 'env:\n  registry: quay.io/org/\n  image: app\n')
+        self.plan_file = os.path.join(self.path, 'plan.json')
+        plan = RenderPlan(self.project, cache=False, dry_run=True)
+        dump_plan([plan.export()], self.plan_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+        with open(os.path.join(self.project, name), 'w') as stream:
+            stream.write(content)
+
+    def test_export(self):
+        with open(self.plan_file) as stream:
+            self.assertEqual(json.load(stream)['projects'][0]['path'], 'project')
+        project = project_plan(self.plan_file, self.project)
+        targets = sorted((t['dockerfile'], t['image'], t['tag']) for t in project['targets'])
+        self.assertEqual(targets, [('centos7/Dockerfile', 'quay.io/org/app', 'centos7'),
+                                   ('centos7/scm/Dockerfile', 'quay.io/org/app', 'centos7-scm')])
+
+    def test_stale_plan(self):
+        os.makedirs(os.path.join(self.project, 'fedora23'))
+        self.assertIsNone(project_plan(self.plan_file, self.project))
+
+
+class DatasourceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def cache(self, **options):
+        cache = DatasourceCache(os.path.join(self.path, 'cache'), root=self.path, **options)
+        return cache.memoize(lambda *args: self.calls.append(args) or len(self.calls),
+                             'filter', 'definition')
+
+    def test_results_are_shared(self):
+        func = self.cache()
+        self.assertEqual([func('a'), func('a'), func('b')], [1, 1, 2])
+        self.assertEqual(self.cache()('a'), 1, "entry stored on disk")
+        self.assertEqual(self.calls, [('a',), ('b',)])
+
+    def test_unpicklable_arguments_are_not_cached(self):
+        func = self.cache()
+        self.assertEqual([func(lambda: 1), func(lambda: 1)], [1, 2])
+
+    def test_inputs_and_ttl(self):
+        with open(os.path.join(self.path, 'versions.json'), 'w') as stream:
+            stream.write('[1]')
+        self.cache(inputs=['*.json'])('a')
+        self.cache(inputs=['*.json'], readonly=True)('a')
+        self.assertEqual(len(self.calls), 1)
+
+        with open(os.path.join(self.path, 'versions.json'), 'w') as stream:
+            stream.write('[1, 2]')
+        self.cache(inputs=['*.json'], readonly=True)('a')
+        self.assertEqual(len(self.calls), 2)
+
+        for name in os.listdir(os.path.join(self.path, 'cache')):
+            os.utime(os.path.join(self.path, 'cache', name), (0, time.time() - 100))
+        self.cache(inputs=['*.json'], ttl=10)('a')
+        self.assertEqual(len(self.calls), 3)
+
+
+class ProjectsPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.realpath(tempfile.mkdtemp())
+        # config cache of the loader shared by plans stays in the test directory
+        self.loader = config._loader
+        config._loader = ConfigLoader(cache_dir=os.path.join(self.path, '.cache'))
+        for project in ('a', 'b'):
+            path = os.path.join(self.path, project)
+            os.makedirs(os.path.join(path, 'centos7'))
+            with open(os.path.join(path, 'Dockerfile.template'), 'w') as stream:
+                stream.write('FROM {}:{{{{ version }}}}\n'.format(project))
+            with open(os.path.join(path, 'docker-template.yaml'), 'w') as stream:
+                stream.write('env:\n  registry: quay.io/org/\n')
+
+    def tearDown(self):
+        config._loader = self.loader
+        shutil.rmtree(self.path)
+
+    def test_projects_are_rendered(self):
+        paths = discover_projects(self.path)
+        self.assertEqual(paths, [os.path.join(self.path, 'a'), os.path.join(self.path, 'b')])
+        plan = ProjectsPlan(paths, jobs=2)
+        results = plan.run()
+        self.assertEqual(sorted(results), paths)
+        for path in paths:
+            self.assertEqual([r.relpath for r in results[path]], ['centos7/Dockerfile'])
+            with open(os.path.join(path, 'centos7', 'Dockerfile')) as stream:
+                self.assertEqual(stream.read(), 'FROM {}:centos7'.format(os.path.basename(path)))
+        self.assertEqual(ProjectsPlan(paths).run(), dict((p, []) for p in paths))
+
+    def test_shard_is_selected_among_all_projects(self):
+        paths = [os.path.join(self.path, 'a'), os.path.join(self.path, 'b')]
+        shards = [ProjectsPlan(paths, shard=(i, 2), cache=False, dry_run=True).pairs()
+                  for i in (1, 2)]
+        # one target of each project, the projects end up in different shards
+        self.assertEqual(sorted(map(len, p) for p in shards), [[0, 1], [1, 0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools import execute
+from citools.config import ConfigLoader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+updated = imp.load_source('git_updated_dockerfiles',
+                          os.path.join(ROOT, 'git-updated-dockerfiles.py'))
+
+ENV = dict(GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+           GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+class ImpactedDockerfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = os.path.realpath(tempfile.mkdtemp())
+        self.environ = dict(os.environ)
+        os.environ.update(ENV)
+        self.loader = updated.config_loader
+        updated.config_loader = ConfigLoader(cache_dir=os.path.join(self.path, '.git', 'cache'),
+                                             safe=True)
+        os.chdir(self.path)
+        execute.git('init', '-q')
+        self.commit({'base.yaml': 'env:\n  registry: quay.io/org/\n',
+                     'project/docker-template.yaml': 'extends: ../base.yaml\n',
+                     'project/Dockerfile.template': 'FROM {{ version }}\n',
+                     'project/Dockerfile.template-scm': 'FROM {{ version }}\n',
+                     'project/centos7/files/conf': 'a\n',
+                     'project/centos7/scm/conf': 'a\n',
+                     'project/fedora23/files/conf': 'a\n'})
+        execute.git('tag', 'base')
+        os.chdir('project')
+
+    def tearDown(self):
+        updated.config_loader = self.loader
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def commit(self, files):
+        for name, content in files.items():
+            if not os.path.isdir(os.path.dirname(name) or '.'):
+                os.makedirs(os.path.dirname(name))
+            with open(name, 'w') as stream:
+                stream.write(content)
+        execute.git('add', '-A')
+        execute.git('commit', '-q', '-m', 'change')
+
+    def impacted(self):
+        return sorted(updated.impacted_dockerfiles('base..HEAD', 'docker-template.yaml'))
+
+    def test_template_change(self):
+        self.commit({'Dockerfile.template-scm': 'FROM {{ version }}:latest\n'})
+        self.assertEqual(self.impacted(), ['centos7/scm/Dockerfile', 'fedora23/scm/Dockerfile'])
+
+    def test_version_directory_changes(self):
+        self.commit({'centos7/files/conf': 'b\n', 'centos7/scm/conf': 'b\n',
+                     'debian9/files/conf': 'a\n'})
+        self.assertEqual(self.impacted(), ['centos7/Dockerfile', 'centos7/scm/Dockerfile',
+                                           'debian9/Dockerfile', 'debian9/scm/Dockerfile'])
+
+    def test_base_config_change(self):
+        self.commit({'../base.yaml': 'env:\n  registry: quay.io/other/\n'})
+        self.assertEqual(len(self.impacted()), 4)
+
+    def test_skip_version_change(self):
+        self.commit({'docker-template.yaml': 'extends: ../base.yaml\nskip-version: [fedora*]\n'})
+        self.assertEqual(self.impacted(), [])
+        self.commit({'docker-template.yaml': 'extends: ../base.yaml\n'})
+        self.assertEqual(self.impacted(), [])
+
+    def test_unrelated_change(self):
+        self.commit({'README': 'readme\n'})
+        self.assertEqual(self.impacted(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
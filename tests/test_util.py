@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from citools.util import atomic_write, read_file
+
+
+class AtomicWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_parent_directories_are_created(self):
+        path = os.path.join(self.path, 'a', 'b', 'Dockerfile')
+        atomic_write(path, 'FROM centos\n')
+        self.assertEqual(read_file(path), 'FROM centos\n')
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['Dockerfile'])
+
+    def test_mode_is_kept(self):
+        path = os.path.join(self.path, 'script')
+        atomic_write(path, 'a')
+        self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+        os.chmod(path, 0755)
+        atomic_write(path, 'b')
+        self.assertEqual(os.stat(path).st_mode & 0777, 0755)
+        self.assertEqual(read_file(path), 'b')
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        path = os.path.join(self.path, 'dir')
+        os.makedirs(os.path.join(path, 'entry'))
+        self.assertRaises(OSError, atomic_write, path, 'content')
+        self.assertEqual(os.listdir(self.path), ['dir'])
+
+    def test_read_missing_file(self):
+        self.assertIsNone(read_file(os.path.join(self.path, 'missing')))
+
+
+if __name__ == '__main__':
+    unittest.main()